@@ -1,12 +1,21 @@
+import collections
+import errno
+import heapq
 import logging
+import math
+import os
 import platform
+import queue
 import re
+import select
+import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+from array import array
 
-import Queue
 import yaml
 from alertaclient.api import Client
 
@@ -23,6 +32,22 @@ PING_SLOW_WARNING = 200  # ms
 PING_SLOW_CRITICAL = 500  # ms
 SERVER_THREAD_COUNT = 20
 LOOP_EVERY = 30
+# 'icmp' for ICMP sockets, 'subprocess' to run ping per target, 'auto' to fall back to ping
+PING_ENGINE = 'auto'
+PING_PAYLOAD = 56  # bytes of data in each echo request, as ping
+PING_HISTORY = 64  # probe results kept per target
+# seconds of probe results alerts are based on, or 'window' of a group of targets
+PING_WINDOW = 300
+PING_LOSS_THRESHOLD = 20  # percent packet loss over the window that raises PingFailed
+# echo requests per second when sweeping a group with 'sweep: true'
+PING_SWEEP_RATE = 5000
+PING_SWEEP_TIMEOUT = 2  # seconds to wait for each reply when sweeping
+PING_MAX_BLOCK = 65536  # most addresses of a target that is not swept, a /16
+PING_DNS_TTL = 300  # seconds that the address of a target is cached
+PING_FAILING_EVERY = 10  # seconds between probes of failing targets
+PING_STABLE_EVERY = 300  # longest interval between probes of stable targets
+PING_STABLE_AFTER = 10  # healthy results in a row before a target is stable
+PING_STABLE_COUNT = 1  # echo requests sent to stable targets
 
 _PING_ALERTS = [
     'PingFailed',
@@ -35,6 +60,12 @@ PING_OK = 0       # all ping replies received within timeout
 PING_FAILED = 1   # some or all ping replies not received or did not respond within timeout
 PING_ERROR = 2    # unspecified error with ping
 
+# a ping of `resource`, with the (count, timeout) of its first attempt or the result if already pinged
+PingRequest = collections.namedtuple(
+    'PingRequest', 'environment service resource retries queue_time result window params')
+
+_IPV4 = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
 
 # Initialise Rules
 def init_targets():
@@ -42,17 +73,630 @@ def init_targets():
     targets = list()
     LOG.info('Loading Ping targets...')
     try:
-        targets = yaml.load(open(PING_FILE))
+        targets = yaml.safe_load(open(PING_FILE))
     except Exception as e:
         LOG.error('Failed to load Ping targets: %s', e)
+
+    for p in targets:
+        valid = []
+        for target in p.get('targets') or []:
+            try:
+                span = target_range(target)
+                if span and not p.get('sweep') and span[1] - span[0] + 1 > PING_MAX_BLOCK:
+                    raise ValueError('larger than a /16, use sweep: true')
+            except (ValueError, OSError) as e:
+                LOG.error('Ignoring Ping target %s: %s', target, e)
+                continue
+            valid.append(target)
+        p['targets'] = valid
     LOG.info('Loaded %d Ping targets OK', len(targets))
 
     return targets
 
 
+def _ip2int(address):
+
+    if not _IPV4.match(address) or any(int(octet) > 255 for octet in address.split('.')):
+        raise ValueError('%s is not an IPv4 address' % address)
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _int2ip(n):
+
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+
+def target_range(target):
+    """Return the (first, last) address of a CIDR block or address range as integers, None for a host.
+
+    Ranges are written 10.0.0.1-10.0.0.20 or 10.0.0.1-20. Blocks larger
+    than a /31 exclude their network and broadcast addresses.
+    """
+
+    if '/' in target:
+        address, prefix = target.split('/', 1)
+        prefix = int(prefix)
+        if not 0 <= prefix <= 32:
+            raise ValueError('invalid prefix length /%d' % prefix)
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        first = _ip2int(address) & mask
+        last = first | (~mask & 0xffffffff)
+        if prefix < 31:
+            first, last = first + 1, last - 1
+        return first, last
+    start, _, end = target.partition('-')
+    if end and _IPV4.match(start):
+        first = _ip2int(start)
+        if '.' in end:
+            last = _ip2int(end)
+        elif 0 <= int(end) <= 255:
+            last = (first & 0xffffff00) | int(end)
+        else:
+            raise ValueError('invalid last octet %s' % end)
+        if not first <= last <= 0xffffffff:
+            raise ValueError('range ends before it starts')
+        return first, last
+    return None
+
+
+def expand_target(target):
+    """Yield the addresses of a CIDR block or address range one at a time, or the host itself."""
+
+    span = target_range(target)
+    if span is None:
+        yield target
+        return
+    n, last = span
+    while n <= last:
+        yield _int2ip(n)
+        n += 1
+
+
+def iter_targets(ping_list, sweep=False):
+    """Yield (environment, service, host, retries, window) for every host of the groups that sweep or not."""
+
+    for p in ping_list:
+        if bool(p.get('sweep')) != sweep or not p.get('targets'):
+            continue
+        retries = p.get('retries', PING_MAX_RETRIES)
+        window = p.get('window', PING_WINDOW)
+        for target in p['targets']:
+            for host in expand_target(target):
+                yield p['environment'], p['service'], host, retries, window
+
+
+def probe_params(retries):
+    """Return the (count, timeout) of a ping with `retries` left."""
+
+    if retries > 1:
+        return 2, 5
+    return 5, PING_MAX_TIMEOUT
+
+
+def _checksum(data):
+
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class WindowStats:
+    """Packet loss, round-trip times and availability of a target over a window."""
+
+    __slots__ = ('sent', 'lost', 'loss',
+                 'availability', 'avg', 'p95', 'jitter')
+
+    def __init__(self, sent, lost, bursts, answered, rtts):
+
+        self.sent = sent
+        self.lost = lost
+        self.loss = round(100.0 * lost / sent, 1)
+        # percent of bursts with a reply
+        self.availability = round(100.0 * answered / bursts, 1)
+        if rtts:
+            ordered = sorted(rtts)
+            self.avg = round(sum(rtts) / len(rtts), 3)
+            rank = max(int(math.ceil(0.95 * len(ordered))) - 1, 0)
+            self.p95 = round(ordered[rank], 3)
+            # mean difference between consecutive round-trip times, as RFC 3550
+            if len(rtts) > 1:
+                deltas = [abs(b - a) for a, b in zip(rtts, rtts[1:])]
+                self.jitter = round(sum(deltas) / len(deltas), 3)
+            else:
+                self.jitter = 0.0
+        else:
+            self.avg = self.p95 = self.jitter = None
+
+    def attributes(self, window):
+
+        return {
+            'packetLoss': self.loss,
+            'rttAvg': self.avg,
+            'rttP95': self.p95,
+            'jitter': self.jitter,
+            'availability': self.availability,
+            'window': window
+        }
+
+
+class PingStats:
+    """The last `size` probe results of every target.
+
+    Results are kept in flat typed arrays with a block of `size` entries
+    per target, about 9 bytes a result, so tens of thousands of targets fit
+    in a few tens of megabytes. Each entry holds the time sent in seconds,
+    the round-trip time and whether a reply was received and the probe was
+    the first of a burst.
+    """
+
+    REPLIED = 1
+    FIRST = 2
+
+    def __init__(self, size=PING_HISTORY):
+
+        self.size = size
+        self._slots = {}
+        self._written = array('L')
+        self._times = array('I')
+        self._rtts = array('f')
+        self._flags = array('B')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._slots)
+
+    def __contains__(self, target):
+
+        return target in self._slots
+
+    def _slot(self, target):
+
+        slot = self._slots.get(target)
+        if slot is None:
+            slot = self._slots[target] = len(self._slots)
+            self._written.append(0)
+            self._times.extend(array('I', [0]) * self.size)
+            self._rtts.extend(array('f', [0]) * self.size)
+            self._flags.extend(array('B', [0]) * self.size)
+        return slot
+
+    def record(self, target, rtts, lost, timestamp=None):
+        """Add a burst of probes: the round-trip times of the replies and the number lost."""
+
+        timestamp = int(timestamp or time.time())
+        flags = self.FIRST
+        with self._lock:
+            slot = self._slot(target)
+            for rtt in list(rtts) + [None] * lost:
+                i = slot * self.size + self._written[slot] % self.size
+                self._times[i] = timestamp
+                self._rtts[i] = rtt or 0
+                if rtt is not None:
+                    flags |= self.REPLIED
+                self._flags[i] = flags
+                self._written[slot] += 1
+                flags = 0
+
+    def window(self, target, seconds, now=None):
+        """Return the WindowStats of the last `seconds` of a target, None if it has no results."""
+
+        since = (now or time.time()) - seconds
+        with self._lock:
+            slot = self._slots.get(target)
+            if slot is None:
+                return None
+            written = self._written[slot]
+            start = slot * self.size
+            sent = lost = bursts = answered = 0
+            replied = False
+            rtts = []
+            for n in range(max(written - self.size, 0), written):
+                i = start + n % self.size
+                if self._times[i] < since:
+                    continue
+                flags = self._flags[i]
+                if flags & self.FIRST:
+                    answered += replied
+                    bursts += 1
+                    replied = False
+                sent += 1
+                if flags & self.REPLIED:
+                    replied = bursts > 0  # the start of a burst may have been overwritten
+                    rtts.append(self._rtts[i])
+                else:
+                    lost += 1
+            answered += replied
+        if not sent:
+            return None
+        return WindowStats(sent, lost, max(bursts, 1), answered, rtts)
+
+
+class ProbeSchedule:
+    """When each target is next due, and how many echo requests to send it.
+
+    Targets start out probed every LOOP_EVERY seconds. After PING_STABLE_AFTER
+    healthy results in a row the interval doubles with each healthy result,
+    up to PING_STABLE_EVERY, and PING_STABLE_COUNT packets are sent. Failing
+    targets are probed every PING_FAILING_EVERY seconds with a short burst
+    and no retries until they recover. Degraded targets, slow or losing
+    some packets, go back to LOOP_EVERY.
+    """
+
+    HEALTHY = 0
+    DEGRADED = 1
+    FAILING = 2
+
+    def __init__(self):
+
+        self._slots = {}
+        self._due = array('d')
+        self._interval = array('f')
+        self._streak = array('H')
+        self._state = array('B')
+        self._lock = threading.Lock()
+        self.packets = 0  # echo requests sent since the last summary()
+
+    def _slot(self, target):
+
+        slot = self._slots.get(target)
+        if slot is None:
+            slot = self._slots[target] = len(self._slots)
+            self._due.append(0)
+            self._interval.append(LOOP_EVERY)
+            self._streak.append(0)
+            self._state.append(self.HEALTHY)
+        return slot
+
+    def stable(self, slot):
+
+        return self._state[slot] == self.HEALTHY and self._streak[slot] >= PING_STABLE_AFTER
+
+    def due(self, targets, now=None):
+        """Yield the (environment, service, host, retries, window) of `targets` that are due, with the
+        (count, timeout) and retries of their first attempt appended.
+        """
+
+        now = now or time.time()
+        for target in targets:
+            host, retries = target[2], target[3]
+            with self._lock:
+                slot = self._slot(host)
+                if self._due[slot] > now:
+                    continue
+                self._due[slot] = now + self._interval[slot]
+                if self._state[slot] == self.FAILING:
+                    params, retries = (2, 5), 0
+                elif self.stable(slot):
+                    count = min(PING_STABLE_COUNT, probe_params(retries)[0])
+                    params = (count, 5)
+                else:
+                    params = probe_params(retries)
+            yield target[:3] + (retries,) + target[4:] + (params,)
+
+    def update(self, target, state):
+        """Set the state of a target after its result, and when it is next due."""
+
+        with self._lock:
+            slot = self._slots.get(target)
+            if slot is None:  # swept hosts are not scheduled
+                return
+            interval = self._interval[slot]
+            if state == self.HEALTHY:
+                self._streak[slot] = min(self._streak[slot] + 1, 0xffff)
+                if self._streak[slot] >= PING_STABLE_AFTER:
+                    self._interval[slot] = min(interval * 2, PING_STABLE_EVERY)
+                else:
+                    self._interval[slot] = LOOP_EVERY
+            else:
+                self._streak[slot] = 0
+                self._interval[slot] = PING_FAILING_EVERY if state == self.FAILING else LOOP_EVERY
+            self._state[slot] = state
+            self._due[slot] += self._interval[slot] - interval
+
+    def sent(self, packets):
+
+        with self._lock:
+            self.packets += packets
+
+    def summary(self):
+        """Return the packets sent since the last summary and the number of stable, healthy, degraded and failing targets."""
+
+        with self._lock:
+            counts = [0, 0, 0, 0]
+            for slot in range(len(self._slots)):
+                counts[0 if self.stable(slot) else self._state[slot] + 1] += 1
+            packets, self.packets = self.packets, 0
+        return packets, counts
+
+
+class _Probe:
+
+    __slots__ = ('node', 'addr', 'count', 'timeout',
+                 'sent', 'rtts', 'error', 'deadline')
+
+    def __init__(self, node, addr, count=1, timeout=PING_SWEEP_TIMEOUT):
+
+        self.node = node
+        self.addr = addr
+        self.count = count
+        self.timeout = timeout
+        self.sent = 0
+        self.rtts = []
+        self.error = None
+        self.deadline = None
+
+
+class IcmpPinger:
+    """Ping many hosts at once from a single ICMP socket.
+
+    Uses an unprivileged datagram ICMP socket where the system allows it
+    (net.ipv4.ping_group_range on Linux) or else a raw socket, which needs
+    root. Echo replies are matched to requests by address and sequence
+    number, and on raw sockets also by identifier as they see every ICMP
+    packet. Raises socket.error if neither kind of socket can be opened.
+    """
+
+    def __init__(self):
+
+        try:
+            self.sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except OSError:
+            self.sock = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        self.sock.setblocking(False)
+        try:
+            # replies arrive in bursts
+            self.sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        except OSError:
+            pass
+        self.ident = os.getpid() & 0xffff  # replaced by the kernel on datagram sockets
+        self.seq = 0
+        self.sent = 0  # echo requests sent
+        self.payload = (b'alerta-pinger' * PING_PAYLOAD)[:PING_PAYLOAD]
+        self.addresses = {}  # node: (addr, expiry)
+
+    def close(self):
+
+        self.sock.close()
+
+    def packet(self, seq):
+
+        header = struct.pack('!BBHHH', 8, 0, 0, self.ident, seq)
+        checksum = _checksum(header + self.payload)
+        return struct.pack('!BBHHH', 8, 0, checksum, self.ident, seq) + self.payload
+
+    def ping(self, node, count=1, interval=1, timeout=5):
+        """Ping one node, returning (rc, rtt, loss, stdout) like WorkerThread.pinger()."""
+
+        return self.ping_many([node], count, interval, timeout)[node]
+
+    def resolve(self, node):
+        """Return the address of `node`, looked up at most once every PING_DNS_TTL seconds."""
+
+        now = time.time()
+        cached = self.addresses.get(node)
+        if cached and cached[1] > now:
+            return cached[0]
+        addr = socket.gethostbyname(node)
+        self.addresses[node] = (addr, now + PING_DNS_TTL)
+        return addr
+
+    def ping_many(self, nodes, count=1, interval=1, timeout=5, stats=None):
+        """Ping all `nodes` at the same time and return {node: (rc, rtt, loss, stdout)}.
+
+        Each node is sent `count` echo requests `interval` seconds apart and
+        has `timeout` seconds from its first request to reply, unless `nodes`
+        is a dict of {node: (count, timeout)}. First requests are spread over
+        one interval so that thousands of nodes do not all send at once. The
+        replies of every node are added to `stats` if given.
+        """
+
+        if not isinstance(nodes, dict):
+            nodes = dict.fromkeys(nodes, (count, timeout))
+
+        results = {}
+        probes = []
+        for node, (count, timeout) in nodes.items():
+            if timeout <= count * interval:
+                timeout = count * interval + 1
+            if timeout > PING_MAX_TIMEOUT:
+                timeout = PING_MAX_TIMEOUT
+            try:
+                probes.append(_Probe(node, self.resolve(node), count, timeout))
+            except OSError:
+                results[node] = (PING_ERROR, (0, 0), 'n/a',
+                                 'ping: unknown host %s' % node)
+
+        start = time.time()
+        spread = interval / len(probes) if probes else 0
+        heap = [(start + i * spread, i, 0) for i in range(len(probes))]
+        longest = max(probe.timeout for probe in probes) if probes else 0
+        end = start + len(probes) * spread + longest
+        pending = {}  # (addr, seq): (probe index, time sent)
+        drained = False
+
+        while heap or pending:
+            now = time.time()
+            if now >= end:
+                break
+            while heap and heap[0][0] <= now:
+                due, i, n = heapq.heappop(heap)
+                probe = probes[i]
+                if probe.error:
+                    continue
+                try:
+                    seq = self.send(probe.addr)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                        # socket buffer full, try again shortly
+                        heapq.heappush(heap, (now + 0.01, i, n))
+                    else:
+                        probe.error = 'ping: sendto: %s' % e
+                    continue
+                sent = time.time()
+                if probe.deadline is None:
+                    probe.deadline = sent + probe.timeout
+                probe.sent += 1
+                pending[(probe.addr, seq)] = (i, sent)
+                if n + 1 < probe.count:
+                    heapq.heappush(heap, (due + interval, i, n + 1))
+            if not heap and not drained:
+                # all requests sent, stop once every probe has had its time to reply
+                drained = True
+                deadlines = [p.deadline for p in probes if p.deadline]
+                end = min(end, max(deadlines) if deadlines else now)
+
+            wait = min(heap[0][0] if heap else end, end) - time.time()
+            if select.select([self.sock], [], [], max(wait, 0))[0]:
+                for address, seq, received in self.replies():
+                    entry = pending.pop((address, seq), None)
+                    if entry is None:
+                        continue
+                    i, sent = entry
+                    if received <= probes[i].deadline:
+                        probes[i].rtts.append((received - sent) * 1000)
+
+        for probe in probes:
+            results[probe.node] = self.result(probe, probe.count)
+            if stats is not None and probe.sent:
+                stats.record(probe.node, probe.rtts,
+                             probe.sent - len(probe.rtts), start)
+        return results
+
+    def sweep(self, nodes, timeout=PING_SWEEP_TIMEOUT, rate=PING_SWEEP_RATE):
+        """Send one echo request to each of `nodes` and yield a _Probe for each as it replies or times out.
+
+        Nodes are read from the iterable as they are sent, `rate` a second,
+        so only those waiting for a reply are held in memory.
+        """
+
+        nodes = iter(nodes)
+        pending = {}  # (addr, seq): (probe, time sent)
+        expiry = collections.deque()  # (deadline, (addr, seq)) in the order sent
+        next_send = time.time()
+        exhausted = False
+        retry = None  # node to send again once the socket buffer has room
+
+        while not exhausted or pending:
+            now = time.time()
+            while not exhausted and next_send <= now:
+                if retry is not None:
+                    node, retry = retry, None
+                else:
+                    try:
+                        node = next(nodes)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                try:
+                    probe = _Probe(node, socket.gethostbyname(node))
+                    seq = self.send(probe.addr)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                        # socket buffer full, try again shortly
+                        retry = node
+                        next_send = now + 0.01
+                        break
+                    LOG.debug('Could not sweep %s: %s', node, e)
+                    continue
+                sent = time.time()
+                probe.sent = 1
+                probe.deadline = sent + timeout
+                pending[(probe.addr, seq)] = (probe, sent)
+                expiry.append((probe.deadline, (probe.addr, seq)))
+                next_send += 1.0 / rate
+
+            while expiry and expiry[0][0] <= now:
+                entry = pending.pop(expiry.popleft()[1], None)
+                if entry is not None:
+                    yield entry[0]
+
+            wakeup = now + timeout
+            if not exhausted:
+                wakeup = min(wakeup, next_send)
+            if expiry:
+                wakeup = min(wakeup, expiry[0][0])
+            if select.select([self.sock], [], [], max(wakeup - time.time(), 0))[0]:
+                for address, seq, received in self.replies():
+                    entry = pending.pop((address, seq), None)
+                    if entry is not None:
+                        probe, sent = entry
+                        probe.rtts.append((received - sent) * 1000)
+                        yield probe
+
+    def send(self, addr):
+        """Send an echo request to `addr` and return its sequence number."""
+
+        self.seq = (self.seq + 1) & 0xffff
+        self.sock.sendto(self.packet(self.seq), (addr, 0))
+        self.sent += 1
+        return self.seq
+
+    def replies(self):
+        """Yield (address, seq, time received) of the echo replies waiting on the socket."""
+
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    LOG.debug('ICMP receive failed: %s', e)
+                return
+            received = time.time()
+
+            if self.raw or (len(data) >= 20 and struct.unpack('!B', data[:1])[0] >> 4 == 4):
+                # strip IP header
+                ihl = struct.unpack('!B', data[:1])[0] & 0x0f
+                data = data[ihl * 4:]
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != 0 or (self.raw and ident != self.ident):
+                continue
+            yield address[0], seq, received
+
+    @staticmethod
+    def result(probe, count):
+
+        received = len(probe.rtts)
+        if probe.error and not received:
+            return PING_ERROR, (0, 0), 'n/a', probe.error
+
+        if probe.sent:
+            loss = '%g' % (100.0 * (probe.sent - received) / probe.sent)
+        else:
+            loss = 'n/a'
+        stdout = '--- %s ping statistics ---\n%d packets transmitted, %d received, %s%% packet loss' % (
+            probe.node, probe.sent, received, loss)
+        if received:
+            avg = sum(probe.rtts) / received
+            mdev = (sum((rtt - avg) ** 2 for rtt in probe.rtts) / received) ** 0.5
+            stdout += '\nrtt min/avg/max/mdev = {:.3f}/{:.3f}/{:.3f}/{:.3f} ms'.format(
+                min(probe.rtts), avg, max(probe.rtts), mdev)
+            rtt = (round(avg, 3), round(max(probe.rtts), 3))
+        else:
+            rtt = (0, 0)
+
+        # like ping -c -w, fewer replies than requests is a failure
+        rc = PING_OK if received >= count else PING_FAILED
+        if rc == PING_OK:
+            LOG.info('%s: is alive %s', probe.node, rtt)
+        else:
+            LOG.info('%s: not responding', probe.node)
+        return rc, rtt, loss, stdout
+
+
 class WorkerThread(threading.Thread):
 
-    def __init__(self, api, queue):
+    def __init__(self, api, queue, stats, schedule):
 
         threading.Thread.__init__(self)
         LOG.debug('Initialising %s...', self.getName())
@@ -60,6 +704,8 @@ class WorkerThread(threading.Thread):
         self.last_event = {}
         self.queue = queue   # internal queue
         self.api = api               # message broker
+        self.stats = stats   # PingStats shared by all workers
+        self.schedule = schedule  # ProbeSchedule shared by all workers
 
     def run(self):
 
@@ -71,7 +717,7 @@ class WorkerThread(threading.Thread):
                 LOG.info('%s is shutting down.', self.getName())
                 break
 
-            environment, service, resource, retries, queue_time = item
+            environment, service, resource, retries, queue_time, result, window, params = item
 
             if time.time() - queue_time > LOOP_EVERY:
                 LOG.warning('Ping request to %s expired after %d seconds.',
@@ -79,52 +725,78 @@ class WorkerThread(threading.Thread):
                 self.queue.task_done()
                 continue
 
-            LOG.info('%s pinging %s...', self.getName(), resource)
-            if retries > 1:
-                rc, rtt, loss, stdout = self.pinger(
-                    resource, count=2, timeout=5)
+            if result:  # already pinged, and recorded, by the ICMP engine
+                rc, rtt, loss, stdout = result
             else:
+                LOG.info('%s pinging %s...', self.getName(), resource)
+                count, timeout = params or probe_params(retries)
                 rc, rtt, loss, stdout = self.pinger(
-                    resource, count=5, timeout=PING_MAX_TIMEOUT)
+                    resource, count=count, timeout=timeout)
+                self.schedule.sent(count)
+                if rc in (PING_OK, PING_FAILED):
+                    # ping -q only reports the average, count that for every reply
+                    if loss == 'n/a':
+                        received = count if rc == PING_OK else 0
+                    else:
+                        received = count * (100 - float(loss)) / 100
+                        received = int(round(received))
+                    self.stats.record(
+                        resource, [rtt[0]] * received, count - received)
 
-            if rc != PING_OK and retries:
+            if rc != PING_OK and retries and not result:
                 LOG.info('Retrying ping %s %s more times', resource, retries)
-                self.queue.put((environment, service, resource,
-                                retries - 1, time.time()))
+                self.queue.put(PingRequest(environment, service, resource,
+                                           retries - 1, time.time(), None, window, None))
                 self.queue.task_done()
                 continue
 
-            if rc == PING_OK:
-                avg, max = rtt
-                if avg > PING_SLOW_CRITICAL:
-                    event = 'PingSlow'
-                    severity = 'critical'
-                    text = 'Node responded to ping in {} ms avg (> {} ms)'.format(
-                        avg, PING_SLOW_CRITICAL)
-                elif avg > PING_SLOW_WARNING:
-                    event = 'PingSlow'
-                    severity = 'warning'
-                    text = 'Node responded to ping in {} ms avg (> {} ms)'.format(
-                        avg, PING_SLOW_WARNING)
-                else:
-                    event = 'PingOK'
-                    severity = 'normal'
-                    text = 'Node responding to ping avg/max %s/%s ms.' % tuple(
-                        rtt)
-                value = '%s/%s ms' % tuple(rtt)
-            elif rc == PING_FAILED:
-                event = 'PingFailed'
-                severity = 'major'
-                text = 'Node did not respond to ping or timed out within %s seconds' % PING_MAX_TIMEOUT
-                value = '%s%% packet loss' % loss
-            elif rc == PING_ERROR:
+            attributes = {}
+            state = ProbeSchedule.FAILING
+            if rc == PING_ERROR:
                 event = 'PingError'
                 severity = 'warning'
                 text = 'Could not ping node %s.' % resource
                 value = stdout
+            elif rc == PING_FAILED and loss in ('100', 'n/a'):
+                event = 'PingFailed'
+                severity = 'major'
+                text = 'Node did not respond to ping or timed out within %s seconds' % PING_MAX_TIMEOUT
+                value = '%s%% packet loss' % loss
+            elif rc in (PING_OK, PING_FAILED):
+                # partial loss and slow replies are judged over the window, not one burst
+                stats = self.stats.window(resource, window)
+                attributes = stats.attributes(window)
+                state = ProbeSchedule.HEALTHY if stats.loss == 0 else ProbeSchedule.DEGRADED
+                if stats.loss > PING_LOSS_THRESHOLD or stats.avg is None:
+                    state = ProbeSchedule.FAILING
+                    event = 'PingFailed'
+                    severity = 'major'
+                    text = 'Node lost {}% of pings in the last {} seconds (> {}%)'.format(
+                        stats.loss, window, PING_LOSS_THRESHOLD)
+                    value = '%s%% packet loss' % stats.loss
+                else:
+                    if stats.p95 > PING_SLOW_WARNING:
+                        state = ProbeSchedule.DEGRADED
+                    if stats.p95 > PING_SLOW_CRITICAL:
+                        event = 'PingSlow'
+                        severity = 'critical'
+                        text = 'Node responded to ping in {} ms p95 over {} seconds (> {} ms)'.format(
+                            stats.p95, window, PING_SLOW_CRITICAL)
+                    elif stats.p95 > PING_SLOW_WARNING:
+                        event = 'PingSlow'
+                        severity = 'warning'
+                        text = 'Node responded to ping in {} ms p95 over {} seconds (> {} ms)'.format(
+                            stats.p95, window, PING_SLOW_WARNING)
+                    else:
+                        event = 'PingOK'
+                        severity = 'normal'
+                        text = 'Node responding to ping avg/p95 {}/{} ms, jitter {} ms.'.format(
+                            stats.avg, stats.p95, stats.jitter)
+                    value = '{}/{} ms'.format(stats.avg, stats.p95)
             else:
                 LOG.warning('Unknown ping return code: %s', rc)
                 continue
+            self.schedule.update(resource, state)
 
             # Defaults
             resource += ':icmp'
@@ -144,6 +816,7 @@ class WorkerThread(threading.Thread):
                     service=service,
                     text=text,
                     event_type='serviceAlert',
+                    attributes=attributes,
                     raw_data=raw_data,
                 )
             except Exception as e:
@@ -169,7 +842,8 @@ class WorkerThread(threading.Thread):
             cmd = 'ping -q -c {} -i {} -w {} {}'.format(
                 count, interval, timeout, node)
         ping = subprocess.Popen(
-            cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
         stdout = ping.communicate()[0].rstrip('\n')
         rc = ping.returncode
         LOG.debug('Ping %s => %s (rc=%d)', cmd, stdout, rc)
@@ -201,22 +875,114 @@ class PingerDaemon:
 
         self.shuttingdown = False
 
+    def ping_targets(self, due, ping_list=None):
+        """Ping the targets that are due from the ICMP engine in one pass and queue the results for alerting.
+
+        Targets that failed with retries left are kept in `self.retrying` and
+        pinged again on the next tick rather than holding up this one. If
+        `ping_list` is given its sweep groups are swept first, and hosts that
+        replied before but miss the sweep are pinged along with the others.
+        """
+
+        targets = {}
+        for target in due + self.retrying:  # a retry replaces the same target due again
+            targets[target[2]] = target
+        if ping_list is not None:
+            for target in self.sweep_targets(ping_list):
+                targets.setdefault(target[2], target)
+        self.retrying = []
+        if not targets:
+            return
+
+        LOG.info('Pinging %d targets...', len(targets))
+        results = self.icmp.ping_many(
+            {target: params or probe_params(retries)
+             for _, _, target, retries, _, params in targets.values()},
+            stats=self.stats)
+
+        for environment, service, target, retries, window, _ in targets.values():
+            if results[target][0] != PING_OK and retries:
+                LOG.info('Retrying ping %s %s more times', target, retries)
+                self.retrying.append((environment, service, target,
+                                      retries - 1, window, None))
+            else:
+                self.queue.put(PingRequest(
+                    environment, service, target, 0, time.time(), results[target], window, None))
+
+    def sweep_targets(self, ping_list):
+        """Send one echo request to every host of the sweep groups and queue the replies for alerting.
+
+        Hosts that have never replied are not reported or remembered, so
+        memory grows with the number of live hosts rather than the size of
+        the swept blocks. Return the hosts that replied before but not now.
+        """
+
+        missed = []
+        hosts = iter_targets(ping_list, sweep=True)
+        # host: (environment, service, retries, window) of the hosts being swept
+        groups = {}
+
+        def nodes():
+            for environment, service, host, retries, window in hosts:
+                groups[host] = (environment, service, retries, window)
+                yield host
+
+        swept = alive = 0
+        for probe in self.icmp.sweep(nodes()):
+            entry = groups.pop(probe.node, None)
+            if entry is None:  # listed in more than one sweep group
+                continue
+            environment, service, retries, window = entry
+            swept += 1
+            if probe.rtts:
+                alive += 1
+                self.stats.record(probe.node, probe.rtts, 0)
+                result = IcmpPinger.result(probe, 1)
+                self.queue.put(PingRequest(environment, service, probe.node, 0,
+                                           time.time(), result, window, None))
+
+            elif probe.node in self.stats:
+                missed.append(
+                    (environment, service, probe.node, retries, window, None))
+        if swept:
+            LOG.info('Swept %d addresses, %d replied and %d replied before but not now',
+                     swept, alive, len(missed))
+        return missed
+
     def run(self):
 
         self.running = True
 
         # Create internal queue
-        self.queue = Queue.Queue()
+        self.queue = queue.Queue()
 
         self.api = Client()
+        self.stats = PingStats(PING_HISTORY)
+        self.schedule = ProbeSchedule()
+        self.retrying = []
 
         # Initialiase ping targets
         ping_list = init_targets()
 
+        self.icmp = None
+        if PING_ENGINE != 'subprocess':
+            try:
+                self.icmp = IcmpPinger()
+                LOG.info('Using %s ICMP socket',
+                         'raw' if self.icmp.raw else 'datagram')
+            except OSError as e:
+                if PING_ENGINE == 'icmp':
+                    raise
+                LOG.warning(
+                    'Could not open ICMP socket, running ping for each target: %s', e)
+        if not self.icmp and any(p.get('sweep') for p in ping_list):
+            LOG.warning(
+                'Sweeping needs an ICMP socket, ignoring targets with sweep: true')
+
         # Start worker threads
         LOG.debug('Starting %s worker threads...', SERVER_THREAD_COUNT)
         for i in range(SERVER_THREAD_COUNT):
-            w = WorkerThread(self.api, self.queue)
+            w = WorkerThread(self.api, self.queue, self.stats, self.schedule)
             try:
                 w.start()
             except Exception as e:
@@ -224,25 +990,40 @@ class PingerDaemon:
                 continue
             LOG.info('Started worker thread: %s', w.getName())
 
+        # failing targets are probed more often than once a cycle
+        tick = min(LOOP_EVERY, PING_FAILING_EVERY)
+        next_cycle = 0
+        summarised = time.time()
         while not self.shuttingdown:
             try:
-                for p in ping_list:
-                    if 'targets' in p and p['targets']:
-                        for target in p['targets']:
-                            environment = p['environment']
-                            service = p['service']
-                            retries = p.get('retries', PING_MAX_RETRIES)
-                            self.queue.put(
-                                (environment, service, target, retries, time.time()))
-
-                LOG.debug('Send heartbeat...')
-                try:
-                    origin = '{}/{}'.format('pinger', platform.uname()[1])
-                    self.api.heartbeat(origin, tags=[__version__])
-                except Exception as e:
-                    LOG.warning('Failed to send heartbeat: %s', e)
+                started = time.time()
+                cycle = started >= next_cycle
+                due = list(self.schedule.due(iter_targets(ping_list), started))
+                if self.icmp:
+                    sent = self.icmp.sent
+                    self.ping_targets(due, ping_list if cycle else None)
+                    self.schedule.sent(self.icmp.sent - sent)
+                else:
+                    for environment, service, target, retries, window, params in due:
+                        self.queue.put(PingRequest(
+                            environment, service, target, retries, time.time(), None, window, params))
+
+                if cycle:
+                    next_cycle = started + LOOP_EVERY
+
+                    LOG.debug('Send heartbeat...')
+                    try:
+                        origin = '{}/{}'.format('pinger', platform.uname()[1])
+                        self.api.heartbeat(origin, tags=[__version__])
+                    except Exception as e:
+                        LOG.warning('Failed to send heartbeat: %s', e)
+
+                    packets, counts = self.schedule.summary()
+                    LOG.info('Sent %d echo requests in the last %ds (%d stable, %d healthy, %d degraded, %d failing targets)',
+                             packets, time.time() - summarised, *counts)
+                    summarised = time.time()
 
-                time.sleep(LOOP_EVERY)
+                time.sleep(max(started + tick - time.time(), 0))
                 LOG.info('Ping queue length is %d', self.queue.qsize())
 
             except (KeyboardInterrupt, SystemExit):
@@ -254,6 +1035,8 @@ class PingerDaemon:
         for i in range(SERVER_THREAD_COUNT):
             self.queue.put(None)
         w.join()
+        if self.icmp:
+            self.icmp.close()
 
 
 def main():
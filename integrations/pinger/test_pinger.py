@@ -0,0 +1,141 @@
+'''
+Unit tests for ping targets, sweeps and window statistics
+'''
+import errno
+import socket
+
+import pinger
+import pytest
+
+
+@pytest.mark.parametrize('target, expected', [
+    ('10.0.0.0/30', ['10.0.0.1', '10.0.0.2']),
+    ('10.0.0.4/31', ['10.0.0.4', '10.0.0.5']),
+    ('10.0.0.9/32', ['10.0.0.9']),
+    ('10.0.0.7/29', ['10.0.0.%d' % n for n in range(1, 7)]),
+    ('10.0.0.254-10.0.1.1', ['10.0.0.254', '10.0.0.255',
+                             '10.0.1.0', '10.0.1.1']),
+    ('10.0.0.253-255', ['10.0.0.253', '10.0.0.254', '10.0.0.255']),
+    ('10.0.0.5-5', ['10.0.0.5']),
+    ('www.example.com', ['www.example.com']),
+    ('db-1', ['db-1']),
+])
+def test_expand_target(target, expected):
+    '''
+    Test blocks and ranges are expanded to their addresses and hosts are left alone
+    '''
+    assert list(pinger.expand_target(target)) == expected
+
+
+@pytest.mark.parametrize('target', [
+    '10.0.0.5-300',
+    '10.0.0.5--1',
+    '10.0.0.5-4',
+    '10.0.1.0-10.0.0.255',
+    '10.0.0.1-10.0.0.256',
+    '10.0.0.256/24',
+    '10.0.0.0/33',
+    '10.0.0/24',
+])
+def test_target_range_invalid(target):
+    '''
+    Test invalid blocks and ranges are rejected rather than wrapped around
+    '''
+    with pytest.raises(ValueError):
+        pinger.target_range(target)
+
+
+def test_target_range_host():
+    '''
+    Test a host is not a range
+    '''
+    assert pinger.target_range('www.example.com') is None
+
+
+def test_init_targets(tmp_path, monkeypatch):
+    '''
+    Test blocks larger than a /16 are only kept by groups that sweep them
+    '''
+    targets = tmp_path / 'targets.yaml'
+    targets.write_text('''
+- environment: Production
+  service: [Network]
+  targets: [10.0.0.0/16, 10.0.0.0/15, 10.1.0.1-10.3.0.1, 10.0.0.1-300, router-1]
+- environment: Production
+  service: [Office]
+  sweep: true
+  targets: [10.0.0.0/8]
+''')
+    monkeypatch.setattr(pinger, 'PING_FILE', str(targets))
+
+    ping_list = pinger.init_targets()
+    assert ping_list[0]['targets'] == ['10.0.0.0/16', 'router-1']
+    assert ping_list[1]['targets'] == ['10.0.0.0/8']
+
+
+def test_window_stats():
+    '''
+    Test packet loss, round-trip times and availability over a window
+    '''
+    stats = pinger.PingStats(size=16)
+    stats.record('router-1', [10.0, 20.0], 0, timestamp=1000)
+    stats.record('router-1', [], 2, timestamp=1010)
+    stats.record('router-1', [30.0], 1, timestamp=1020)
+
+    window = stats.window('router-1', 60, now=1030)
+    assert (window.sent, window.lost, window.loss) == (6, 3, 50.0)
+    assert window.availability == 66.7
+    assert window.avg == 20.0
+    assert window.p95 == 30.0
+    assert window.jitter == 10.0
+
+    # only the last burst is in a short window
+    window = stats.window('router-1', 15, now=1030)
+    assert (window.sent, window.lost, window.availability) == (2, 1, 100.0)
+    assert window.avg == 30.0
+
+    assert stats.window('router-1', 5, now=1030) is None
+    assert stats.window('router-2', 60, now=1030) is None
+
+
+def test_window_stats_overwritten():
+    '''
+    Test only the last `size` results of a target are kept
+    '''
+    stats = pinger.PingStats(size=4)
+    for n in range(10):
+        stats.record('router-1', [float(n)], 0, timestamp=1000 + n)
+
+    window = stats.window('router-1', 60, now=1010)
+    assert window.sent == 4
+    assert window.avg == 7.5
+    assert window.availability == 100.0
+
+
+def test_sweep_socket_buffer_full(monkeypatch):
+    '''
+    Test addresses are sent again, in order, while the socket buffer is full
+    '''
+    icmp = object.__new__(pinger.IcmpPinger)  # without an ICMP socket
+    icmp.sock, other = socket.socketpair()
+    full = iter([True, False, True, True, False])
+    sent = []
+
+    def send(addr):
+        if next(full, False):
+            raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+        sent.append(addr)
+        return len(sent)
+
+    monkeypatch.setattr(icmp, 'send', send)
+    monkeypatch.setattr(icmp, 'replies', lambda: iter(()))
+    try:
+        nodes = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+        probes = list(icmp.sweep(nodes, timeout=0.01, rate=1000))
+    finally:
+        icmp.sock.close()
+        other.close()
+
+    assert sent == nodes
+    assert [probe.node for probe in probes] == nodes
+    assert all(probe.sent == 1 and not probe.rtts for probe in probes)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of parsing syslog messages into alerts.
+
+Compares SyslogDaemon.parse_syslog() with the previous implementation, which
+tried up to six uncompiled re.match() calls per message and built the
+correlate list and tags of every alert from scratch, on a corpus of RFC 5424,
+RFC 3164 and Cisco messages.
+
+    $ python bench_parse.py [iterations]
+"""
+import logging
+import re
+import socket
+import sys
+import time
+import timeit
+
+import syslogfwder
+
+CORPUS = [
+    '<34>1 2003-10-11T22:14:15.003Z mymachine.example.com su - ID47 - BOM\'su root\' failed for lonvick on /dev/pts/8',
+    '<165>1 2003-08-24T05:14:15.000003-07:00 192.0.2.1 myproc 8710 - - %% It\'s time to make the do-nuts.',
+    '<13>Feb  5 17:32:18 10.0.0.99 myapp: Use the BFG!',
+    '<86>Oct 11 22:14:15 mymachine sshd[4721]: pam_unix(sshd:session): session opened for user root',
+    '<11>Jan 18 08:01:02 web-1 nginx: upstream timed out (110: Connection timed out) while reading response header',
+    '<189>158: *Mar  1 18:46:11: %SYS-5-CONFIG_I: Configured from console by vty2 (10.34.195.36)',
+    '<187>2231: Jun 12 10:21:33.482: %LINK-3-UPDOWN: Interface GigabitEthernet0/1, changed state to down',
+    '<190>%SEC-6-IPACCESSLOGP: list 102 denied tcp 10.1.1.1(1234) -> 10.2.2.2(22), 1 packet',
+]
+
+SOURCE = '192.0.2.1'
+
+
+def legacy_parse_syslog(ip, data):
+    # parse_syslog() before the formats were compiled
+
+    syslogAlerts = list()
+
+    event = None
+    resource = None
+
+    for msg in data.split('\n'):
+        if not msg or 'last message repeated' in msg:
+            continue
+
+        if re.match(r'<\d+>1', msg):
+            m = re.match(
+                r'<(\d+)>1 (\S+) (\S+) (\S+) (\S+) (\S+) (.*)', msg)
+            if m:
+                PRI = int(m.group(1))
+                HOSTNAME = m.group(3)
+                APPNAME = m.group(4)
+                PROCID = m.group(5)
+                MSGID = m.group(6)
+                TAG = '{}[{}] {}'.format(APPNAME, PROCID, MSGID)
+                MSG = m.group(7)
+            else:
+                continue
+
+        elif re.match(r'<(\d{1,3})>\S{3}\s', msg):
+            m = re.match(
+                r'<(\d{1,3})>\S{3}\s{1,2}\d?\d \d{2}:\d{2}:\d{2} (\S+)( (\S+):)? (.*)', msg)
+            if m:
+                PRI = int(m.group(1))
+                HOSTNAME = m.group(2)
+                TAG = m.group(4)
+                MSG = m.group(5)
+            else:
+                continue
+
+        elif re.match(r'<\d+>.*%[A-Z0-9_-]+', msg):
+            m = re.match(r'<(\d+)>.*(%([A-Z0-9_-]+)):? (.*)', msg)
+            if m:
+                PRI = int(m.group(1))
+                CISCO_SYSLOG = m.group(2)
+                try:
+                    CISCO_FACILITY, CISCO_MNEMONIC = m.group(
+                        3).split('-')
+                except ValueError:
+                    CISCO_FACILITY = CISCO_MNEMONIC = 'na'
+
+                TAG = CISCO_MNEMONIC
+                MSG = m.group(4)
+
+                event = CISCO_SYSLOG
+
+                try:
+                    socket.inet_aton(ip)
+                    (resource, _, _) = socket.gethostbyaddr(ip)
+                except (OSError, socket.herror):
+                    resource = ip
+
+                resource = '{}:{}'.format(resource, CISCO_FACILITY)
+            else:
+                continue
+
+        facility, level = syslogfwder.decode_priority(PRI)
+
+        event = event or '{}{}'.format(
+            facility.capitalize(), level.capitalize())
+        resource = resource or '{}{}'.format(
+            HOSTNAME, ':' + TAG if TAG else '')
+        severity = syslogfwder.priority_to_code(level)
+        tags = ['{}.{}'.format(facility, level)]
+        correlate = ['{}{}'.format(facility.capitalize(), s.capitalize())
+                     for s in syslogfwder.SYSLOG_SEVERITY_NAMES]
+
+        syslogAlerts.append({
+            'resource': resource,
+            'event': event,
+            'environment': 'Production',
+            'severity': severity,
+            'correlate': correlate,
+            'service': ['Platform'],
+            'group': 'Syslog',
+            'value': level,
+            'text': MSG,
+            'tags': tags,
+            'event_type': 'syslogAlert',
+            'raw_data': msg
+        })
+
+    return syslogAlerts
+
+
+def main():
+
+    logging.disable(logging.CRITICAL)
+    # Cisco messages look up the name of the sender, answer at once so DNS is not measured
+    socket.gethostbyaddr = lambda ip: ('router-1.example.com', [], [ip])
+    # until the name is cached
+    while syslogfwder._RESOLVER.name(SOURCE) == SOURCE:
+        time.sleep(0.01)
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    # one message per datagram, as most senders do
+    daemon = object.__new__(syslogfwder.SyslogDaemon)  # without its sockets
+    parse_syslog = daemon.parse_syslog
+    for msg in CORPUS:
+        expected = legacy_parse_syslog(SOURCE, msg)
+        assert parse_syslog(SOURCE, msg) == expected, msg
+
+    def run(parse):
+        for msg in CORPUS:
+            parse(SOURCE, msg)
+
+    legacy = min(timeit.repeat(lambda: run(legacy_parse_syslog),
+                               number=number, repeat=3))
+    compiled = min(timeit.repeat(lambda: run(parse_syslog),
+                                 number=number, repeat=3))
+
+    messages = number * len(CORPUS)
+
+    print('{:<10} {:>14}'.format('parser', 'messages/sec'))
+    print('%-10s %14d' % ('legacy', messages / legacy))
+    print('%-10s %14d' % ('compiled', messages / compiled))
+    print('speedup    %13.1fx' % (legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
+import errno
 import logging
+import multiprocessing
 import os
 import platform
+import queue
 import re
 import select
+import signal
 import socket
 import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 
 from alertaclient.api import Client
 
@@ -12,6 +19,22 @@ __version__ = '3.5.0'
 
 SYSLOG_TCP_PORT = int(os.environ.get('SYSLOG_TCP_PORT', 514))
 SYSLOG_UDP_PORT = int(os.environ.get('SYSLOG_UDP_PORT', 514))
+SYSLOG_TCP_MAX_CONNECTIONS = int(
+    os.environ.get('SYSLOG_TCP_MAX_CONNECTIONS', 1000))
+SYSLOG_MAX_MESSAGE_SIZE = int(os.environ.get('SYSLOG_MAX_MESSAGE_SIZE', 65536))
+SYSLOG_UDP_RCVBUF = int(os.environ.get('SYSLOG_UDP_RCVBUF', 4194304))
+SYSLOG_PROCESSES = int(os.environ.get('SYSLOG_PROCESSES', 1))
+# seconds host names are cached, 0 to disable
+SYSLOG_DNS_TTL = int(os.environ.get('SYSLOG_DNS_TTL', 300))
+# seconds expired names are used while refreshing
+SYSLOG_DNS_STALE_TTL = int(os.environ.get('SYSLOG_DNS_STALE_TTL', 3600))
+# seconds failed lookups are cached
+SYSLOG_DNS_NEGATIVE_TTL = int(os.environ.get('SYSLOG_DNS_NEGATIVE_TTL', 60))
+SYSLOG_DNS_CACHE_SIZE = int(os.environ.get('SYSLOG_DNS_CACHE_SIZE', 10000))
+SYSLOG_DNS_THREADS = 4  # background reverse lookups
+SYSLOG_TCP_BATCH = 100  # messages handled from one connection before serving the others
+# datagrams read on one wakeup before serving the TCP connections
+SYSLOG_UDP_BATCH = 1000
 
 
 SYSLOG_FACILITY_NAMES = [
@@ -63,9 +86,6 @@ SYSLOG_SEVERITY_MAP = {
     'debug': 'debug',
 }
 
-if sys.version_info[0] >= 3:
-    unicode = str
-
 
 def priority_to_code(name):
     return SYSLOG_SEVERITY_MAP.get(name, 'unknown')
@@ -77,6 +97,150 @@ def decode_priority(priority):
     return SYSLOG_FACILITY_NAMES[facility], SYSLOG_SEVERITY_NAMES[level]
 
 
+def udp_drops(sock):
+    """Return the number of datagrams the kernel dropped for a UDP socket because its receive buffer was full.
+
+    Only available on Linux, returns None elsewhere.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open('/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def send_heartbeat(api):
+
+    LOG.debug('Send heartbeat...')
+    try:
+        origin = '{}/{}'.format('syslog', platform.uname()[1])
+        api.heartbeat(origin, tags=[__version__])
+    except Exception as e:
+        LOG.warning('Failed to send heartbeat: %s', e)
+
+
+def log_counters(counters, seconds):
+
+    LOG.info('Received %d UDP and %d TCP messages in the last %ds, %d UDP messages dropped by the kernel',
+             counters['udp'], counters['tcp'], seconds, counters['dropped'])
+
+
+class ReverseResolver:
+    """LRU cache of the host names of source addresses.
+
+    Names are fresh for `ttl` seconds. For `stale_ttl` seconds after that the
+    old name is still returned while it is looked up again in the background.
+    Addresses without a name are cached for `negative_ttl` seconds. Lookups
+    never block the caller, the address itself is returned until its name
+    is known.
+    """
+
+    def __init__(self, size=SYSLOG_DNS_CACHE_SIZE, ttl=SYSLOG_DNS_TTL,
+                 stale_ttl=SYSLOG_DNS_STALE_TTL, negative_ttl=SYSLOG_DNS_NEGATIVE_TTL):
+
+        self.size = size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self._cache = OrderedDict()  # ip: (name, expires), least recently used first
+        self._pending = set()
+        self._queue = queue.Queue(maxsize=1000)
+        self._lock = threading.Lock()
+        self._pid = None  # lookup threads are started in the process that uses them
+
+    def name(self, ip):
+        """Return the host name of `ip`, or `ip` if it is not known yet or has none."""
+
+        try:
+            socket.inet_aton(ip)
+        except OSError:
+            return ip
+        if not self.ttl:
+            return self._lookup(ip)[0]
+
+        now = time.time()
+        with self._lock:
+            entry = self._cache.pop(ip, None)
+            if entry is not None:
+                name, expires = entry
+                if now < expires + self.stale_ttl:
+                    self._cache[ip] = entry
+                    if now >= expires:
+                        self._refresh(ip)
+                    return name
+            self._refresh(ip)
+        return ip
+
+    def _refresh(self, ip):
+        # with the lock held
+
+        if ip in self._pending:
+            return
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            for i in range(SYSLOG_DNS_THREADS):
+                t = threading.Thread(target=self._run, name='Resolver-%d' % i)
+                t.daemon = True
+                t.start()
+        try:
+            self._queue.put_nowait(ip)
+        except queue.Full:
+            return  # looked up again next time
+        self._pending.add(ip)
+
+    def _lookup(self, ip):
+
+        try:
+            return socket.gethostbyaddr(ip)[0], self.ttl
+        except OSError as e:
+            LOG.debug('No host name for %s: %s', ip, e)
+            return ip, self.negative_ttl
+
+    def _run(self):
+
+        while True:
+            ip = self._queue.get()
+            name, ttl = self._lookup(ip)
+            with self._lock:
+                self._cache.pop(ip, None)
+                self._cache[ip] = (name, time.time() + ttl)
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+                self._pending.discard(ip)
+
+
+_RESOLVER = ReverseResolver()
+
+
+def _priorities():
+    # (facility, level, event, severity, tags, correlate) indexed by PRI, lists are shared by all alerts
+    table = []
+    for facility in SYSLOG_FACILITY_NAMES:
+        correlate = ['{}{}'.format(facility.capitalize(), s.capitalize())
+                     for s in SYSLOG_SEVERITY_NAMES]
+        for level in SYSLOG_SEVERITY_NAMES:
+            table.append((facility, level, '{}{}'.format(facility.capitalize(), level.capitalize()),
+                          priority_to_code(level), ['{}.{}'.format(facility, level)], correlate))
+    return table
+
+
+SYSLOG_PRIORITIES = _priorities()
+
+# formats are matched after the <PRI> header
+_PRI = re.compile(r'<(\d+)>')
+_RFC5424 = re.compile(r'1 (\S+) (\S+) (\S+) (\S+) (\S+) (.*)')
+_RFC3164 = re.compile(
+    r'\S{3}\s{1,2}\d?\d \d{2}:\d{2}:\d{2} (\S+)( (\S+):)? (.*)')
+_RFC3164_HEADER = re.compile(r'\S{3}\s')
+_CISCO = re.compile(r'.*(%([A-Z0-9_-]+)):? (.*)')
+_CISCO_HEADER = re.compile(r'.*%[A-Z0-9_-]+')
+
+
 LOOP_EVERY = 20  # seconds
 
 LOG = logging.getLogger('alerta.syslog')
@@ -84,193 +248,455 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s: %(levelname)s - %(message)s', level=logging.DEBUG)
 
 
+class SyslogStream:
+    """Messages received on a TCP connection.
+
+    Messages are framed by octet-counting ("<length> <message>") or ended by
+    a newline, as described in RFC 6587, and can be split across reads. The
+    framing is detected for every message.
+    """
+
+    def __init__(self, sock, addr):
+
+        self.sock = sock
+        self.addr = addr
+        self.buffer = bytearray()
+        self.more = False  # complete messages are buffered, stop reading until they are handled
+        self.closed = False
+
+    def fileno(self):
+
+        return self.sock.fileno()
+
+    def receive(self, size=65536):
+        """Read what is available from the connection, return False when it was closed by the client."""
+
+        try:
+            data = self.sock.recv(size)
+        except OSError as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            LOG.warning('Syslog TCP connection from %s failed: %s',
+                        self.addr[0], e)
+            data = b''
+        if not data:
+            self.closed = True
+            return False
+        self.buffer.extend(data)
+        return True
+
+    def messages(self, limit=SYSLOG_TCP_BATCH):
+        """Return up to `limit` complete messages and keep the rest.
+
+        Raises ValueError if the stream can not be framed.
+        """
+
+        buf = self.buffer
+        messages = []
+        pos = 0
+        while len(messages) < limit and pos < len(buf):
+            if buf.startswith((b'\r', b'\n'), pos):
+                pos += 1
+                continue
+            if buf[pos:pos + 1].isdigit():
+                # octet-counting
+                space = buf.find(b' ', pos, pos + 11)
+                if space < 0:
+                    if len(buf) - pos > 10:
+                        raise ValueError('invalid message length %r' %
+                                         bytes(buf[pos:pos + 10]))
+                    break
+                try:
+                    length = int(bytes(buf[pos:space]))
+                except ValueError:
+                    raise ValueError('invalid message length %r' %
+                                     bytes(buf[pos:space]))
+                if length > SYSLOG_MAX_MESSAGE_SIZE:
+                    raise ValueError(
+                        'message of %d bytes is too long' % length)
+                end = space + 1 + length
+                if end > len(buf):
+                    break
+                messages.append(bytes(buf[space + 1:end]))
+            else:
+                # non-transparent framing
+                end = buf.find(b'\n', pos)
+                if end < 0:
+                    if len(buf) - pos > SYSLOG_MAX_MESSAGE_SIZE:
+                        raise ValueError(
+                            'message of more than %d bytes is too long' % SYSLOG_MAX_MESSAGE_SIZE)
+                    if self.closed:  # the last message does not need a newline
+                        end = len(buf)
+                    else:
+                        break
+                messages.append(bytes(buf[pos:end]).rstrip(b'\r'))
+                end += 1
+            pos = end
+        del buf[:pos]
+        self.more = len(messages) == limit
+        return messages
+
+    def close(self):
+
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
 class SyslogDaemon:
 
-    def __init__(self):
+    def __init__(self, outbox=None):
 
         self.api = Client()
+        # listener processes share the ports and report their counters to the parent instead of sending heartbeats
+        self.outbox = outbox
 
         LOG.info('Starting UDP listener...')
         # Set up syslog UDP listener
         try:
             self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if outbox:
+                self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if SYSLOG_UDP_RCVBUF:
+                self.udp.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_RCVBUF, SYSLOG_UDP_RCVBUF)
+            self.udp.setblocking(False)
             self.udp.bind(('', SYSLOG_UDP_PORT))
         except OSError as e:
             LOG.error('Syslog UDP error: %s', e)
             sys.exit(2)
         LOG.info('Listening on syslog port %s/udp' % SYSLOG_UDP_PORT)
+        rcvbuf = self.udp.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if rcvbuf < SYSLOG_UDP_RCVBUF:  # Linux reports double the size asked for
+            LOG.warning(
+                'UDP receive buffer is %d bytes, increase net.core.rmem_max to allow %d', rcvbuf, SYSLOG_UDP_RCVBUF)
+
+        # datagrams are read into the same buffer and decoded from there
+        self.udp_buffer = bytearray(SYSLOG_MAX_MESSAGE_SIZE)
+        self.udp_view = memoryview(self.udp_buffer)
+        self.udp_dropped = udp_drops(self.udp)
+        # messages since the last heartbeat
+        self.counters = {'udp': 0, 'tcp': 0, 'dropped': 0}
 
         LOG.info('Starting TCP listener...')
         # Set up syslog TCP listener
         try:
             self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if outbox:
+                self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.tcp.bind(('', SYSLOG_TCP_PORT))
-            self.tcp.listen(5)
+            self.tcp.listen(socket.SOMAXCONN)
         except OSError as e:
             LOG.error('Syslog TCP error: %s', e)
             sys.exit(2)
         LOG.info('Listening on syslog port %s/tcp' % SYSLOG_TCP_PORT)
 
+        self.streams = {}  # socket: SyslogStream of open TCP connections
+
         self.shuttingdown = False
 
     def run(self):
 
-        count = 0
+        heartbeat = 0
         while not self.shuttingdown:
             try:
+                # connections with messages left from their last turn are not read until they are handled
+                waiting = [stream for stream in self.streams.values()
+                           if stream.more]
+                readers = [self.udp]
+                readers.extend(stream for stream in self.streams.values()
+                               if not stream.more)
+
+                if len(self.streams) < SYSLOG_TCP_MAX_CONNECTIONS:
+                    readers.append(self.tcp)
+
                 LOG.debug('Waiting for syslog messages...')
                 ip, op, rdy = select.select(
-                    [self.udp, self.tcp], [], [], LOOP_EVERY)
-                if ip:
-                    for i in ip:
-                        if i == self.udp:
-                            data, addr = self.udp.recvfrom(4096)
-                            data = unicode(data, 'utf-8', errors='ignore')
-                            LOG.debug(
-                                'Syslog UDP data received from %s: %s', addr, data)
-                        if i == self.tcp:
-                            client, addr = self.tcp.accept()
-                            data = client.recv(4096)
-                            data = unicode(data, 'utf-8', errors='ignore')
-                            client.close()
-                            LOG.debug(
-                                'Syslog TCP data received from %s: %s', addr, data)
-
-                        alerts = self.parse_syslog(ip=addr[0], data=data)
-                        for alert in alerts:
-                            try:
-                                self.api.send_alert(**alert)
-                            except Exception as e:
-                                LOG.warning('Failed to send alert: %s', e)
-
-                    count += 1
-                if not ip or count % 5 == 0:
-                    LOG.debug('Send heartbeat...')
-                    try:
-                        origin = '{}/{}'.format('syslog', platform.uname()[1])
-                        self.api.heartbeat(origin, tags=[__version__])
-                    except Exception as e:
-                        LOG.warning('Failed to send heartbeat: %s', e)
+                    readers, [], [], 0 if waiting else LOOP_EVERY)
+                for i in ip:
+                    if i == self.udp:
+                        self.receive_udp()
+                    elif i == self.tcp:
+                        self.accept()
+                    else:
+                        i.receive()
+                        waiting.append(i)
+
+                for stream in waiting:
+                    self.read_stream(stream)
+
+                if time.time() - heartbeat >= LOOP_EVERY:
+                    self.count_drops()
+                    if self.outbox:
+                        self.outbox.put((os.getpid(), self.counters))
+                    else:
+                        log_counters(self.counters, time.time() - heartbeat)
+                        send_heartbeat(self.api)
+                    self.counters = dict.fromkeys(self.counters, 0)
+                    heartbeat = time.time()
 
             except (KeyboardInterrupt, SystemExit):
                 self.shuttingdown = True
 
         LOG.info('Shutdown request received...')
+        for stream in list(self.streams.values()):
+            stream.close()
+
+    def receive_udp(self):
+        """Read all datagrams waiting on the UDP socket, up to SYSLOG_UDP_BATCH."""
+
+        for _ in range(SYSLOG_UDP_BATCH):
+            try:
+                nbytes, addr = self.udp.recvfrom_into(self.udp_buffer)
+            except OSError as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    LOG.warning('Syslog UDP receive failed: %s', e)
+                break
+            self.counters['udp'] += 1
+            data = str(self.udp_view[:nbytes], 'utf-8', errors='ignore')
+            LOG.debug(
+                'Syslog UDP data received from %s: %s', addr, data)
+            self.forward(addr[0], data)
+
+    def count_drops(self):
+
+        dropped = udp_drops(self.udp)
+        if dropped is not None and self.udp_dropped is not None:
+            if dropped > self.udp_dropped:
+                LOG.warning(
+                    'Kernel dropped %d UDP messages, receive buffer is full', dropped - self.udp_dropped)
+            self.counters['dropped'] += dropped - self.udp_dropped
+        self.udp_dropped = dropped
+
+    def accept(self):
+
+        try:
+            client, addr = self.tcp.accept()
+        except OSError as e:
+            LOG.warning('Syslog TCP accept failed: %s', e)
+            return
+        client.setblocking(False)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.streams[client] = SyslogStream(client, addr)
+        LOG.debug('Syslog TCP connection from %s (%d open)',
+                  addr, len(self.streams))
+
+    def read_stream(self, stream):
+
+        try:
+            messages = stream.messages()
+        except ValueError as e:
+            LOG.warning('Closing syslog TCP connection from %s: %s',
+                        stream.addr[0], e)
+            messages = []
+            stream.closed = True
+            stream.more = False
+        self.counters['tcp'] += len(messages)
+        for data in messages:
+            data = data.decode('utf-8', errors='ignore')
+            LOG.debug(
+                'Syslog TCP data received from %s: %s', stream.addr, data)
+            self.forward(stream.addr[0], data)
+        if stream.closed and not stream.more:
+            del self.streams[stream.sock]
+            stream.close()
+            LOG.debug('Syslog TCP connection from %s closed (%d open)',
+                      stream.addr, len(self.streams))
+
+    def forward(self, ip, data):
+
+        alerts = self.parse_syslog(ip=ip, data=data)
+        for alert in alerts:
+            try:
+                self.api.send_alert(**alert)
+            except Exception as e:
+                LOG.warning('Failed to send alert: %s', e)
 
     def parse_syslog(self, ip, data):
 
         LOG.debug('Parsing syslog message...')
         syslogAlerts = list()
 
-        event = None
-        resource = None
-
         for msg in data.split('\n'):
             if not msg or 'last message repeated' in msg:
                 continue
+            syslogAlert = parse_message(ip, msg)
+            if syslogAlert:
+                syslogAlerts.append(syslogAlert)
 
-            if re.match(r'<\d+>1', msg):
-                # Parse RFC 5424 compliant message
-                m = re.match(
-                    r'<(\d+)>1 (\S+) (\S+) (\S+) (\S+) (\S+) (.*)', msg)
-                if m:
-                    PRI = int(m.group(1))
-                    # ISOTIMESTAMP = m.group(2)
-                    HOSTNAME = m.group(3)
-                    APPNAME = m.group(4)
-                    PROCID = m.group(5)
-                    MSGID = m.group(6)
-                    TAG = '{}[{}] {}'.format(APPNAME, PROCID, MSGID)
-                    MSG = m.group(7)
-                    LOG.info('Parsed RFC 5424 message OK')
-                else:
-                    LOG.error(
-                        'Could not parse RFC 5424 syslog message: %s', msg)
-                    continue
+        return syslogAlerts
 
-            elif re.match(r'<(\d{1,3})>\S{3}\s', msg):
-                # Parse RFC 3164 compliant message
-                m = re.match(
-                    r'<(\d{1,3})>\S{3}\s{1,2}\d?\d \d{2}:\d{2}:\d{2} (\S+)( (\S+):)? (.*)', msg)
-                if m:
-                    PRI = int(m.group(1))
-                    HOSTNAME = m.group(2)
-                    TAG = m.group(4)
-                    MSG = m.group(5)
-                    LOG.info('Parsed RFC 3164 message OK')
-                else:
-                    LOG.error(
-                        'Could not parse RFC 3164 syslog message: %s', msg)
-                    continue
 
-            elif re.match(r'<\d+>.*%[A-Z0-9_-]+', msg):
-                # Parse Cisco Syslog message
-                m = re.match(r'<(\d+)>.*(%([A-Z0-9_-]+)):? (.*)', msg)
-                if m:
-                    LOG.debug(m.groups())
-                    PRI = int(m.group(1))
-                    CISCO_SYSLOG = m.group(2)
+def parse_message(ip, msg):
+    """Parse one RFC 5424, RFC 3164 or Cisco syslog message and return an alert, or None."""
+
+    h = _PRI.match(msg)
+    if not h:
+        LOG.error('Could not parse syslog message: %s', msg)
+        return
+    PRI = int(h.group(1))
+    if PRI >= len(SYSLOG_PRIORITIES):
+        LOG.error('Invalid syslog priority %s: %s', PRI, msg)
+        return
+    pos = h.end()
+    event = resource = None
+
+    # dispatch on the bytes after the header, a full match implies the header matched
+    if msg.startswith('1', pos):
+        # Parse RFC 5424 compliant message
+        m = _RFC5424.match(msg, pos)
+        if not m:
+            LOG.error('Could not parse RFC 5424 syslog message: %s', msg)
+            return
+        # ISOTIMESTAMP = m.group(1)
+        HOSTNAME, APPNAME, PROCID, MSGID, MSG = m.group(2, 3, 4, 5, 6)
+        TAG = '{}[{}] {}'.format(APPNAME, PROCID, MSGID)
+        LOG.info('Parsed RFC 5424 message OK')
+
+    elif pos <= 5 and _RFC3164_HEADER.match(msg, pos):
+        # Parse RFC 3164 compliant message
+        m = _RFC3164.match(msg, pos)
+        if not m:
+            LOG.error('Could not parse RFC 3164 syslog message: %s', msg)
+            return
+        HOSTNAME, _, TAG, MSG = m.groups()
+        LOG.info('Parsed RFC 3164 message OK')
+
+    elif '%' in msg and _CISCO_HEADER.match(msg, pos):
+        # Parse Cisco Syslog message
+        m = _CISCO.match(msg, pos)
+        if not m:
+            LOG.error('Could not parse Cisco syslog message: %s', msg)
+            return
+        LOG.debug(m.groups())
+        CISCO_SYSLOG, CISCO_NAME, MSG = m.groups()
+        try:
+            CISCO_FACILITY, CISCO_MNEMONIC = CISCO_NAME.split('-')
+        except ValueError as e:
+            LOG.error('Could not parse Cisco syslog - %s: %s', e, CISCO_NAME)
+            CISCO_FACILITY = CISCO_MNEMONIC = 'na'
+
+        TAG = CISCO_MNEMONIC
+        event = CISCO_SYSLOG
+
+        # replace IP address with a hostname, if known
+        resource = _RESOLVER.name(ip) + ':' + CISCO_FACILITY
+
+    else:
+        LOG.error('Could not parse syslog message: %s', msg)
+        return
+
+    facility, level, default_event, severity, tags, correlate = SYSLOG_PRIORITIES[PRI]
+
+    return {
+        'resource': resource or (HOSTNAME + ':' + TAG if TAG else HOSTNAME),
+        'event': event or default_event,
+        'environment': 'Production',
+        'severity': severity,
+        'correlate': correlate,
+        'service': ['Platform'],
+        'group': 'Syslog',
+        'value': level,
+        'text': MSG,
+        'tags': tags,
+        'event_type': 'syslogAlert',
+        'raw_data': msg
+    }
+
+
+class SyslogListeners:
+    """Run a SyslogDaemon in each of `processes` child processes.
+
+    All children listen on the same ports using SO_REUSEPORT, and the
+    kernel spreads connections and datagrams between them. The parent
+    restarts children that exit, adds up their counters and sends the one
+    heartbeat for this host, only while every child is running and
+    reporting its counters.
+    """
+
+    def __init__(self, processes=SYSLOG_PROCESSES):
+
+        self.api = Client()
+        self.processes = [None] * processes
+        self.outbox = multiprocessing.Queue()
+        self.reported = {}  # pid: when each child last reported its counters
+
+        self.shuttingdown = False
+
+    def _spawn(self, index):
+
+        process = multiprocessing.Process(
+            target=_listener_process, args=(self.outbox,), name='syslog-listener-%d' % index)
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+        self.reported[process.pid] = time.time()
+        LOG.info('Started listener process: %s (pid %s)',
+                 process.name, process.pid)
+
+    def run(self):
+
+        # shut down the children rather than leave them running, they inherit this too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for index in range(len(self.processes)):
+            self._spawn(index)
+
+        started = time.time()
+        while not self.shuttingdown:
+            try:
+                time.sleep(max(started + LOOP_EVERY - time.time(), 0))
+                counters = Counter(udp=0, tcp=0, dropped=0)
+                while True:
                     try:
-                        CISCO_FACILITY, CISCO_MNEMONIC = m.group(
-                            3).split('-')
-                    except ValueError as e:
+                        pid, reported = self.outbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    counters.update(reported)
+                    self.reported[pid] = time.time()
+                log_counters(counters, time.time() - started)
+                started = time.time()
+
+                healthy = True
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
                         LOG.error(
-                            'Could not parse Cisco syslog - %s: %s', e, m.group(3))
-                        CISCO_FACILITY = CISCO_MNEMONIC = 'na'
+                            'Listener process %s exited with code %s, restarting...', process.name, process.exitcode)
+                        del self.reported[process.pid]
+                        self._spawn(index)
+                        healthy = False
+                    # children report about every LOOP_EVERY seconds, allow for one late report
+                    elif started - self.reported[process.pid] > 2 * LOOP_EVERY:
+                        LOG.warning('Listener process %s has not reported for %ds',
+                                    process.name, started - self.reported[process.pid])
+                        healthy = False
+
+                if healthy:
+                    send_heartbeat(self.api)
+                else:
+                    LOG.warning(
+                        'Not sending heartbeat until all listener processes are running')
 
-                    TAG = CISCO_MNEMONIC
-                    MSG = m.group(4)
+            except (KeyboardInterrupt, SystemExit):
+                self.shuttingdown = True
 
-                    event = CISCO_SYSLOG
+        LOG.info('Shutdown request received...')
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
 
-                    # replace IP address with a hostname, if necessary
-                    try:
-                        socket.inet_aton(ip)
-                        (resource, _, _) = socket.gethostbyaddr(ip)
-                    except (OSError, socket.herror):
-                        resource = ip
 
-                    resource = '{}:{}'.format(resource, CISCO_FACILITY)
-                else:
-                    LOG.error('Could not parse Cisco syslog message: %s', msg)
-                    continue
+def _listener_process(outbox):
+    """Receive syslog messages in a child process of SyslogListeners."""
 
-            facility, level = decode_priority(PRI)
-
-            # Defaults
-            event = event or '{}{}'.format(
-                facility.capitalize(), level.capitalize())
-            resource = resource or '{}{}'.format(
-                HOSTNAME, ':' + TAG if TAG else '')
-            severity = priority_to_code(level)
-            group = 'Syslog'
-            value = level
-            text = MSG
-            environment = 'Production'
-            service = ['Platform']
-            tags = ['{}.{}'.format(facility, level)]
-            correlate = ['{}{}'.format(facility.capitalize(), s.capitalize())
-                         for s in SYSLOG_SEVERITY_NAMES]
-            raw_data = msg
-
-            syslogAlert = {
-                'resource': resource,
-                'event': event,
-                'environment': environment,
-                'severity': severity,
-                'correlate': correlate,
-                'service': service,
-                'group': group,
-                'value': value,
-                'text': text,
-                'tags': tags,
-                'event_type': 'syslogAlert',
-                'raw_data': raw_data
-            }
-            syslogAlerts.append(syslogAlert)
+    # the parent shuts the children down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        return syslogAlerts
+    SyslogDaemon(outbox).run()
 
 
 def main():
@@ -278,7 +704,14 @@ def main():
     LOG = logging.getLogger('alerta.syslog')
 
     try:
-        SyslogDaemon().run()
+        processes = SYSLOG_PROCESSES
+        if processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            LOG.error('SO_REUSEPORT is not supported, running a single listener')
+            processes = 1
+        if processes > 1:
+            SyslogListeners(processes).run()
+        else:
+            SyslogDaemon().run()
     except (SystemExit, KeyboardInterrupt):
         LOG.info('Exiting alerta syslog.')
         sys.exit(0)
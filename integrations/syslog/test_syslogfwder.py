@@ -0,0 +1,115 @@
+'''
+Unit tests for framing syslog messages received over TCP
+'''
+import socket
+
+import pytest
+import syslogfwder
+
+MESSAGE = b'<13>Feb  5 17:32:18 10.0.0.99 myapp: Use the BFG!'
+OTHER = b'<34>1 2003-10-11T22:14:15.003Z mymachine su - ID47 - failed'
+
+
+@pytest.fixture
+def connection():
+    client, server = socket.socketpair()
+    stream = syslogfwder.SyslogStream(server, ('192.0.2.1', 514))
+    yield client, stream
+    client.close()
+    stream.close()
+
+
+def octets(msg):
+    return b'%d %s' % (len(msg), msg)
+
+
+def test_octet_counting_split(connection):
+    '''
+    Test octet-counted messages split across reads are only returned once complete
+    '''
+    client, stream = connection
+    data = octets(MESSAGE) + octets(OTHER)
+    end = len(octets(MESSAGE))
+
+    # in the length, after the length and in the message
+    for chunk in (data[:1], data[1:3], data[3:30], data[30:end - 1]):
+        client.sendall(chunk)
+        assert stream.receive()
+        assert stream.messages() == []
+    client.sendall(data[end - 1:end + 1])
+    assert stream.receive()
+    assert stream.messages() == [MESSAGE]
+
+    client.sendall(data[end + 1:])
+    assert stream.receive()
+    assert stream.messages() == [OTHER]
+    assert stream.buffer == b''
+
+
+def test_octet_counting_newline_in_message(connection):
+    '''
+    Test octet-counted messages may contain newlines
+    '''
+    client, stream = connection
+    client.sendall(octets(MESSAGE + b'\nsecond line') + octets(OTHER))
+    assert stream.receive()
+    assert stream.messages() == [MESSAGE + b'\nsecond line', OTHER]
+
+
+def test_lf_framing(connection):
+    '''
+    Test messages ended by a newline, a carriage return and newline or split across reads
+    '''
+    client, stream = connection
+    client.sendall(MESSAGE + b'\r\n\n' + OTHER[:20])
+    assert stream.receive()
+    assert stream.messages() == [MESSAGE]
+
+    client.sendall(OTHER[20:] + b'\n' + octets(MESSAGE))
+    assert stream.receive()
+    assert stream.messages() == [OTHER, MESSAGE]
+
+
+def test_close_without_newline(connection):
+    '''
+    Test the last message does not need a newline once the connection is closed
+    '''
+    client, stream = connection
+    client.sendall(MESSAGE + b'\n' + OTHER)
+    assert stream.receive()
+    assert stream.messages() == [MESSAGE]
+    assert stream.messages() == []
+
+    client.close()
+    assert not stream.receive()
+    assert stream.closed
+    assert stream.messages() == [OTHER]
+
+
+def test_messages_limit(connection):
+    '''
+    Test no more than `limit` messages are returned at a time
+    '''
+    client, stream = connection
+    client.sendall(b''.join(octets(MESSAGE) for _ in range(5)))
+    assert stream.receive()
+    assert stream.messages(limit=3) == [MESSAGE] * 3
+    assert stream.more
+    assert stream.messages(limit=3) == [MESSAGE] * 2
+    assert not stream.more
+
+
+@pytest.mark.parametrize('data', [
+    b'12345678901 <13>message',
+    b'12x <13>message',
+    b'%d ' % (syslogfwder.SYSLOG_MAX_MESSAGE_SIZE + 1),
+])
+def test_invalid_framing(connection, data):
+    '''
+    Test streams that can not be framed are rejected
+    '''
+    client, stream = connection
+    client.sendall(data)
+    assert stream.receive()
+    with pytest.raises(ValueError):
+        stream.messages()
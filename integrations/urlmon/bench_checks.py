@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the cost of evaluating one check result.
+
+Compares feeding the response body through a BodyReader, which runs the
+compiled search as the body is read, then check_status() on compiled checks
+against the per-cycle evaluation that WorkerThread.run() used to do on the
+raw settings.checks dictionaries (dict lookups, uncompiled re.search() per
+body line and eval() of the rule twice).
+
+Both sides start from a response that has been received: the CheckResult
+is made by the request, as the legacy (status, reason, body, rtt) tuple
+was, so it is not timed.
+
+    $ python bench_checks.py [iterations]
+"""
+import json
+import logging
+import re
+import sys
+import timeit
+
+import urlmon
+
+DEFINITIONS = [
+    {
+        'resource': 'status-only',
+        'url': 'http://example.com/',
+        'environment': 'Production',
+        'service': ['Web'],
+    },
+    {
+        'resource': 'status-regex',
+        'url': 'http://example.com/',
+        'environment': 'Production',
+        'service': ['Web'],
+        'status_regex': '2[0-9][0-9]',
+    },
+    {
+        'resource': 'search',
+        'url': 'http://example.com/',
+        'environment': 'Production',
+        'service': ['Web'],
+        'search': 'id="footer-[0-9]+"',
+    },
+    {
+        'resource': 'rule',
+        'url': 'http://example.com/health',
+        'environment': 'Production',
+        'service': ['Web'],
+        'headers': {'Content-type': 'application/json'},
+        'rule': "body['status'] == 'ok' and body['nodes'] >= 3",
+    },
+]
+
+LINES = ['<p>line %d of some html page</p>' % i for i in range(500)]
+HTML = '\n'.join(LINES + ['<div id="footer-1">'])
+JSON = json.dumps({'status': 'ok', 'nodes': 5})
+
+
+def legacy_check_status(check, status, reason, body, rtt):
+    # evaluation as done by WorkerThread.run() before checks were compiled
+
+    status_regex = check.get('status_regex', None)
+    search_string = check.get('search', None)
+    rule = check.get('rule', None)
+    warn_thold = check.get('warning', urlmon.SLOW_WARNING_THRESHOLD)
+    crit_thold = check.get('critical', urlmon.SLOW_CRITICAL_THRESHOLD)
+    check.get('api_endpoint', None)
+    check.get('api_key', None)
+    check.get('check_ssl')
+
+    description = urlmon.HTTP_RESPONSES[status]
+    if status_regex:
+        if re.search(status_regex, str(status)):
+            event = 'HttpResponseRegexOK'
+        else:
+            event = 'HttpResponseRegexError'
+    else:
+        event = 'HttpResponseOK'
+    severity = 'normal'
+    value = '%s (%d)' % (description, status)
+    text = 'HTTP server responded with status code %d in %dms' % (status, rtt)
+
+    if rtt > crit_thold or rtt > warn_thold:
+        event = 'HttpResponseSlow'
+    if search_string and body:
+        found = False
+        for line in body.split('\n'):
+            if re.search(search_string, line):
+                found = True
+                break
+        if not found:
+            event = 'HttpContentError'
+    elif rule and body:
+        headers = check.get('headers', {})
+        if 'Content-type' in headers and headers['Content-type'] == 'application/json':
+            body = json.loads(body)
+        try:
+            eval(rule)
+        except Exception:
+            pass
+        else:
+            if not eval(rule):
+                event = 'HttpContentError'
+
+    '%s : RT > %d RT > %d x %s' % (
+        check['url'], warn_thold, crit_thold, check.get('count', 1))
+    return event, severity, value, text
+
+
+def compiled_check_status(check, result, body):
+    # the body is searched as it is read, then the result is evaluated
+
+    reader = urlmon.BodyReader.for_check(check)
+    if reader.wants_body:
+        for i in range(0, len(body), urlmon.BODY_CHUNK):
+            if reader.feed(body[i:i + urlmon.BODY_CHUNK]):
+                break
+    reader.close(result)
+    return urlmon.check_status(check, result)
+
+
+def main():
+
+    logging.disable(logging.CRITICAL)
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print('%-14s %12s %12s %8s' %
+          ('check', 'legacy (us)', 'compiled (us)', 'speedup'))
+    for definition in DEFINITIONS:
+        body = JSON if 'rule' in definition else HTML
+        check = urlmon.Check(definition)
+        # responses are read as bytes, the legacy code decoded them first
+        data = body.encode('utf-8')
+        result = urlmon.CheckResult(status=200, rtt=120,
+                                    headers={'content-type': 'text/html'})
+        event = legacy_check_status(definition, 200, None, body, 120)[0]
+        assert compiled_check_status(check, result, data)[0] == event, event
+
+        legacy = min(timeit.repeat(
+            lambda: legacy_check_status(definition, 200, None, body, 120), number=number, repeat=3)) / number
+        compiled = min(timeit.repeat(
+            lambda: compiled_check_status(check, result, data), number=number, repeat=3)) / number
+        print('%-14s %12.2f %12.2f %7.1fx' %
+              (definition['resource'], legacy * 1e6, compiled * 1e6, legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Load benchmark of a complete urlmon daemon against a local server farm.
+
+Starts HTTP, HTTPS and slow-handshake HTTPS servers on 127.0.0.1 in a
+separate process, generates `settings.checks` pointing at them with a mix
+of injected latency, errors, connection resets and large bodies, then runs
+UrlmonDaemon for a while with alerts recorded instead of sent. No network
+access or Alerta server is needed; HTTPS needs the openssl command to make
+a throwaway certificate.
+
+Reports checks/sec, scheduling lag (request start after the check fell
+due), p50/p99 response time and its error against the injected latency
+per profile, and resident memory of the daemon.
+
+    $ python bench_load.py [--checks 1000] [--interval 10] [--duration 30]
+                           [--engine threads|asyncio] [--processes 1]
+                           [--servers 8] [--mix fast=40,slow=15,...]
+"""
+import argparse
+import bisect
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import settings
+import urlmon
+
+SLOW_LATENCY = 250  # ms
+TLS_DELAY = 200  # ms, handshake delay of slow-tls servers
+LARGE_BODY = 2 * 1024 * 1024
+
+# name: (server kind, query, extra check settings)
+PROFILES = collections.OrderedDict([
+    ('fast', ('http', {}, {})),
+    ('slow', ('http', {'latency': SLOW_LATENCY}, {})),
+    ('error', ('http', {'status': 503}, {})),
+    ('reset', ('http', {'reset': 1}, {})),
+    ('large', ('http', {'size': LARGE_BODY}, {'search': 'id="footer"'})),
+    ('tls', ('https', {}, {'check_ssl': True})),
+    ('slow-tls', ('slow-tls', {}, {'check_ssl': True})),
+])
+DEFAULT_MIX = 'fast=40,slow=15,error=10,reset=5,large=5,tls=20,slow-tls=5'
+
+BLOCK = (b'<p>' + b'x' * 1017 + b'</p>\n') * 64
+FOOTER = b'<div id="footer"></div>\n'
+
+# multiprocessing.Queue of (time, resource, event, responseTime)
+RESULTS = None
+
+
+class FarmHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        params = parse_qs(urlsplit(self.path).query)
+        query = {k: int(v[0]) for k, v in params.items()}
+
+        if query.get('latency'):
+            time.sleep(query['latency'] / 1000)
+        if query.get('reset'):
+            self.close_connection = True
+            return
+
+        size = query.get('size', 0)
+        blocks = size // len(BLOCK)
+        self.send_response(query.get('status', 200))
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length',
+                         str(blocks * len(BLOCK) + len(FOOTER)))
+        if self.server.close_connections:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        for _ in range(blocks):
+            self.wfile.write(BLOCK)
+        self.wfile.write(FOOTER)
+
+
+class FarmServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+    close_connections = False
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping kept-alive connections
+
+
+class TLSFarmServer(FarmServer):
+    """HTTPS server that waits `delay` seconds before each handshake.
+
+    Slow servers close the connection after every response so that each
+    check pays for the handshake.
+    """
+
+    def __init__(self, address, handler, context, delay=0):
+
+        self.context = context
+        self.delay = delay
+        self.close_connections = delay > 0
+        FarmServer.__init__(self, address, handler)
+
+    def get_request(self):
+
+        sock, address = FarmServer.get_request(self)
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def finish_request(self, request, client_address):
+
+        time.sleep(self.delay)
+        try:
+            request.do_handshake()
+        except (ssl.SSLError, OSError):
+            return
+        FarmServer.finish_request(self, request, client_address)
+
+
+def serve_farm(servers, certs, conn):
+    """Run the server farm and send back the ports of each kind of server."""
+
+    farm = collections.defaultdict(list)
+    for _ in range(servers):
+        farm['http'].append(FarmServer(('127.0.0.1', 0), FarmHandler))
+        if certs:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certs)
+            farm['https'].append(
+                TLSFarmServer(('127.0.0.1', 0), FarmHandler, context))
+            farm['slow-tls'].append(
+                TLSFarmServer(('127.0.0.1', 0), FarmHandler, context,
+                              TLS_DELAY / 1000))
+
+    for server in sum(farm.values(), []):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports = {kind: [server.server_address[1] for server in group]
+             for kind, group in farm.items()}
+    conn.send(ports)
+    threading.Event().wait()
+
+
+def make_certificate(directory):
+
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+             '-keyout', keyfile, '-out', certfile, '-days', '1', '-subj', '/CN=127.0.0.1',
+             '-addext', 'subjectAltName=IP:127.0.0.1'],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile, keyfile
+
+
+def make_checks(number, interval, mix, ports):
+
+    weights = [(name, weight)
+               for name, weight in mix if PROFILES[name][0] in ports]
+    total = sum(weight for _, weight in weights)
+    checks = []
+    expected = {}
+    for name, weight in weights:
+        kind, query, extra = PROFILES[name]
+        scheme = 'http' if kind == 'http' else 'https'
+        for i in range(round(number * weight / total)):
+            resource_name = 'bench-%s-%05d' % (name, i)
+            port = ports[kind][i % len(ports[kind])]
+            definition = {
+                'resource': resource_name,
+                'url': '%s://127.0.0.1:%d/%s?%s' % (scheme, port, name, urlencode(query)),
+                'environment': 'Bench',
+                'service': ['Bench'],
+                'interval': interval,
+            }
+            definition.update(extra)
+            checks.append(definition)
+            latency = query.get('latency', 0)
+            if kind == 'slow-tls':
+                latency += TLS_DELAY
+            expected[resource_name] = (name, latency)
+    return checks, expected
+
+
+class RecordingClient:
+    """Stand-in for alertaclient.api.Client that queues check results."""
+
+    def __init__(self, endpoint=None, key=None, **kwargs):
+        pass
+
+    def heartbeat(self, origin, **kwargs):
+        pass
+
+    def send_alert(self, resource, event, **kwargs):
+
+        rtt = kwargs.get('attributes', {}).get('responseTime')
+        RESULTS.put((time.time(), resource, event, rtt))
+
+
+class RecordingScheduler(urlmon.CheckScheduler):
+    """CheckScheduler that records when each check fell due."""
+
+    due_times = collections.defaultdict(list)
+
+    def due(self, now):
+
+        for deadline, check in super().due(now):
+            self.due_times[check.resource].append(
+                deadline - self.interval(check))
+            yield deadline, check
+
+
+def rss(pid='self'):
+    """Resident set size in bytes, from /proc or the peak if that is not available."""
+
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if pid == 'self' else 0
+
+
+def percentile(values, p):
+
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def collect(results, done):
+
+    while not done.is_set() or not RESULTS.empty():
+        try:
+            results.append(RESULTS.get(timeout=0.2))
+        except queue.Empty:
+            pass
+
+
+def main():
+
+    global RESULTS
+
+    parser = argparse.ArgumentParser(
+        description='Run urlmon against a local server farm.')
+    parser.add_argument('--checks', type=int, default=1000,
+                        help='number of checks (default: 1000)')
+    parser.add_argument('--interval', type=int, default=10,
+                        help='check interval in seconds (default: 10)')
+    parser.add_argument('--duration', type=int, default=30,
+                        help='seconds to run for (default: 30)')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'),
+                        default='threads')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes (default: 1)')
+    parser.add_argument('--servers', type=int, default=8,
+                        help='servers, ie. origins, of each kind (default: 8)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='profile weights (default: %s)' % DEFAULT_MIX)
+    parser.add_argument('--verbose', action='store_true',
+                        help='show urlmon warnings')
+    args = parser.parse_args()
+
+    items = (item.split('=') for item in args.mix.split(','))
+    mix = [(name, int(weight)) for name, weight in items]
+    for name, _ in mix:
+        if name not in PROFILES:
+            parser.error('unknown profile %s, expected one of %s' %
+                         (name, ', '.join(PROFILES)))
+
+    if args.verbose:
+        logging.basicConfig(level=logging.WARNING)
+    else:
+        logging.disable(logging.CRITICAL)
+
+    tempdir = tempfile.mkdtemp(prefix='bench-urlmon-')
+    certs = make_certificate(tempdir)
+    if not certs:
+        print('openssl not available, running without HTTPS checks')
+
+    parent, child = multiprocessing.Pipe()
+    farm = multiprocessing.Process(target=serve_farm,
+                                   args=(args.servers, certs, child),
+                                   daemon=True)
+    farm.start()
+    ports = parent.recv()
+
+    settings.checks, expected = make_checks(
+        args.checks, args.interval, mix, ports)
+    if certs:
+        urlmon._SSL_CONTEXT.load_verify_locations(certs[0])
+    urlmon.ENGINE = args.engine
+    urlmon.PROCESSES = args.processes
+    urlmon.CHECKS_FILE = None
+    urlmon.RELOAD_EVERY = 0
+    urlmon.ALERT_REFRESH = 0
+    urlmon.SHARDS = None
+    urlmon.Client = RecordingClient
+    urlmon.CheckScheduler = RecordingScheduler
+    RESULTS = multiprocessing.Queue()
+
+    results = []
+    done = threading.Event()
+    collector = threading.Thread(
+        target=collect, args=(results, done), daemon=True)
+    collector.start()
+
+    daemon = urlmon.UrlmonDaemon()
+    memory = {'before': rss()}
+
+    def stop():
+        pids = [p.pid for p in multiprocessing.active_children()
+                if p.pid != farm.pid]
+        memory['after'] = rss() + sum(rss(pid) for pid in pids)
+        daemon.shuttingdown = True
+
+    print('urlmon load benchmark: %d checks every %ds for %ds, engine %s, %d process(es), %d server(s) of %s' % (
+        len(settings.checks), args.interval, args.duration, args.engine, args.processes, args.servers,
+        ', '.join(sorted(ports))))
+    started = time.time()
+    timer = threading.Timer(args.duration, stop)
+    timer.daemon = True
+    timer.start()
+    daemon.run()
+    stopped = started + args.duration
+
+    done.set()
+    collector.join()
+    farm.terminate()
+    shutil.rmtree(tempdir)
+
+    runs = [(completed, resource_name, event, rtt)
+            for completed, resource_name, event, rtt in results
+            if completed <= stopped and resource_name in expected
+            if event != 'HttpSSLChecker']
+    lags = []
+    by_profile = collections.defaultdict(list)
+    for completed, resource_name, event, rtt in runs:
+        start = completed - (rtt or 0) / 1000
+        due_times = RecordingScheduler.due_times[resource_name]
+        i = bisect.bisect_right(due_times, start + 0.001) - 1
+        if i >= 0:
+            lags.append(max(start - due_times[i], 0) * 1000)
+        name, latency = expected[resource_name]
+        by_profile[name].append((event, rtt, latency))
+
+    rate = len(runs) / args.duration
+    scheduled = len(settings.checks) / args.interval
+    print('{:<14} {:10.1f} (scheduled {:.1f})'.format(
+        'checks/sec', rate, scheduled))
+    print('{:<14} p50 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        'lag (ms)', percentile(lags, 50), percentile(lags, 99),
+        max(lags or [float('nan')])))
+    growth = memory['after'] - memory['before']
+    print('{:<14} {:.1f} MiB (+{:.1f} MiB, {:.1f} KiB per check)'.format(
+        'memory', memory['after'] / 2 ** 20, growth / 2 ** 20,
+        growth / 1024 / max(len(settings.checks), 1)))
+    print()
+    print('{:<10} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}'.format(
+        'profile', 'runs', 'failed', 'p50 (ms)', 'p99 (ms)', 'p50 err',
+        'p99 err'))
+    for name in PROFILES:
+        if name not in by_profile:
+            continue
+        answered = [(rtt, latency) for _, rtt, latency in by_profile[name]
+                    if rtt is not None]
+        rtts = [rtt for rtt, _ in answered]
+        errors = [rtt - latency for rtt, latency in answered]
+        failed = len(by_profile[name]) - len(answered)
+
+        print('%-10s %6d %6d %10.1f %10.1f %10.1f %10.1f' % (
+            name, len(by_profile[name]), failed,
+            percentile(rtts, 50), percentile(rtts, 99),
+            percentile(errors, 50), percentile(errors, 99)))
+
+
+if __name__ == '__main__':
+    main()
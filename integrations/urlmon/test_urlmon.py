@@ -0,0 +1,618 @@
+'''
+Unit tests for urlmon checks
+'''
+import asyncio
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import urlmon
+
+
+def make_check(resource, **definition):
+    definition.setdefault('url', 'http://%s/' % resource)
+    definition.update({
+        'resource': resource,
+        'environment': 'Production',
+        'service': ['Web'],
+    })
+    return urlmon.Check(definition)
+
+
+@pytest.mark.parametrize('interval', [0, -60, 'often', None, True, float('inf'), float('nan')])
+def test_check_interval_rejected(interval):
+    '''
+    Test checks without a positive interval are rejected
+    '''
+    with pytest.raises(ValueError):
+        make_check('www.example.com', interval=interval)
+
+
+@pytest.mark.parametrize('rule, expected', [
+    ("body['status'] == 'ok'", True),
+    ("body['status'] != 'ok'", False),
+    ("status == 200 and len(body['nodes']) >= 3", True),
+    ('status in [200, 204]', True),
+    ('200 <= status < 300', True),
+    ("400 <= status < 500 or not body['nodes']", False),
+    ("headers['Content-Type'] == 'application/json'", True),
+    ("int(body['count']) * 2 - 1 == 9", True),
+    ("body['nodes'][-1] == 'c'", True),
+    ("'missing' not in body", True),
+    ("body['ratio'] is None", True),
+])
+def test_compile_rule(rule, expected):
+    '''
+    Test rules are evaluated against the status, headers and body of a response
+    '''
+    result = (200, {'Content-Type': 'application/json'},
+              {'status': 'ok', 'nodes': ['a', 'b', 'c'], 'count': '5', 'ratio': None})
+    assert bool(urlmon.compile_rule(rule)(result)) is expected
+
+
+@pytest.mark.parametrize('rule', [
+    'body.__class__',
+    "body['status'].upper() == 'OK'",
+    "__import__('os').system('true')",
+    "open('/etc/passwd')",
+    'len(body, key=None)',
+    '[x for x in body]',
+    'lambda: 1',
+    "body['nodes'][1:]",
+    'request == 1',
+    'status ** 2',
+    'status ==',
+])
+def test_compile_rule_rejected(rule):
+    '''
+    Test rules using attribute access, calls or other expressions are rejected
+    '''
+    with pytest.raises(ValueError):
+        urlmon.compile_rule(rule)
+
+
+def test_scheduler_update():
+    '''
+    Test unchanged checks are kept while new and removed checks are reported
+    '''
+    a, b = make_check('a.example.com'), make_check('b.example.com')
+    scheduler = urlmon.CheckScheduler([a, b])
+    assert len(scheduler) == 2
+
+    a2 = make_check('a.example.com')
+    c = make_check('c.example.com')
+    added, removed = scheduler.update([a2, c])
+    assert added == [c]
+    assert removed == [b]
+    assert sorted(check.resource for check in scheduler.checks) == [
+        'a.example.com', 'c.example.com']
+    assert a in scheduler.checks and a2 not in scheduler.checks
+
+
+def test_scheduler_due(monkeypatch):
+    '''
+    Test every check falls due once per interval and removed checks are dropped
+    '''
+    monkeypatch.setattr(urlmon.random, 'uniform', lambda a, b: b)
+    fast = make_check('fast.example.com', interval=10)
+    slow = make_check('slow.example.com', interval=60)
+    with monkeypatch.context() as m:
+        m.setattr(urlmon.time, 'time', lambda: 1000.0)
+        scheduler = urlmon.CheckScheduler([fast, slow], jitter=0)
+    start = 1000.0
+
+    assert list(scheduler.due(start + 5)) == []
+    assert list(scheduler.due(start + 10)) == [(start + 20, fast)]
+    assert list(scheduler.due(start + 15)) == []
+    assert [check for _, check in scheduler.due(start + 60)] == [fast, slow]
+
+    # fell behind, the next run is an interval from now rather than a burst
+    assert list(scheduler.due(start + 100)) == [(start + 80, fast)]
+    assert scheduler.next_due() == start + 110
+
+    scheduler.update([slow])
+    assert [check for _, check in scheduler.due(start + 300)] == [slow]
+    assert len(scheduler) == 1
+
+
+def test_shard_map_exactly_one():
+    '''
+    Test every check is run by exactly one shard, and shards get a fair share
+    '''
+    nodes = ['shard-%d' % n for n in range(4)]
+    shards = [urlmon.ShardMap(nodes, node) for node in nodes]
+    checks = [make_check('www-%d.example.com' % n) for n in range(1000)]
+
+    counts = [0] * len(shards)
+    for check in checks:
+        owners = [i for i, shard in enumerate(shards) if shard.owns(check)]
+        assert len(owners) == 1
+        counts[owners[0]] += 1
+    assert min(counts) > 200
+
+
+def test_shard_map_stable():
+    '''
+    Test only the checks of an added or removed shard move
+    '''
+    resources = ['www-%d.example.com' % n for n in range(1000)]
+    nodes = ['a', 'b', 'c', 'd']
+    before = urlmon.ShardMap(nodes, 'a')
+    added = urlmon.ShardMap(nodes + ['e'], 'a')
+    removed = urlmon.ShardMap(['a', 'b', 'd'], 'a')
+
+    moved = [r for r in resources if added.owner(r) != before.owner(r)]
+    assert moved and all(added.owner(r) == 'e' for r in moved)
+    moved = [r for r in resources if removed.owner(r) != before.owner(r)]
+    assert moved and all(before.owner(r) == 'c' for r in moved)
+
+
+@pytest.mark.parametrize('shards, shard, nodes, node', [
+    (3, 1, ['shard-0', 'shard-1', 'shard-2'], 'shard-1'),
+    (2, '0', ['shard-0', 'shard-1'], 'shard-0'),
+    (['eu-1', 'us-1'], 'us-1', ['eu-1', 'us-1'], 'us-1'),
+])
+def test_shard_map_from_settings(shards, shard, nodes, node):
+    '''
+    Test SHARDS can be a number of shards or a list of their names
+    '''
+    shard_map = urlmon.ShardMap.from_settings(shards, shard)
+    assert (shard_map.nodes, shard_map.node) == (nodes, node)
+
+
+@pytest.mark.parametrize('shards, shard', [(3, None), (3, 3), (['eu-1', 'us-1'], 'ap-1')])
+def test_shard_map_from_settings_rejected(shards, shard):
+    '''
+    Test a SHARD that is missing or not one of SHARDS is rejected
+    '''
+    with pytest.raises(ValueError):
+        urlmon.ShardMap.from_settings(shards, shard)
+
+
+class RecordingPool:
+    '''Keeps the checks a worker pool is told about'''
+
+    def __init__(self):
+        self.checks = []
+        self.removed = []
+
+    def update_checks(self, checks, removed):
+        self.checks = list(checks)
+        self.removed.extend(removed)
+
+
+def test_reload_checks(tmp_path):
+    '''
+    Test added, changed and removed checks reach the scheduler and workers once the checks file is rewritten
+    '''
+    path = tmp_path / 'checks.json'
+
+    def write(definitions, mtime):
+        path.write_text(json.dumps(definitions))
+        os.utime(str(path), ns=(mtime, mtime))
+
+    write([{'resource': resource, 'url': 'http://%s/' % resource,
+            'environment': 'Production', 'service': ['Web']}
+           for resource in 'abc'], 1)
+    daemon = urlmon.UrlmonDaemon()
+    daemon.source = urlmon.CheckSource(str(path))
+    daemon.shards = None
+    daemon.queue = RecordingPool()
+    scheduler = urlmon.CheckScheduler(daemon.load_checks())
+    a, b, c = scheduler.checks
+    assert not daemon.source.changed()
+
+    write([a.definition, dict(b.definition, interval=30),
+           dict(c.definition, resource='d', url='http://d/')], 2)
+    assert daemon.source.changed()
+    daemon.reload_checks(scheduler)
+    assert not daemon.source.changed()
+
+    assert [check.resource for check in scheduler.checks] == ['a', 'b', 'd']
+    assert scheduler.checks[0] is a
+    assert scheduler.checks[1].interval == 30
+    assert set(daemon.queue.removed) == {b, c}
+    assert daemon.queue.checks == scheduler.checks
+
+    # a broken file keeps the current checks
+    path.write_text('[')
+    daemon.reload_checks(scheduler)
+    assert [check.resource for check in scheduler.checks] == ['a', 'b', 'd']
+
+
+def test_body_search_single_line():
+    '''
+    Test a body without newlines is searched as it is read, across chunks, with a bounded overlap
+    '''
+    check = make_check('www.example.com', search='"status": "ok"')
+    body = urlmon.BodyReader(check)
+    chunk = b'{"padding": "' + b'x' * 4096 + b'", '
+
+    for _ in range(100):
+        assert not body.feed(chunk)
+        assert len(body.pending) <= urlmon.SEARCH_OVERLAP
+    assert not body.feed(b'"status": "o')
+    assert body.feed(b'k", "more": "' + b'x' * 4096)
+
+    result = urlmon.CheckResult()
+    body.close(result)
+    assert result.found
+
+
+def test_body_search_not_found():
+    '''
+    Test a pattern that is not in a body without newlines is reported once it is all read
+    '''
+    check = make_check('www.example.com', search='"status": "ok"')
+    body = urlmon.BodyReader(check)
+    for _ in range(10):
+        assert not body.feed(b'"status": "failed", ')
+
+    result = urlmon.CheckResult()
+    body.close(result)
+    assert result.found is False
+
+
+def test_alert_filter(monkeypatch):
+    '''
+    Test alerts are sent on a change, repeats are suppressed and resent after the refresh interval
+    '''
+    now = [1000.0]
+    monkeypatch.setattr(urlmon.time, 'time', lambda: now[0])
+    alerts = urlmon.AlertFilter(refresh=300)
+    check = make_check('www.example.com')
+    key = (check, 'http')
+
+    def send(event, severity, value):
+        if not alerts.should_send(key, event, severity, value):
+            return False
+        alerts.record(key, event, severity, value)
+        return True
+
+    assert send('HttpResponseOK', 'normal', 'OK (200)')
+    assert not send('HttpResponseOK', 'normal', 'OK (200)')
+    assert send('HttpServerError', 'major', 'Service Unavailable (503)')
+    assert send('HttpResponseSlow', 'warning', '5100ms')
+    # response times are compared by their power of two
+    assert not send('HttpResponseSlow', 'warning', '6200ms')
+    assert send('HttpResponseSlow', 'warning', '9000ms')
+
+    now[0] += 299
+    assert not send('HttpResponseSlow', 'warning', '9000ms')
+    now[0] += 1
+    assert send('HttpResponseSlow', 'warning', '9000ms')
+    assert (alerts.sent, alerts.suppressed) == (5, 3)
+
+    alerts.forget(check)
+    assert send('HttpResponseSlow', 'warning', '9000ms')
+
+
+def test_history_wrap_around():
+    '''
+    Test only the last `size` results are kept once the ring wraps around
+    '''
+    history = urlmon.CheckHistory(4)
+    for n in range(10):
+        history.record(1000 + n, 10.0 * n, True)
+
+    assert len(history) == 4
+    summary = history.summary(60, now=1010)
+    assert (summary.samples, summary.availability) == (4, 100.0)
+    assert (summary.p50, summary.p95) == (70.0, 90.0)
+    assert history.summary(5, now=1020).samples == 0
+
+
+def test_history_percentile():
+    '''
+    Test nearest-rank percentiles, availability and slope are of available results in the window
+    '''
+    assert urlmon._percentile([1, 2, 3], 50) == 2
+    assert urlmon._percentile(list(range(1, 101)), 95) == 95
+    assert urlmon._percentile(list(range(1, 101)), 0) == 1
+    assert urlmon._percentile(list(range(1, 101)), 100) == 100
+
+    history = urlmon.CheckHistory(32)
+    history.record(900, 5000.0, True)  # outside the window
+    for n in range(1, 11):
+        history.record(1000 + n, 10.0 * n, True)
+        history.record(1000 + n, 9999.0, False)
+
+    summary = history.summary(60, percentile=90, now=1011)
+    assert (summary.samples, summary.availability) == (20, 50.0)
+    assert (summary.p50, summary.p95, summary.percentile) == (50.0, 100.0, 90.0)
+    assert summary.slope == 600.0  # 10ms a second
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''A time.time() that moves on a second each call'''
+
+    now = iter(range(1000, 2000))
+    monkeypatch.setattr(urlmon.time, 'time', lambda: float(next(now)))
+
+
+def record(store, check, count):
+    result = urlmon.CheckResult(status=200, rtt=100)
+    for _ in range(count):
+        summary = store.record(check, result)
+    return summary
+
+
+def test_history_store_reopen(tmp_path, clock):
+    '''
+    Test an unchanged check picks up its history after a restart
+    '''
+    a, b = make_check('a.example.com'), make_check('b.example.com')
+    store = urlmon.HistoryStore(size=8, directory=str(tmp_path))
+    record(store, a, 3)
+    record(store, b, 10)
+    store.close()
+
+    store = urlmon.HistoryStore(size=8, directory=str(tmp_path))
+    assert record(store, make_check('a.example.com'), 1).samples == 4
+    assert record(store, make_check('b.example.com'), 1).samples == 8
+    store.close()
+
+
+def test_history_store_resized(tmp_path, clock):
+    '''
+    Test histories start again when the history size or the window of a check changes
+    '''
+    check = make_check('a.example.com')
+    store = urlmon.HistoryStore(size=8, directory=str(tmp_path))
+    record(store, check, 3)
+    store.close()
+
+    store = urlmon.HistoryStore(size=16, directory=str(tmp_path))
+    assert record(store, check, 1).samples == 1
+    windowed = make_check('a.example.com', window=60)
+    assert record(store, windowed, 1).samples == 1
+    assert record(store, check, 1).samples == 2
+    store.close()
+
+
+def test_history_store_forget(tmp_path, clock):
+    '''
+    Test the slot of a removed check is reused, cleared, by the next new check
+    '''
+    a, b = make_check('a.example.com'), make_check('b.example.com')
+    store = urlmon.HistoryStore(size=8, directory=str(tmp_path))
+    record(store, a, 3)
+    slot = store._slots[store.key(a)]
+
+    store.forget(a)
+    assert store.key(a) not in store._slots
+    assert record(store, b, 1).samples == 1
+    assert store._slots[store.key(b)] == slot
+    assert record(store, a, 1).samples == 1
+    store.close()
+
+
+def test_aimd_limit():
+    '''
+    Test the limit grows by one and halves on timeouts, once a window, between its minimum and maximum
+    '''
+    limit = urlmon.AIMDLimit(8, minimum=3)
+    window = urlmon.AIMD_WINDOW
+    timeouts = int(window * urlmon.AIMD_TIMEOUT_RATE)  # not halved
+
+    def results(timed_out):
+        for n in range(window):
+            limit.record(n < timed_out)
+
+    results(0)
+    assert limit.limit == 8  # at the maximum
+    results(timeouts + 1)
+    assert limit.limit == 4
+    for _ in range(window - 1):
+        limit.record(True)
+    assert limit.limit == 4  # until the window is complete
+    limit.record(True)
+    assert limit.limit == 3  # at the minimum
+    results(window)
+    assert limit.limit == 3
+    results(timeouts)
+    assert limit.limit == 4
+    results(0)
+    assert limit.limit == 5
+
+
+def test_concurrency_limiter_origin():
+    '''
+    Test checks over an origin's limit are deferred and timeouts from a throttled origin do not lower the total
+    '''
+    limiter = urlmon.ConcurrencyLimiter(40, origin_limit=2)
+    origin = ('http', 'slow.example.com', 80)
+    items = [(0, n, make_check('slow-%d' % n), ()) for n in range(3)]
+
+    for item in items[:2]:
+        assert limiter.reserve(block=False)
+        assert limiter.start(origin, item)
+    assert limiter.reserve(block=False)
+    assert not limiter.start(origin, items[2])
+    assert (limiter.active, limiter.deferred) == (2, 1)
+    assert limiter.finish(origin, False) is items[2]
+    assert limiter.finish(origin, False) is None
+    assert limiter.active == 0
+
+    def timeouts():
+        for _ in range(urlmon.AIMD_WINDOW):
+            limiter.reserve()
+            limiter.start(origin, items[0])
+            limiter.finish(origin, True)
+
+    timeouts()
+    assert limiter._origins[origin].limit.limit == 1
+    assert limiter.total.limit == 20
+    timeouts()
+    assert limiter._origins[origin].limit.limit == 1
+    assert limiter.total.limit == 21  # only a throttled origin timed out
+    assert limiter.total.minimum == 4
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    '''Answers like a protected page that redirects to another origin'''
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.server.name, self.command, self.path,
+             self.headers.get('Authorization'), self.headers.get('Cookie')))
+        if self.path == '/landing':
+            self.reply(200)
+        elif not self.headers.get('Authorization'):
+            self.reply(401, ('WWW-Authenticate', 'Basic realm="urlmon"'))
+        elif self.headers['Authorization'] != 'Basic dTpzZWNyZXQ=':  # u:secret
+            self.reply(403)
+        else:
+            self.reply(302, ('Location', self.server.redirect))
+
+    do_PUT = do_GET
+
+    def reply(self, status, *headers):
+        body = b'ok'
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def origins():
+    '''Two local servers on different ports, so different origins, that share a log of requests'''
+
+    requests = []
+    servers = []
+    for name in ('a', 'b'):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+        server.name = name
+        server.requests = requests
+        server.url = 'http://127.0.0.1:%d' % server.server_port
+        threading.Thread(target=server.serve_forever,
+                         args=(0.01,), daemon=True).start()
+        servers.append(server)
+    a, b = servers
+    a.redirect = b.url + '/landing'
+    yield a.url, b.url, requests
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def run_check(engine, check):
+    if engine == 'asyncio':
+        return asyncio.run(urlmon.async_urlmon(check))
+    return urlmon.WorkerThread.urlmon(check)
+
+
+class SizedBodyHandler(BaseHTTPRequestHandler):
+    '''Answers with a body of the size in the path, chunked if asked for'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        size = int(self.path.split('/')[-1])
+        self.send_response(200)
+        if self.path.startswith('/chunked/'):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for _ in range(size // 1024):
+                self.wfile.write(b'400\r\n' + b'x' * 1024 + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self.wfile.write(b'x' * size)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+@pytest.mark.parametrize('path, connections', [
+    ('/length/0', 1),
+    ('/length/%d' % urlmon.DRAIN_BYTES, 1),
+    ('/chunked/4096', 1),
+    ('/length/%d' % (urlmon.DRAIN_BYTES + 1), 2),
+    ('/chunked/%d' % (urlmon.DRAIN_BYTES + 1024), 2),
+])
+def test_status_only_connection_reused(engine, path, connections):
+    '''
+    Test status only checks drain small bodies, with a length or chunked, to reuse the connection
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SizedBodyHandler)
+    server.connections = set()
+    threading.Thread(target=server.serve_forever,
+                     args=(0.01,), daemon=True).start()
+    check = make_check('keep-alive', url='http://127.0.0.1:%d%s' %
+                       (server.server_port, path))
+
+    async def run_twice():
+        pool = urlmon.ConnectionPool()
+        results = [await urlmon.async_urlmon(check, pool) for _ in range(2)]
+        pool.clear()
+        return results
+
+    try:
+        if engine == 'asyncio':
+            results = asyncio.run(run_twice())
+        else:
+            results = [urlmon.WorkerThread.urlmon(check) for _ in range(2)]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [result.status for result in results] == [200, 200]
+    assert len(server.connections) == connections
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_redirect_to_other_origin(origins, engine):
+    '''
+    Test credentials are only sent after a challenge and not to another origin after a redirect
+    '''
+    a, b, requests = origins
+    check = make_check('protected', url=a + '/protected', username='u', password='secret',
+                       realm='urlmon', uri=a, headers={'Cookie': 'session=1'})
+
+    result = run_check(engine, check)
+    assert result.status == 200
+    assert requests == [
+        ('a', 'GET', '/protected', None, 'session=1'),
+        ('a', 'GET', '/protected', 'Basic dTpzZWNyZXQ=', 'session=1'),
+        ('b', 'GET', '/landing', None, None),
+    ]
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_credentials_outside_uri(origins, engine):
+    '''
+    Test credentials are not sent to a URL outside the uri or for another realm
+    '''
+    a, b, requests = origins
+    for auth in ({'uri': b, 'realm': 'urlmon'}, {'uri': a, 'realm': 'other'}):
+        check = make_check('protected', url=a + '/protected',
+                           username='u', password='secret', **auth)
+        assert run_check(engine, check).status == 401
+    assert [request[3] for request in requests] == [None, None]
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_redirect_not_followed(origins, engine):
+    '''
+    Test redirects of methods other than GET, HEAD and POST are not followed, as urllib
+    '''
+    a, b, requests = origins
+    check = make_check('protected', url=a + '/protected', method='PUT',
+                       headers={'Authorization': 'Basic dTpzZWNyZXQ='})
+
+    assert run_check(engine, check).status == 302
+    assert [request[:3]
+            for request in requests] == [('a', 'PUT', '/protected')]
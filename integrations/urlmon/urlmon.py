@@ -1,24 +1,51 @@
+import ast
+import asyncio
+import codecs
+import collections
 import datetime
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
+import operator
+import os
 import platform
 import queue
+import random
 import re
+import runpy
+import signal
 import socket
 import ssl
+import struct
 import sys
 import threading
 import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
 from http.server import BaseHTTPRequestHandler as BHRH
-from urllib.error import URLError  # pylint: disable=no-name-in-module
-from urllib.parse import urlparse  # pylint: disable=no-name-in-module
+from types import MappingProxyType, SimpleNamespace
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlparse, urlsplit
 from urllib.request import (  # pylint: disable=no-name-in-module
-    HTTPBasicAuthHandler, ProxyHandler, Request, build_opener, install_opener,
-    urlopen)
+    HTTPBasicAuthHandler, HTTPHandler, HTTPPasswordMgr, HTTPRedirectHandler,
+    HTTPSHandler, ProxyHandler, Request, build_opener)
 
 import settings
 from alertaclient.api import Client
 
+try:
+    import fcntl
+except ImportError:  # Windows, histories are not shared between processes
+    fcntl = None
+
 HTTP_RESPONSES = {k: v[0] for k, v in list(BHRH.responses.items())}
 
 # Add missing responses
@@ -45,7 +72,8 @@ _HTTP_ALERTS = [
 
 __version__ = '3.3.0'
 
-LOOP_EVERY = 60  # seconds
+LOOP_EVERY = 60  # seconds, default check interval
+JITTER = 0.1  # fraction of check interval
 # TARGET_FILE = 'urlmon.targets'  # FIXME -- or settings.py ???
 SERVER_THREADS = 20
 SLOW_WARNING_THRESHOLD = 5000  # ms
@@ -54,330 +82,2690 @@ MAX_TIMEOUT = 15000  # ms
 SSL_DAYS = 30
 SSL_DAYS_PANIC = 7
 
+ENGINE = getattr(settings, 'ENGINE', 'threads')  # 'threads' or 'asyncio'
+# in-flight checks for asyncio engine
+MAX_CONCURRENCY = getattr(settings, 'MAX_CONCURRENCY', 1000)
+# in-flight checks per origin, 0 for no limit
+ORIGIN_CONCURRENCY = getattr(settings, 'ORIGIN_CONCURRENCY', 4)
+AIMD_WINDOW = 20  # results between concurrency limit adjustments
+AIMD_TIMEOUT_RATE = 0.1  # fraction of timed out checks that halves a concurrency limit
+SENDER_THREADS = 20  # alert senders for asyncio engine
+# worker processes, each running ENGINE
+PROCESSES = getattr(settings, 'PROCESSES', 1)
+STATS_EVERY = 1  # seconds between worker process stats reports
+# number of shards or list of peer names
+SHARDS = getattr(settings, 'SHARDS', None)
+# index or name of this instance
+SHARD = os.environ.get('URLMON_SHARD', getattr(settings, 'SHARD', None))
+# .py, .yaml or .json file of checks, default settings.checks
+CHECKS_FILE = getattr(settings, 'CHECKS_FILE', None)
+# seconds between checks file mtime polls, 0 for SIGHUP only
+RELOAD_EVERY = getattr(settings, 'RELOAD_EVERY', 10)
+# resend unchanged alerts after (secs), 0 to always send
+ALERT_REFRESH = getattr(settings, 'ALERT_REFRESH', 300)
+RETRY_DELAY = 10  # seconds between attempts of checks with count > 1
+MAX_REDIRECTS = 10
+MAX_BODY_BYTES = 10 * 1024 * 1024  # default body download limit
+BODY_CHUNK = 64 * 1024
+# characters of an unfinished line kept to match the pattern across chunks
+SEARCH_OVERLAP = 1024
+# unread bodies up to this size are drained to keep the connection
+DRAIN_BYTES = 16 * 1024
+POOL_MAXSIZE = 10  # idle keep-alive connections per origin
+POOL_IDLE_TIMEOUT = 30  # seconds
+CERT_CACHE_TTL = 6 * 60 * 60  # seconds before certificate expiry is probed again
+# seconds host addresses are cached, 0 to disable
+DNS_TTL = getattr(settings, 'DNS_TTL', 60)
+# seconds expired addresses are used while refreshing
+DNS_STALE_TTL = getattr(settings, 'DNS_STALE_TTL', 600)
+# seconds failed lookups are cached
+DNS_NEGATIVE_TTL = getattr(settings, 'DNS_NEGATIVE_TTL', 30)
+DNS_THREADS = 4  # background refreshes of expired addresses
+# results kept per check for percentiles, 0 to disable
+HISTORY_SIZE = getattr(settings, 'HISTORY_SIZE', 128)
+# directory of memory-mapped history files kept across restarts
+HISTORY_DIR = getattr(settings, 'HISTORY_DIR', None)
+HISTORY_SEGMENT = 1024  # check histories mapped at a time
+HISTORY_WINDOW = 900  # seconds, default window for percentiles, availability and slope
+
+_SSL_CONTEXT = ssl.create_default_context()
+_SSL_DATE_FMT = r'%b %d %H:%M:%S %Y %Z'
+
 
 LOG = logging.getLogger('alerta.urlmon')
 logging.basicConfig(
     format='%(asctime)s - %(name)s: %(levelname)s - %(message)s', level=logging.DEBUG)
 
 
+_RULE_NAMES = ('status', 'headers', 'body')
+_RULE_FUNCTIONS = {
+    'len': len,
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': bool,
+}
+_RULE_COMPARE = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+_RULE_BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+_RULE_UNARYOPS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+}
+
+
+def compile_rule(rule):
+    """Compile a rule expression into a function of (status, headers, body).
+
+    Rules are Python expressions limited to literals, subscripts, comparisons,
+    boolean logic, basic arithmetic and the functions in _RULE_FUNCTIONS, eg.
+
+        body['status'] == 'ok' and len(body['nodes']) >= 3
+
+    Raises ValueError if the rule uses anything else.
+    """
+
+    try:
+        tree = ast.parse(rule.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(str(e))
+    return _compile_rule_node(tree.body)
+
+
+def _compile_rule_node(node):
+
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda ns: value
+
+    if isinstance(node, ast.Name):
+        if node.id not in _RULE_NAMES:
+            raise ValueError('unknown name %r' % node.id)
+        index = _RULE_NAMES.index(node.id)
+        return lambda ns: ns[index]
+
+    if isinstance(node, ast.Subscript):
+        key = node.slice
+        if isinstance(key, getattr(ast, 'Index', ())):  # Python 3.8
+            key = key.value
+        if isinstance(key, ast.Slice):
+            raise ValueError('slices are not supported')
+        value, key = _compile_rule_node(node.value), _compile_rule_node(key)
+        return lambda ns: value(ns)[key(ns)]
+
+    if isinstance(node, ast.Compare):
+        left = _compile_rule_node(node.left)
+        ops = [(_rule_op(_RULE_COMPARE, op), _compile_rule_node(right))
+               for op, right in zip(node.ops, node.comparators)]
+        if len(ops) == 1:
+            (op, right), = ops
+            return lambda ns: op(left(ns), right(ns))
+
+        def compare(ns):
+            a = left(ns)
+            for op, right in ops:
+                b = right(ns)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return compare
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_rule_node(v) for v in node.values]
+        if isinstance(node.op, ast.And):
+            def all_of(ns):
+                for v in values:
+                    result = v(ns)
+                    if not result:
+                        return result
+                return result
+            return all_of
+
+        def any_of(ns):
+            for v in values:
+                result = v(ns)
+                if result:
+                    return result
+            return result
+        return any_of
+
+    if isinstance(node, ast.UnaryOp):
+        op = _rule_op(_RULE_UNARYOPS, node.op)
+        operand = _compile_rule_node(node.operand)
+        return lambda ns: op(operand(ns))
+
+    if isinstance(node, ast.BinOp):
+        op = _rule_op(_RULE_BINOPS, node.op)
+        left = _compile_rule_node(node.left)
+        right = _compile_rule_node(node.right)
+        return lambda ns: op(left(ns), right(ns))
+
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        items = [_compile_rule_node(e) for e in node.elts]
+        return lambda ns: [item(ns) for item in items]
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _RULE_FUNCTIONS or node.keywords:
+            raise ValueError('unsupported function call')
+        func = _RULE_FUNCTIONS[node.func.id]
+        args = [_compile_rule_node(a) for a in node.args]
+        return lambda ns: func(*[a(ns) for a in args])
+
+    raise ValueError('unsupported expression %s' % type(node).__name__)
+
+
+def _rule_op(ops, op):
+
+    try:
+        return ops[type(op)]
+    except KeyError:
+        raise ValueError('unsupported operator %s' % type(op).__name__)
+
+
+class Check:
+    """A settings.checks entry compiled once when the checks are loaded.
+
+    Regexes, thresholds, request headers and the rule are prepared up front
+    so that evaluating a result does no parsing. Instances are read-only.
+    """
+
+    __slots__ = (
+        'definition', 'resource', 'url', 'environment', 'service', 'tags',
+        'method', 'data', 'headers', 'auth', 'proxy', 'count', 'interval',
+        'status_regex', 'search', 'rule', 'assertion', 'json_body', 'body_limit',
+        'warning', 'critical', 'slow_phase', 'percentile', 'window', 'slow_label', 'threshold_info',
+        'check_ssl', 'origin', 'ssl_origin', 'api'
+    )
+
+    def __init__(self, definition):
+
+        def set(name, value):
+            object.__setattr__(self, name, value)
+
+        set('definition', definition)
+        set('resource', definition['resource'])
+        set('url', definition['url'])
+        set('environment', definition['environment'])
+        set('service', definition['service'])
+        set('tags', definition.get('tags', list()))
+
+        post = definition.get('post', None)
+        set('data', json.dumps(post).encode('utf-8') if post else None)
+        set('method', definition.get('method', 'POST' if post else 'GET').upper())
+        headers = dict(definition.get('headers', {}))
+        if 'User-agent' not in headers:
+            headers['User-agent'] = 'alert-urlmon/%s' % (__version__)
+        set('headers', MappingProxyType(headers))
+        set('json_body', any(k.lower() == 'content-type' and v == 'application/json'
+                             for k, v in headers.items()))
+
+        username = definition.get('username', None)
+        password = definition.get('password', None)
+        if username and password:
+            # credentials are only sent to URLs under `uri`
+            set('auth', (definition.get('realm', None),
+                         definition.get('uri') or self.url, username, password))
+        else:
+            set('auth', None)
+        set('proxy', definition.get('proxy', False))
+
+        set('count', definition.get('count', 1))
+        interval = definition.get('interval', LOOP_EVERY)
+        valid = isinstance(interval, (int, float)) and 0 < interval < math.inf
+        if not valid or isinstance(interval, bool):
+            raise ValueError('interval must be a positive number of seconds')
+        set('interval', interval)
+        set('check_ssl', definition.get('check_ssl'))
+        url = urlparse(self.url)
+        set('origin', (url.scheme, url.hostname, url.port))
+        set('ssl_origin', (url.hostname, url.port or 443))
+
+        status_regex = definition.get('status_regex', None)
+        set('status_regex', re.compile(status_regex) if status_regex else None)
+        search = definition.get('search', None)
+        set('search', re.compile(search, re.MULTILINE) if search else None)
+        rule = definition.get('rule', None)
+        set('rule', rule)
+        set('assertion', compile_rule(rule) if rule else None)
+        # status-only checks don't download the body at all
+        if self.search or self.assertion:
+            set('body_limit', definition.get('max_body_bytes', MAX_BODY_BYTES))
+        else:
+            set('body_limit', 0)
+
+        set('warning', definition.get('warning', SLOW_WARNING_THRESHOLD))
+        set('critical', definition.get('critical', SLOW_CRITICAL_THRESHOLD))
+        set('slow_phase', definition.get('slow_phase', 'rtt'))
+        if self.slow_phase != 'rtt' and self.slow_phase not in Timings.PHASES:
+            raise ValueError('slow_phase must be rtt or one of %s' %
+                             ', '.join(Timings.PHASES))
+        set('percentile', definition.get('percentile', None))
+        if self.percentile is not None and not 0 < self.percentile <= 100:
+            raise ValueError('percentile must be between 0 and 100')
+        set('window', definition.get('window', HISTORY_WINDOW))
+        label = Timings.label(self.slow_phase)
+        if self.percentile is not None:
+            label = 'P{:g} {}'.format(self.percentile, label)
+        set('slow_label', label)
+        if self.percentile is not None:
+            set('threshold_info', '%s : %s > %d %s > %d over %ds' % (
+                self.url, label, self.warning, label, self.critical, self.window))
+        else:
+            set('threshold_info', '%s : %s > %d %s > %d x %s' % (
+                self.url, label, self.warning, label, self.critical, self.count))
+
+        checker_api = definition.get('api_endpoint', None)
+        checker_apikey = definition.get('api_key', None)
+        if (checker_api and checker_apikey):
+            set('api', Client(endpoint=checker_api, key=checker_apikey))
+        else:
+            set('api', None)
+
+    def __setattr__(self, name, value):
+
+        raise AttributeError('Check is read-only')
+
+    def __repr__(self):
+
+        return 'Check({!r}, {!r})'.format(self.resource, self.url)
+
+
+class Timings:
+    """Milliseconds spent in each phase of a check request.
+
+    Phases are summed over redirects. DNS, connect and TLS stay at zero when
+    a pooled connection is reused.
+    """
+
+    __slots__ = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+    PHASES = __slots__
+
+    def __init__(self):
+
+        self.dns = self.connect = self.tls = self.ttfb = self.transfer = 0.0
+
+    @staticmethod
+    def label(phase):
+
+        return 'RT' if phase == 'rtt' else phase.upper()
+
+    def attributes(self):
+
+        return {phase + 'Time': int(getattr(self, phase)) for phase in self.PHASES}
+
+
+class CheckResult:
+
+    __slots__ = ('status', 'reason', 'body', 'found',
+                 'rtt', 'headers', 'timings', 'previous')
+
+    def __init__(self, status=0, reason=None, body=None, found=None, rtt=0, headers=None, timings=None):
+
+        self.status = status
+        self.reason = reason
+        self.body = body      # kept only for rules
+        self.found = found    # search pattern found, None if no body
+        self.rtt = rtt
+        self.headers = headers if headers is not None else {}
+        self.timings = timings if timings is not None else Timings()
+        self.previous = ()    # results of earlier failed attempts
+
+    @property
+    def attempts(self):
+
+        return len(self.previous) + 1
+
+    def should_retry(self, check):
+
+        return not self.status and self.attempts < check.count
+
+    @property
+    def timed_out(self):
+
+        return not self.status and 'timed out' in str(self.reason)
+
+    def available(self, check):
+
+        if check.status_regex:
+            return bool(self.status) and bool(check.status_regex.search(str(self.status)))
+        return bool(self.status) and self.status < 500
+
+    def slow_time(self, check):
+
+        return self.rtt if check.slow_phase == 'rtt' else getattr(self.timings, check.slow_phase)
+
+
+class BodyReader:
+    """Consume a response body as it arrives, up to the check's body_limit.
+
+    The search pattern is matched on each chunk, and the end of the previous
+    line, so reading can stop as soon as it is found. The body itself is only
+    kept for rules.
+    """
+
+    __slots__ = ('limit', 'size', 'chunks', 'pattern',
+                 'decoder', 'pending', 'found')
+
+    def __init__(self, check):
+
+        self.limit = check.body_limit
+        self.size = 0
+        self.chunks = [] if check.assertion and not check.search else None
+        self.pattern = check.search
+        self.decoder = None
+        if self.pattern:
+            decoder = codecs.getincrementaldecoder('utf-8')
+            self.decoder = decoder(errors='ignore')
+        self.pending = ''
+        self.found = None
+
+    @classmethod
+    def for_check(cls, check):
+        """Return a reader for the response of `check`, status only checks share one that reads nothing."""
+
+        if not check.body_limit:
+            return _NO_BODY
+        return cls(check)
+
+    @property
+    def wants_body(self):
+
+        return self.limit > 0
+
+    def feed(self, data):
+        """Add a chunk of body, returns True once no more is needed."""
+
+        if self.size + len(data) > self.limit:
+            data = data[:self.limit - self.size]
+            LOG.debug('Response body truncated at %d bytes', self.limit)
+        self.size += len(data)
+        if self.chunks is not None:
+            self.chunks.append(data)
+
+        if self.pattern and not self.found:
+            text = self.pending + self.decoder.decode(data)
+            self.found = bool(self.pattern.search(text))
+            if self.found:
+                return True
+            # only the unfinished line, or its last SEARCH_OVERLAP characters,
+            # can be part of a match that ends in a later chunk
+            start = max(text.rfind('\n') + 1, len(text) - SEARCH_OVERLAP)
+            self.pending = text[start:]
+
+        return self.size >= self.limit
+
+    def close(self, result):
+
+        if self.pattern and not self.found and self.size:
+            text = self.pending + self.decoder.decode(b'', True)
+            self.found = bool(self.pattern.search(text))
+        result.found = self.found
+        if self.chunks is not None:
+            result.body = b''.join(self.chunks)
+
+
+# shared by checks that only look at the response status
+_NO_BODY = BodyReader(SimpleNamespace(
+    body_limit=0, assertion=None, search=None))
+
+
+def compile_checks(definitions):
+    """Compile check definitions, skipping (and logging) any that are invalid."""
+
+    checks = list()
+    for definition in definitions:
+        try:
+            checks.append(Check(definition))
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            LOG.error('Invalid check %s: %s',
+                      definition.get('resource', definition), e)
+    LOG.info('Loaded %d URL checks', len(checks))
+    return checks
+
+
+class CheckSource:
+    """Check definitions that can be re-read when the file they live in changes.
+
+    A Python file must define `checks`, YAML and JSON files hold the list of
+    checks or a mapping with a `checks` key. Without a path the definitions
+    come from `settings.checks` and reloading re-imports the settings module.
+    """
+
+    def __init__(self, path=None):
+
+        self.module = path is None
+        if self.module:
+            self.path = getattr(settings, '__file__', None)
+        else:
+            self.path = path
+        self.mtime = self._mtime()
+        self.loaded = False
+
+    def _mtime(self):
+
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+    def changed(self):
+
+        return self._mtime() != self.mtime
+
+    def load(self):
+
+        self.mtime = self._mtime()
+        if self.module:
+            if self.loaded:
+                importlib.reload(settings)
+            definitions = settings.checks
+        elif self.path.endswith('.py'):
+            definitions = runpy.run_path(self.path)['checks']
+        elif self.path.endswith(('.yaml', '.yml')):
+            import yaml
+            with open(self.path) as f:
+                definitions = yaml.safe_load(f)
+        else:
+            with open(self.path) as f:
+                definitions = json.load(f)
+        self.loaded = True
+
+        if isinstance(definitions, dict):
+            definitions = definitions['checks']
+        if not isinstance(definitions, list):
+            raise ValueError('checks must be a list, not %s' %
+                             type(definitions).__name__)
+        return definitions
+
+
+def check_status(check, result, history=None):
+    """Map the result of a URL check to an alert event, severity, value and text.
+
+    If the check has a `percentile` and the HistorySummary of its recent
+    results is given, that percentile is compared to the slow thresholds
+    instead of the time of this one result.
+    """
+
+    status = result.status
+    reason = result.reason
+    body = result.body
+    rtt = result.rtt
+
+    try:
+        description = HTTP_RESPONSES[status]
+    except KeyError:
+        description = 'undefined'
+
+    if not status:
+        event = 'HttpConnectionError'
+        severity = 'major'
+        value = reason
+        text = 'Error during connection or data transfer (timeout=%d).' % MAX_TIMEOUT
+        if result.attempts > 1:
+            text = 'Error during connection or data transfer (timeout=%d, %d attempts).' % (
+                MAX_TIMEOUT, result.attempts)
+
+    elif check.status_regex:
+        if check.status_regex.search(str(status)):
+            event = 'HttpResponseRegexOK'
+            severity = 'normal'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (
+                status, check.status_regex.pattern, rtt)
+        else:
+            event = 'HttpResponseRegexError'
+            severity = 'major'
+            value = '%s (%d)' % (description, status)
+            text = 'HTTP server responded with status code %d that failed to match "%s"' % (
+                status, check.status_regex.pattern)
+
+    elif 100 <= status <= 199:
+        event = 'HttpInformational'
+        severity = 'normal'
+        value = '%s (%d)' % (description, status)
+        text = 'HTTP server responded with status code %d in %dms' % (
+            status, rtt)
+
+    elif 200 <= status <= 299:
+        event = 'HttpResponseOK'
+        severity = 'normal'
+        value = '%s (%d)' % (description, status)
+        text = 'HTTP server responded with status code %d in %dms' % (
+            status, rtt)
+
+    elif 300 <= status <= 399:
+        event = 'HttpRedirection'
+        severity = 'minor'
+        value = '%s (%d)' % (description, status)
+        text = 'HTTP server responded with status code %d in %dms' % (
+            status, rtt)
+
+    elif 400 <= status <= 499:
+        event = 'HttpClientError'
+        severity = 'minor'
+        value = '%s (%d)' % (description, status)
+        text = 'HTTP server responded with status code %d in %dms' % (
+            status, rtt)
+
+    elif 500 <= status <= 599:
+        event = 'HttpServerError'
+        severity = 'major'
+        value = '%s (%d)' % (description, status)
+        text = 'HTTP server responded with status code %d in %dms' % (
+            status, rtt)
+
+    else:
+        event = 'HttpUnknownError'
+        severity = 'warning'
+        value = 'UNKNOWN'
+        text = 'HTTP request resulted in an unhandled error.'
+
+    if event in ['HttpResponseOK', 'HttpResponseRegexOK']:
+        if history is not None and history.percentile is not None:
+            elapsed = history.percentile
+        else:
+            elapsed = result.slow_time(check)
+        if elapsed > check.critical:
+            event = 'HttpResponseSlow'
+            severity = 'critical'
+            value = '%dms' % elapsed
+            text = 'Website available but exceeding critical %s thresholds of %dms' % (
+                check.slow_label, check.critical)
+        elif elapsed > check.warning:
+            event = 'HttpResponseSlow'
+            severity = 'warning'
+            value = '%dms' % elapsed
+            text = 'Website available but exceeding warning %s thresholds of %dms' % (
+                check.slow_label, check.warning)
+        if check.search and result.found is not None:
+            if result.found:
+                LOG.debug('Regex: Found %s', check.search.pattern)
+            else:
+                event = 'HttpContentError'
+                severity = 'minor'
+                value = 'Search failed'
+                text = 'Website available but pattern "%s" not found' % check.search.pattern
+        elif check.assertion and body:
+            LOG.debug('Evaluating rule %s', check.rule)
+            body = body.decode('utf-8', errors='ignore')
+            if check.json_body:
+                try:
+                    body = json.loads(body)
+                except ValueError as e:
+                    LOG.error(
+                        'Could not evaluate rule %s: %s', check.rule, e)
+            try:
+                passed = check.assertion((status, result.headers, body))
+            except Exception as e:
+                LOG.error('Could not evaluate rule %s: %s', check.rule, e)
+            else:
+                if not passed:
+                    event = 'HttpContentError'
+                    severity = 'minor'
+                    value = 'Rule failed'
+                    text = 'Website available but rule evaluation failed (%s)' % check.rule
+
+    LOG.debug('URL: %s, Status: %s (%s), Round-Trip Time: %dms -> %s',
+              check.url, description, status, rtt, event)
+
+    return event, severity, value, text
+
+
+class CertificateCache:
+    """Certificate expiry dates by (host, port).
+
+    Filled from the TLS handshakes the checks make anyway, so a separate
+    connection is only needed when an entry is missing or older than `ttl`.
+    """
+
+    def __init__(self, ttl=CERT_CACHE_TTL):
+
+        self.ttl = ttl
+        self._certs = {}
+        self._lock = threading.Lock()
+
+    def put(self, host, port, ssl_info):
+
+        try:
+            not_after = datetime.datetime.strptime(
+                ssl_info['notAfter'], _SSL_DATE_FMT)
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._certs[(host, port)] = (not_after, time.time())
+
+    def days_left(self, host, port):
+        """Return the time left before the certificate expires, None if not known."""
+
+        with self._lock:
+            entry = self._certs.get((host, port))
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0] - datetime.datetime.utcnow()
+
+
+_CERTIFICATES = CertificateCache()
+
+
+class Resolver:
+    """Cache of getaddrinfo() results by (host, port), shared by all checks.
+
+    The system resolver does not expose record TTLs so addresses are fresh
+    for `ttl` seconds. For `stale_ttl` seconds after that the old addresses
+    are still returned while a single background lookup refreshes them.
+    Names that fail to resolve are cached for `negative_ttl` seconds.
+    """
+
+    def __init__(self, ttl=DNS_TTL, stale_ttl=DNS_STALE_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=DNS_THREADS, thread_name_prefix='Resolver')
+
+    def _cached(self, host, port):
+        """Return cached addresses, raise a cached failure or return None on a miss."""
+
+        key = (host, port)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            addresses, expires = entry
+            now = time.time()
+            if now >= expires:
+                if not isinstance(addresses, list) or now >= expires + self.stale_ttl:
+                    self.misses += 1
+                    return None
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    self._executor.submit(self._refresh, host, port)
+            self.hits += 1
+        if not isinstance(addresses, list):
+            raise socket.gaierror(*addresses)
+        return addresses
+
+    def _lookup(self, host, port):
+
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self._lock:
+                self._cache[(host, port)] = (
+                    e.args, time.time() + self.negative_ttl)
+            raise
+        with self._lock:
+            self._cache[(host, port)] = (addresses, time.time() + self.ttl)
+        return addresses
+
+    def _refresh(self, host, port):
+
+        try:
+            self._lookup(host, port)
+        except OSError as e:
+            LOG.debug('Failed to refresh addresses for %s: %s', host, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard((host, port))
+
+    def resolve(self, host, port):
+
+        if not self.ttl:
+            return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        addresses = self._cached(host, port)
+        if addresses is None:
+            addresses = self._lookup(host, port)
+        return addresses
+
+    async def resolve_async(self, host, port):
+
+        if not self.ttl:
+            return await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = self._cached(host, port)
+        if addresses is None:
+            addresses = await asyncio.get_running_loop().run_in_executor(None, self._lookup, host, port)
+        return addresses
+
+
+_RESOLVER = Resolver()
+
+
+def ssl_days_left(check):
+    """Return the time left before the certificate for the check URL expires.
+
+    The cached expiry is used unless it is stale, in which case the server is
+    probed with a TLS handshake.
+    """
+
+    domain, port = check.ssl_origin
+    days_left = _CERTIFICATES.days_left(domain, port)
+    if days_left is not None:
+        return days_left
+
+    LOG.debug('Probing certificate for %s:%s', domain, port)
+    sock = _create_connection(Timings(), (domain, port), 3.0)
+    try:
+        with _SSL_CONTEXT.wrap_socket(sock, server_hostname=domain) as conn:
+            _CERTIFICATES.put(domain, port, conn.getpeercert())
+    finally:
+        sock.close()
+    return _CERTIFICATES.days_left(domain, port)
+
+
+class AlertFilter:
+    """Last alert sent for each check, used to suppress repeats.
+
+    An alert is sent when its event, severity or value bucket differs from
+    the last one sent for the check, or when that is older than `refresh`
+    seconds so the alert is kept alive in Alerta.
+    """
+
+    def __init__(self, refresh=ALERT_REFRESH):
+
+        self.refresh = refresh
+        self.sent = 0
+        self.suppressed = 0
+        self._last = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(value):
+
+        # response times change every run so only powers of two are significant
+        if isinstance(value, str) and value.endswith('ms') and value[:-2].isdigit():
+            return 'ms', int(value[:-2]).bit_length()
+        return value
+
+    def should_send(self, key, event, severity, value):
+
+        with self._lock:
+            last = self._last.get(key)
+            if last and last[0] == (event, severity, self.bucket(value)) and time.time() - last[1] < self.refresh:
+                self.suppressed += 1
+                return False
+        return True
+
+    def record(self, key, event, severity, value):
+
+        with self._lock:
+            self._last[key] = (
+                (event, severity, self.bucket(value)), time.time())
+            self.sent += 1
+
+    def forget(self, check):
+
+        with self._lock:
+            for key in [k for k in self._last if k[0] is check]:
+                del self._last[key]
+
+
+class HistorySummary:
+    """Response times and availability of a check's results within a window."""
+
+    __slots__ = ('samples', 'availability', 'p50',
+                 'p95', 'percentile', 'slope')
+
+    def __init__(self, samples=0, availability=None, p50=None, p95=None, percentile=None, slope=None):
+
+        self.samples = samples
+        self.availability = availability  # percent of results that were available
+        self.p50 = p50
+        self.p95 = p95
+        self.percentile = percentile  # check's percentile, None if not configured
+        self.slope = slope  # ms per minute
+
+    def attributes(self, prefix='responseTime'):
+
+        return {
+            prefix + 'P50': int(self.p50) if self.p50 is not None else None,
+            prefix + 'P95': int(self.p95) if self.p95 is not None else None,
+            prefix + 'Slope': self.slope,
+            'availability': self.availability
+        }
+
+
+def _percentile(ordered, p):
+
+    # nearest-rank percentile of a sorted list
+    return ordered[max(int(math.ceil(p / 100 * len(ordered))) - 1, 0)]
+
+
+class CheckHistory:
+    """Fixed-size ring of the most recent results of one check.
+
+    Times, response times and outcomes are typed arrays cast over a single
+    buffer, a bytearray or a memory-mapped file, so the cost per check is
+    fixed at `nbytes(size)` and a mapped history survives restarts.
+    """
+
+    MAGIC = b'UMH1'
+    HEADER = struct.Struct('<4sIQ')  # magic, size, results written
+
+    def __init__(self, size, buffer=None):
+
+        self.size = size
+        if buffer is None:
+            buffer = bytearray(self.nbytes(size))
+        self.buffer = buffer
+        view = memoryview(self.buffer)
+        magic, stored, _ = self.HEADER.unpack_from(view)
+        if magic != self.MAGIC or stored != size:
+            view[:self.nbytes(size)] = bytes(self.nbytes(size))
+            self.HEADER.pack_into(view, 0, self.MAGIC, size, 0)
+        offset = self.HEADER.size
+        self._written = view[8:offset].cast('Q')
+        self._times = view[offset:offset + 8 * size].cast('d')
+        offset += 8 * size
+        self._values = view[offset:offset + 4 * size].cast('f')
+        offset += 4 * size
+        self._ok = view[offset:offset + size].cast('B')
+        self._views = (view, self._written, self._times,
+                       self._values, self._ok)
+
+    @classmethod
+    def nbytes(cls, size):
+
+        return cls.HEADER.size + 13 * size
+
+    def __len__(self):
+
+        return min(self._written[0], self.size)
+
+    def record(self, timestamp, value, ok):
+
+        i = self._written[0] % self.size
+        self._times[i] = timestamp
+        self._values[i] = value
+        self._ok[i] = ok
+        self._written[0] += 1
+
+    def summary(self, window, percentile=None, now=None):
+        """Return a HistorySummary of the results recorded in the last `window` seconds."""
+
+        since = (now or time.time()) - window
+        times = []
+        values = []
+        total = 0
+        for i in range(len(self)):
+            if self._times[i] < since:
+                continue
+            total += 1
+            if self._ok[i]:
+                times.append(self._times[i])
+                values.append(self._values[i])
+        if not total:
+            return HistorySummary()
+
+        summary = HistorySummary(total, round(100.0 * len(values) / total, 2))
+        if values:
+            ordered = sorted(values)
+            summary.p50 = _percentile(ordered, 50)
+            summary.p95 = _percentile(ordered, 95)
+            if percentile is not None:
+                summary.percentile = _percentile(ordered, percentile)
+        if len(values) > 1 and max(times) - min(times) >= 1:
+            # least squares fit of value against time
+            mean_t = sum(times) / len(times)
+            mean_v = sum(values) / len(values)
+            variance = sum((t - mean_t) ** 2 for t in times)
+            if variance:
+                covariance = sum((t - mean_t) * (v - mean_v)
+                                 for t, v in zip(times, values))
+                summary.slope = round(60 * covariance / variance, 1)
+        return summary
+
+    def close(self):
+
+        for view in reversed(self._views):
+            view.release()
+        if isinstance(self.buffer, memoryview):
+            self.buffer.release()
+
+
+class HistoryStore:
+    """CheckHistory of every check run in this process.
+
+    Histories are kept in memory unless `directory` is given. Then each check
+    has a fixed slot in one memory-mapped file, history.dat, and history.idx
+    is a log of which check, by a hash of its definition, owns each slot so
+    an unchanged check picks up its history after a restart. Worker processes
+    share both files and lock the index to allocate slots.
+    """
+
+    INDEX = struct.Struct('<4sII')  # magic, slot size, compactions
+    MAGIC = b'UMI1'
+    RECORD = struct.Struct('<20sI')  # definition hash, zeros when free, slot
+    FREE = bytes(20)
+
+    def __init__(self, size=HISTORY_SIZE, directory=HISTORY_DIR, segment=HISTORY_SEGMENT):
+
+        self.size = size
+        self.directory = directory
+        self.segment = segment  # slots mapped at a time
+        granularity = mmap.ALLOCATIONGRANULARITY
+        pages = math.ceil(CheckHistory.nbytes(size) * segment / granularity)
+        self.segment_bytes = pages * granularity
+        self._histories = {}
+        self._lock = threading.Lock()
+        self._index = None
+        self._data = None
+        self._segments = []
+        self._slots = {}  # definition hash: slot
+        self._owners = {}  # slot: definition hash
+        self._free = set()
+        self._next = 0  # slots below this have been allocated before
+        self._epoch = None
+        self._offset = 0  # index bytes read so far
+
+    @staticmethod
+    def key(check):
+
+        return hashlib.sha1(CheckScheduler.key(check).encode('utf-8')).digest()
+
+    def _locked(self, func, *args):
+        """Call func with the index locked against other processes."""
+
+        if fcntl:
+            fcntl.flock(self._index, fcntl.LOCK_EX)
+        try:
+            self._sync()
+            return func(*args)
+        finally:
+            if fcntl:
+                fcntl.flock(self._index, fcntl.LOCK_UN)
+
+    def _sync(self):
+        """Apply the index records written since the last call, by any process."""
+
+        nbytes = CheckHistory.nbytes(self.size)
+        self._index.seek(0)
+        header = self._index.read(self.INDEX.size)
+        epoch = -1
+        if len(header) == self.INDEX.size:
+            magic, stored, epoch = self.INDEX.unpack(header)
+            if magic != self.MAGIC or stored != nbytes:
+                epoch = -1
+        if epoch < 0:  # new, or written for another HISTORY_SIZE
+            epoch = self._epoch + 1 if self._epoch is not None else 0
+            self._index.truncate(0)
+            self._index.write(self.INDEX.pack(self.MAGIC, nbytes, epoch))
+            self._index.flush()
+        if epoch != self._epoch:
+            self._epoch = epoch
+            self._offset = self.INDEX.size
+            self._slots = {}
+            self._owners = {}
+            self._next = 0
+
+        self._index.seek(self._offset)
+        data = self._index.read()
+        data = data[:len(data) - len(data) % self.RECORD.size]
+        for key, slot in self.RECORD.iter_unpack(data):
+            self._apply(key, slot)
+        self._offset += len(data)
+        if self._offset == self.INDEX.size + len(data):  # read from the start
+            self._free = set(range(self._next)) - set(self._owners)
+
+    def _apply(self, key, slot):
+
+        owner = self._owners.pop(slot, None)
+        if owner is not None:
+            del self._slots[owner]
+        if key == self.FREE:
+            self._free.add(slot)
+            return
+        if key in self._slots:
+            previous = self._slots[key]
+            del self._owners[previous]
+            self._free.add(previous)
+        self._slots[key] = slot
+        self._owners[slot] = key
+        self._free.discard(slot)
+        self._next = max(self._next, slot + 1)
+
+    def _append(self, key, slot):
+
+        self._index.write(self.RECORD.pack(key, slot))
+        self._index.flush()
+        self._offset += self.RECORD.size
+        self._apply(key, slot)
+
+    def _allocate(self, key):
+
+        slot = self._slots.get(key)
+        if slot is not None:  # allocated by another process
+            return slot, False
+        slot = self._free.pop() if self._free else self._next
+        self._append(key, slot)
+        return slot, True
+
+    def _release(self, key):
+
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._append(self.FREE, slot)
+
+    def _compact(self):
+
+        written = (self._offset - self.INDEX.size) // self.RECORD.size
+        if written - len(self._slots) <= max(len(self._slots), 1024):
+            return
+        self._epoch += 1
+        nbytes = CheckHistory.nbytes(self.size)
+        header = self.INDEX.pack(self.MAGIC, nbytes, self._epoch)
+        records = [self.RECORD.pack(key, slot)
+                   for key, slot in self._slots.items()]
+        self._index.truncate(0)
+        self._index.write(header + b''.join(records))
+        self._index.flush()
+        self._offset = self.INDEX.size + self.RECORD.size * len(records)
+
+    def _map(self, slot):
+        """Return the part of history.dat for a slot, growing the file if needed."""
+
+        nbytes = CheckHistory.nbytes(self.size)
+        segment, i = divmod(slot, self.segment)
+        while len(self._segments) <= segment:
+            offset = len(self._segments) * self.segment_bytes
+            if os.fstat(self._data.fileno()).st_size < offset + self.segment_bytes:
+                self._locked(self._grow, offset + self.segment_bytes)
+            self._segments.append(mmap.mmap(
+                self._data.fileno(), self.segment_bytes, offset=offset))
+        return memoryview(self._segments[segment])[i * nbytes:(i + 1) * nbytes]
+
+    def _grow(self, end):
+
+        if os.fstat(self._data.fileno()).st_size < end:
+            self._data.truncate(end)
+
+    def _open_files(self):
+
+        if self._index is None:
+            path = os.path.join(self.directory, 'history')
+            self._index = open(path + '.idx', 'a+b')
+            self._data = open(path + '.dat', 'a+b')
+            self._locked(self._compact)
+
+    def _open(self, check):
+
+        if not self.directory:
+            return CheckHistory(self.size)
+        try:
+            self._open_files()
+            key = self.key(check)
+            slot, new = self._slots.get(key), False
+            if slot is None:
+                slot, new = self._locked(self._allocate, key)
+            buffer = self._map(slot)
+            if new:  # clear what a forgotten check left behind
+                buffer[:] = bytes(len(buffer))
+            return CheckHistory(self.size, buffer)
+        except (OSError, ValueError) as e:
+            LOG.warning(
+                'Failed to map history of %s, keeping it in memory: %s', check.resource, e)
+            return CheckHistory(self.size)
+
+    def record(self, check, result):
+        """Add the result of a check and return a HistorySummary of its window, None if disabled."""
+
+        if not self.size:
+            return None
+        with self._lock:
+            history = self._histories.get(check)
+            if history is None:
+                history = self._histories[check] = self._open(check)
+        now = time.time()
+        elapsed = result.slow_time(check) or 0
+        history.record(now, elapsed, result.available(check))
+        return history.summary(check.window, check.percentile, now)
+
+    def forget(self, check):
+
+        with self._lock:
+            history = self._histories.pop(check, None)
+            if history is not None:
+                history.close()
+            if not self.size or not self.directory:
+                return
+            try:
+                self._open_files()
+                self._locked(self._release, self.key(check))
+            except OSError as e:
+                LOG.warning('Failed to free history of %s: %s',
+                            check.resource, e)
+
+    def close(self):
+
+        with self._lock:
+            histories, self._histories = self._histories, {}
+            for history in histories.values():
+                history.close()
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            if self._index is not None:
+                self._index.close()
+                self._data.close()
+                self._index = self._data = None
+
+
+_HISTORY = HistoryStore()
+
+
+def send_check_alerts(api, check, event, severity, value, text, days_left=None, alerts=None, result=None, history=None):
+    """Send the check result, and certificate expiry if known, to the check's Alerta API.
+
+    If an AlertFilter is given alerts that repeat the last one sent are skipped.
+    The response and phase times of `result` and the percentiles, slope and
+    availability of a HistorySummary are added to the alert attributes.
+    """
+
+    local_api = check.api or api
+
+    resource = check.resource
+    correlate = _HTTP_ALERTS
+    group = 'Web'
+    environment = check.environment
+    service = check.service
+    tags = check.tags
+    threshold_info = check.threshold_info
+
+    attributes = {'thresholdInfo': threshold_info}
+    if result is not None and result.status:
+        attributes['responseTime'] = result.rtt
+        attributes.update(result.timings.attributes())
+    if result is not None and result.attempts > 1:
+        attributes['attempts'] = result.attempts
+    if history is not None and history.samples:
+        attributes.update(history.attributes(
+            'responseTime' if check.slow_phase == 'rtt' else check.slow_phase + 'Time'))
+
+    try:
+        if alerts is None or alerts.should_send((check, 'http'), event, severity, value):
+            local_api.send_alert(
+                resource=resource,
+                event=event,
+                correlate=correlate,
+                group=group,
+                value=value,
+                severity=severity,
+                environment=environment,
+                service=service,
+                text=text,
+                event_type='serviceAlert',
+                tags=tags,
+                attributes=attributes
+            )
+            if alerts:
+                alerts.record((check, 'http'), event, severity, value)
+    except Exception as e:
+        LOG.warning('Failed to send alert: %s', e)
+
+    if days_left is None:
+        return
+
+    if days_left < datetime.timedelta(days=0):
+        text = 'HTTPS cert for %s expired' % check.resource
+        severity = 'critical'
+    elif days_left < datetime.timedelta(days=SSL_DAYS) and days_left > datetime.timedelta(days=SSL_DAYS_PANIC):
+        text = 'HTTPS cert for {} will expire at {}'.format(
+            check.resource, days_left)
+        severity = 'major'
+    elif days_left <= datetime.timedelta(days=SSL_DAYS_PANIC):
+        text = 'HTTPS cert for {} will expire at {}'.format(
+            check.resource, days_left)
+        severity = 'critical'
+    else:
+        severity = 'normal'
+
+    value = 'left %s day(s)' % days_left.days
+    try:
+        if alerts is None or alerts.should_send((check, 'ssl'), 'HttpSSLChecker', severity, value):
+            local_api.send_alert(
+                resource=resource,
+                event='HttpSSLChecker',
+                correlate=correlate,
+                group=group,
+                value=value,
+                severity=severity,
+                environment=environment,
+                service=service,
+                text=text,
+                event_type='serviceAlert',
+                tags=tags,
+                attributes={
+                    'thresholdInfo': threshold_info
+                }
+            )
+            if alerts:
+                alerts.record((check, 'ssl'), 'HttpSSLChecker',
+                              severity, value)
+    except Exception as e:
+        LOG.warning('Failed to send ssl alert: %s', e)
+
+
+class ConnectionPool:
+    """Idle keep-alive connections keyed by (scheme, host, port, proxy, auth)."""
+
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, released = idle.pop()
+                if time.time() - released < self.idle_timeout:
+                    return conn
+                conn.close()
+            self._idle.pop(key, None)
+        return None
+
+    def put(self, key, conn):
+
+        with self._lock:
+            idle = self._idle.setdefault(key, collections.deque())
+            if len(idle) >= self.maxsize:
+                idle.popleft()[0].close()
+            idle.append((conn, time.time()))
+
+    def clear(self):
+
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+class KeepAliveHandler(HTTPHandler, HTTPSHandler):
+    """Replaces the default urllib HTTP/HTTPS handlers to reuse pooled connections.
+
+    Connections go back to the pool when their response is closed after the
+    body has been read in full.
+    """
+
+    def __init__(self, pool, key):
+
+        HTTPHandler.__init__(self)
+        HTTPSHandler.__init__(self, context=_SSL_CONTEXT)
+        self.pool = pool
+        self.key = key  # (proxy, auth) of the opener
+
+    def do_open(self, http_class, req, **http_conn_args):
+
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+        scheme = 'https' if issubclass(http_class, HTTPSConnection) else 'http'
+        key = (scheme, host, req._tunnel_host) + self.key
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(
+            {k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+        headers.pop('Connection', None)
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop(
+                'Proxy-Authorization')
+
+        timings = getattr(_TIMINGS, 'current', None) or Timings()
+        conn = self.pool.get(key)
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn._create_connection = functools.partial(
+                    _create_connection, timings)
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            try:
+                if not reused:
+                    start = time.perf_counter()
+                    before = timings.dns + timings.connect
+                    conn.connect()
+                    handshake = (time.perf_counter() - start) * 1000
+                    handshake -= timings.dns + timings.connect - before
+                    timings.tls += handshake
+                start = time.perf_counter()
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                if not reused and scheme == 'https':
+                    origin = urlsplit('//' + (req._tunnel_host or host))
+                    _CERTIFICATES.put(
+                        origin.hostname, origin.port or 443, conn.sock.getpeercert())
+                response = conn.getresponse()
+                timings.ttfb += (time.perf_counter() - start) * 1000
+            except (OSError, HTTPException) as e:
+                conn.close()
+                if reused:  # server closed the idle connection, try a new one
+                    conn = None
+                    continue
+                if isinstance(e, OSError):
+                    raise URLError(e)
+                raise
+            break
+
+        def close(conn=conn, close_response=response.close):
+            fully_read = response.isclosed()
+            close_response()
+            if fully_read and not response.will_close and conn.sock:
+                self.pool.put(key, conn)
+            else:
+                conn.close()
+
+        response.close = close
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+    def http_open(self, req):
+
+        return self.do_open(HTTPConnection, req)
+
+
+def _create_connection(timings, address, timeout=None, source_address=None):
+    """socket.create_connection() that times name resolution and connecting separately."""
+
+    host, port = address
+    start = time.perf_counter()
+    addresses = _RESOLVER.resolve(host, port)
+    connecting = time.perf_counter()
+    timings.dns += (connecting - start) * 1000
+
+    error = OSError('getaddrinfo returned an empty list')
+    for _, _, _, _, sockaddr in addresses:
+        try:
+            sock = socket.create_connection(
+                sockaddr[:2], timeout, source_address)
+        except OSError as e:
+            error = e
+            continue
+        timings.connect += (time.perf_counter() - connecting) * 1000
+        return sock
+    raise error
+
+
+_CONNECTIONS = ConnectionPool()
+_TIMINGS = threading.local()  # Timings of the request running in this thread
+_OPENERS = {}
+_OPENERS_LOCK = threading.Lock()
+
+
+def _origin(url):
+
+    u = urlsplit(url)
+    return u.scheme, u.hostname, u.port or (443 if u.scheme == 'https' else 80)
+
+
+# request headers that are not sent on when a redirect leaves the origin
+_ORIGIN_HEADERS = ('authorization', 'cookie')
+
+
+class RedirectHandler(HTTPRedirectHandler):
+    """Follows redirects like urllib but drops credentials and cookies on the way to another origin."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None and _origin(new.full_url) != _origin(req.full_url):
+            for name in _ORIGIN_HEADERS:
+                new.remove_header(name.capitalize())
+        return new
+
+
+def get_opener(proxy=None, auth=None):
+    """Return the shared opener for a (proxy, auth) combination."""
+
+    key = (tuple(sorted(proxy.items())) if proxy else None, auth)
+    with _OPENERS_LOCK:
+        opener = _OPENERS.get(key)
+        if opener is None:
+            handlers = [KeepAliveHandler(_CONNECTIONS, key), RedirectHandler()]
+            if auth:
+                realm, uri, username, password = auth
+                auth_handler = HTTPBasicAuthHandler()
+                auth_handler.add_password(realm=realm,
+                                          uri=uri,
+                                          user=username,
+                                          passwd=password)
+                handlers.append(auth_handler)
+            if proxy:
+                handlers.append(ProxyHandler(proxy))
+            opener = _OPENERS[key] = build_opener(*handlers)
+    return opener
+
+
 class WorkerThread(threading.Thread):
 
-    def __init__(self, queue, api):
+    def __init__(self, queue, api, alerts=None, retries=None, limiter=None):
 
         threading.Thread.__init__(self)
         LOG.debug('Initialising %s...', self.getName())
 
         self.queue = queue   # internal queue
         self.api = api       # send alerts api
+        self.alerts = alerts  # suppress repeated alerts
+        self.retries = retries  # RetryTimer for failed attempts
+        # shared by all workers
+        self.limiter = limiter or ConcurrencyLimiter(SERVER_THREADS)
 
     def run(self):
 
         while True:
+            self.limiter.reserve()
             LOG.debug('Waiting on input queue...')
-            try:
-                check, queue_time = self.queue.get()
-            except TypeError:
+            item = self.queue.get()
+            deadline, _, check, *previous = item
+            if check is None:
+                self.limiter.cancel()
                 LOG.info('%s is shutting down.', self.getName())
                 break
 
-            if time.time() - queue_time > LOOP_EVERY:
-                LOG.warning('URL request for %s to %s expired after %d seconds.', check['resource'], check['url'],
-                            int(time.time() - queue_time))
+            if not self.limiter.start(check.origin, item):
+                LOG.debug('Deferring %s, too many checks in flight to %s',
+                          check.resource, check.origin[1])
                 self.queue.task_done()
                 continue
 
-            resource = check['resource']
-            LOG.info('%s polling %s...', self.getName(), resource)
-            status, reason, body, rtt = self.urlmon(check)
-
-            status_regex = check.get('status_regex', None)
-            search_string = check.get('search', None)
-            rule = check.get('rule', None)
-            warn_thold = check.get('warning', SLOW_WARNING_THRESHOLD)
-            crit_thold = check.get('critical', SLOW_CRITICAL_THRESHOLD)
-            checker_api = check.get('api_endpoint', None)
-            checker_apikey = check.get('api_key', None)
-            check_ssl = check.get('check_ssl')
-            if (checker_api and checker_apikey):
-                local_api = Client(endpoint=checker_api, key=checker_apikey)
-            else:
-                local_api = self.api
+            if time.time() > deadline:
+                LOG.warning('URL request for %s to %s is running %d seconds late.', check.resource, check.url,
+                            int(time.time() - deadline))
 
+            result = None
             try:
-                description = HTTP_RESPONSES[status]
-            except KeyError:
-                description = 'undefined'
-
-            if not status:
-                event = 'HttpConnectionError'
-                severity = 'major'
-                value = reason
-                text = 'Error during connection or data transfer (timeout=%d).' % MAX_TIMEOUT
-
-            elif status_regex:
-                if re.search(status_regex, str(status)):
-                    event = 'HttpResponseRegexOK'
-                    severity = 'normal'
-                    value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that matched "%s" in %dms' % (
-                        status, status_regex, rtt)
-                else:
-                    event = 'HttpResponseRegexError'
-                    severity = 'major'
-                    value = '%s (%d)' % (description, status)
-                    text = 'HTTP server responded with status code %d that failed to match "%s"' % (
-                        status, status_regex)
-
-            elif 100 <= status <= 199:
-                event = 'HttpInformational'
-                severity = 'normal'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (
-                    status, rtt)
-
-            elif 200 <= status <= 299:
-                event = 'HttpResponseOK'
-                severity = 'normal'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (
-                    status, rtt)
-
-            elif 300 <= status <= 399:
-                event = 'HttpRedirection'
-                severity = 'minor'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (
-                    status, rtt)
-
-            elif 400 <= status <= 499:
-                event = 'HttpClientError'
-                severity = 'minor'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (
-                    status, rtt)
+                result = self.process(check, *previous)
+            except Exception as e:
+                LOG.error('Check for %s failed: %s',
+                          check.resource, e, exc_info=1)
+            finally:
+                deferred = self.limiter.finish(
+                    check.origin, result is not None and result.timed_out)
+                if deferred:
+                    self.queue.put(deferred)
 
-            elif 500 <= status <= 599:
-                event = 'HttpServerError'
-                severity = 'major'
-                value = '%s (%d)' % (description, status)
-                text = 'HTTP server responded with status code %d in %dms' % (
-                    status, rtt)
+            self.queue.task_done()
 
-            else:
-                event = 'HttpUnknownError'
-                severity = 'warning'
-                value = 'UNKNOWN'
-                text = 'HTTP request resulted in an unhandled error.'
-
-            if event in ['HttpResponseOK', 'HttpResponseRegexOK']:
-                if rtt > crit_thold:
-                    event = 'HttpResponseSlow'
-                    severity = 'critical'
-                    value = '%dms' % rtt
-                    text = 'Website available but exceeding critical RT thresholds of %dms' % crit_thold
-                elif rtt > warn_thold:
-                    event = 'HttpResponseSlow'
-                    severity = 'warning'
-                    value = '%dms' % rtt
-                    text = 'Website available but exceeding warning RT thresholds of %dms' % warn_thold
-                if search_string and body:
-                    LOG.debug('Searching for %s', search_string)
-                    found = False
-                    for line in body.split('\n'):
-                        m = re.search(search_string, line)
-                        if m:
-                            found = True
-                            LOG.debug('Regex: Found %s in %s',
-                                      search_string, line)
-                            break
-                    if not found:
-                        event = 'HttpContentError'
-                        severity = 'minor'
-                        value = 'Search failed'
-                        text = 'Website available but pattern "%s" not found' % search_string
-                elif rule and body:
-                    LOG.debug('Evaluating rule %s', rule)
-                    headers = check.get('headers', {})
-                    if 'Content-type' in headers and headers['Content-type'] == 'application/json':
-                        try:
-                            body = json.loads(body)
-                        except ValueError as e:
-                            LOG.error(
-                                'Could not evaluate rule %s: %s', rule, e)
-                    try:
-                        # NOTE: assumes request body in variable called 'body'
-                        eval(rule)
-                    except (SyntaxError, NameError, ZeroDivisionError) as e:
-                        LOG.error('Could not evaluate rule %s: %s', rule, e)
-                    except Exception as e:
-                        LOG.error('Could not evaluate rule %s: %s', rule, e)
-                    else:
-                        if not eval(rule):
-                            event = 'HttpContentError'
-                            severity = 'minor'
-                            value = 'Rule failed'
-                            text = 'Website available but rule evaluation failed (%s)' % rule
-
-            LOG.debug('URL: %s, Status: %s (%s), Round-Trip Time: %dms -> %s',
-                      check['url'], description, status, rtt, event)
-
-            resource = check['resource']
-            correlate = _HTTP_ALERTS
-            group = 'Web'
-            environment = check['environment']
-            service = check['service']
-            text = text
-            tags = check.get('tags', list())
-            threshold_info = '%s : RT > %d RT > %d x %s' % (
-                check['url'], warn_thold, crit_thold, check.get('count', 1))
+        self.queue.task_done()
 
+    def process(self, check, previous=()):
+
+        resource = check.resource
+        LOG.info('%s polling %s...', self.getName(), resource)
+        result = self.urlmon(check)
+        result.previous = list(previous)
+        if self.retries is not None and result.should_retry(check):
+            LOG.info('%s attempt %d of %d failed, retrying in %ds.',
+                     resource, result.attempts, check.count, RETRY_DELAY)
+            self.retries.put_later(
+                RETRY_DELAY, check, result.previous + [result])
+            return result
+        history = _HISTORY.record(check, result)
+        event, severity, value, text = check_status(check, result, history)
+
+        days_left = None
+        if check.check_ssl:
             try:
-                local_api.send_alert(
-                    resource=resource,
-                    event=event,
-                    correlate=correlate,
-                    group=group,
-                    value=value,
-                    severity=severity,
-                    environment=environment,
-                    service=service,
-                    text=text,
-                    event_type='serviceAlert',
-                    tags=tags,
-                    attributes={
-                        'thresholdInfo': threshold_info
-                    }
-                )
+                days_left = ssl_days_left(check)
             except Exception as e:
-                LOG.warning('Failed to send alert: %s', e)
-
-            if check_ssl:
-                ssl_date_fmt = r'%b %d %H:%M:%S %Y %Z'
-                context = ssl.create_default_context()
-                domain = '{uri.netloc}'.format(uri=urlparse(check.get('url')))
-                port = urlparse(check.get('url')).port or 443
-                conn = context.wrap_socket(
-                    socket.socket(socket.AF_INET),
-                    server_hostname=domain
-                )
-                conn.settimeout(3.0)
-                conn.connect((domain, port))
-                ssl_info = conn.getpeercert()
-                days_left = datetime.datetime.strptime(
-                    ssl_info['notAfter'], ssl_date_fmt) - datetime.datetime.utcnow()
-                if days_left < datetime.timedelta(days=0):
-                    text = 'HTTPS cert for %s expired' % check['resource']
-                    severity = 'critical'
-                elif days_left < datetime.timedelta(days=SSL_DAYS) and days_left > datetime.timedelta(days=SSL_DAYS_PANIC):
-                    text = 'HTTPS cert for {} will expire at {}'.format(
-                        check['resource'], days_left)
-                    severity = 'major'
-                elif days_left <= datetime.timedelta(days=SSL_DAYS_PANIC):
-                    text = 'HTTPS cert for {} will expire at {}'.format(
-                        check['resource'], days_left)
-                    severity = 'critical'
-                else:
-                    severity = 'normal'
+                LOG.warning(
+                    'Failed to get certificate for %s: %s', resource, e)
 
-                try:
-                    local_api.send_alert(
-                        resource=resource,
-                        event='HttpSSLChecker',
-                        correlate=correlate,
-                        group=group,
-                        value='left %s day(s)' % days_left.days,
-                        severity=severity,
-                        environment=environment,
-                        service=service,
-                        text=text,
-                        event_type='serviceAlert',
-                        tags=tags,
-                        attributes={
-                            'thresholdInfo': threshold_info
-                        }
-                    )
-                except Exception as e:
-                    LOG.warning('Failed to send ssl alert: %s', e)
-
-            self.queue.task_done()
-            LOG.info('%s check complete.', self.getName())
-
-        self.queue.task_done()
+        send_check_alerts(self.api, check, event, severity,
+                          value, text, days_left, self.alerts, result, history)
+        LOG.info('%s check complete.', self.getName())
+        return result
 
     @staticmethod
     def urlmon(check):
+        """Make one attempt at the check request, retries are scheduled by the caller."""
+
+        opener = get_opener(check.proxy, check.auth)
+        result = CheckResult()
+        start = time.time()
+        _TIMINGS.current = result.timings
+
+        response = None
+        try:
+            req = Request(check.url, check.data,
+                          headers=check.headers, method=check.method)
+            response = opener.open(req, None, MAX_TIMEOUT / 1000)
+            result.status = response.getcode()
+            result.headers = {
+                k.lower(): v for k, v in response.headers.items()}
+            body = BodyReader.for_check(check)
+            transfer = time.perf_counter()
+            if body.wants_body:
+                while True:
+                    data = response.read(BODY_CHUNK)
+                    if not data or body.feed(data):
+                        break
+            elif response.chunked or response.length is not None and response.length <= DRAIN_BYTES:
+                response.read(DRAIN_BYTES)  # so the connection can be reused
+            result.timings.transfer += (time.perf_counter() - transfer) * 1000
+            body.close(result)
+        except ValueError as e:
+            LOG.error('Request failed: %s' % e)
+        except HTTPError as e:
+            result.reason = None
+            result.status = e.code
+            result.headers = {k.lower(): v for k, v in e.headers.items()}
+            e.close()
+        except URLError as e:
+            if hasattr(e, 'reason'):
+                result.reason = str(e.reason)
+                result.status = None
+            elif hasattr(e, 'code'):
+                result.reason = None
+                result.status = e.code  # pylint: disable=no-member
+        except (OSError, HTTPException) as e:
+            # the body timed out or the connection failed part way through
+            result.reason = str(e)
+            result.status = None
+        except Exception as e:
+            LOG.warning('Unexpected error: %s' % e)
+        finally:
+            if response is not None:
+                response.close()
+            _TIMINGS.current = None
+
+        # round-trip time
+        result.rtt = int((time.time() - start) * 1000 - result.timings.dns)
+        return result
+
+
+async def async_urlmon(check, pool=None):
+    """Asyncio counterpart of WorkerThread.urlmon()."""
+
+    if check.proxy:
+        # proxied checks are rare so leave them to urllib on the default executor
+        return await asyncio.get_running_loop().run_in_executor(None, WorkerThread.urlmon, check)
+
+    result = CheckResult()
+    start = time.time()
+    body = BodyReader.for_check(check)
+
+    try:
+        result.status, result.headers = await asyncio.wait_for(
+            http_request(check.url, check.headers, check.data, pool,
+                         body, check.method, result.timings, check.auth),
+            MAX_TIMEOUT / 1000)
+    except ValueError as e:
+        LOG.error('Request failed: %s' % e)
+    except asyncio.TimeoutError:
+        result.reason = 'timed out'
+        result.status = None
+    except OSError as e:
+        # match the reason urllib reports for the same socket error
+        if isinstance(e, socket.gaierror):
+            strerror = e.strerror
+        else:
+            strerror = os.strerror(e.errno or 0)
+        if e.errno:
+            result.reason = '[Errno {}] {}'.format(e.errno, strerror)
+        else:
+            result.reason = str(e)
+        result.status = None
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        result.reason = str(e)
+        result.status = None
+    except Exception as e:
+        LOG.warning('Unexpected error: %s' % e)
 
-        url = check['url']
-        post = check.get('post', None)
-        count = check.get('count', 1)
-        headers = check.get('headers', {})
-        username = check.get('username', None)
-        password = check.get('password', None)
-        realm = check.get('realm', None)
-        uri = check.get('uri', None)
-        proxy = check.get('proxy', False)
-
-        status = 0
-        reason = None
-        body = None
-        rtt = 0
+    # round-trip time
+    result.rtt = int((time.time() - start) * 1000 - result.timings.dns)
+    if result.status:
+        body.close(result)
+    return result
+
+
+async def async_ssl_days_left(check):
+    """Asyncio counterpart of ssl_days_left()."""
+
+    domain, port = check.ssl_origin
+    days_left = _CERTIFICATES.days_left(domain, port)
+    if days_left is not None:
+        return days_left
+
+    LOG.debug('Probing certificate for %s:%s', domain, port)
+    _, writer = await asyncio.wait_for(_open_connection(domain, port, True, Timings()), 3.0)
+    try:
+        _CERTIFICATES.put(domain, port, writer.get_extra_info('peercert'))
+    finally:
+        writer.close()
+    return _CERTIFICATES.days_left(domain, port)
+
+
+async def http_request(url, headers, data=None, pool=None, body=None, method=None, timings=None, auth=None):
+    """Minimal HTTP/1.1 client for the asyncio engine, redirects are followed like urlopen().
+
+    The final response body is fed to `body` (a BodyReader) and connections
+    are kept alive in `pool` if one is given. Phase times are added to
+    `timings`. Like HTTPBasicAuthHandler, the (realm, uri, username,
+    password) of `auth` are only sent in answer to a 401 challenge for the
+    realm from a URL under uri. Returns (status, headers).
+    """
+
+    method = method or ('POST' if data is not None else 'GET')
+    timings = timings or Timings()
+    redirects = 0
+    authorization = None
+    while True:
+        sent = headers
+        if authorization:
+            sent = dict(headers, Authorization=authorization)
+        status, response_headers = await _http_exchange(method, url, sent, data, pool, body, timings)
+        if status == 401 and auth and not authorization:
+            authorization = _basic_authorization(
+                auth, url, response_headers.get('www-authenticate'))
+            if authorization:
+                continue
+        location = response_headers.get('location')
+        if status not in _REDIRECTS or not location or redirects == MAX_REDIRECTS:
+            break
+        # urllib raises HTTPError rather than follow these
+        if not (method in ('GET', 'HEAD') or method == 'POST' and status in (301, 302, 303)):
+            break
+        if method == 'POST':
+            method, data = 'GET', None
+            headers = {name: value for name, value in headers.items()
+                       if name.lower() not in ('content-length', 'content-type')}
+        location = urljoin(url, location)
+        if _origin(location) != _origin(url):
+            headers = {name: value for name, value in headers.items()
+                       if name.lower() not in _ORIGIN_HEADERS}
+        url = location
+        redirects += 1
+        authorization = None
+    return status, response_headers
+
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_PASSWORDS = {}  # auth: HTTPPasswordMgr holding its credentials
+
+
+def _basic_authorization(auth, url, challenge):
+    """Return the Authorization header that answers a 401 `challenge` from `url`, None if `auth` does not apply."""
+
+    realms = [realm for scheme, _, realm in HTTPBasicAuthHandler.rx.findall(challenge or '')
+              if scheme.lower() == 'basic']
+    if not realms:
+        return None
+    passwords = _PASSWORDS.get(auth)
+    if passwords is None:
+        realm, uri, username, password = auth
+        passwords = _PASSWORDS[auth] = HTTPPasswordMgr()
+        passwords.add_password(realm, uri, username, password)
+    username, password = passwords.find_user_password(realms[0], url)
+    if username is None:
+        return None
+    credentials = '{}:{}'.format(username, password).encode('utf-8')
+    return 'Basic %s' % b64encode(credentials).decode('ascii')
+
+
+class _Stream:
+
+    __slots__ = ('reader', 'writer')
+
+    def __init__(self, reader, writer):
+
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+
+        self.writer.close()
+
+
+async def _open_connection(host, port, tls, timings):
+    """asyncio.open_connection() that times resolution, connect and TLS handshake separately."""
+
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    addresses = await _RESOLVER.resolve_async(host, port)
+    connecting = time.perf_counter()
+    timings.dns += (connecting - start) * 1000
+
+    error = OSError('getaddrinfo returned an empty list')
+    for family, type_, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr)
+            break
+        except OSError as e:
+            sock.close()
+            error = e
+        except BaseException:
+            sock.close()
+            raise
+    else:
+        raise error
+    handshake = time.perf_counter()
+    timings.connect += (handshake - connecting) * 1000
 
+    try:
+        streams = await asyncio.open_connection(
+            sock=sock, ssl=_SSL_CONTEXT if tls else None, server_hostname=host if tls else None)
+    except BaseException:
+        sock.close()
+        raise
+    timings.tls += (time.perf_counter() - handshake) * 1000
+    return streams
+
+
+async def _http_exchange(method, url, headers, data, pool=None, body=None, timings=None):
+
+    u = urlparse(url)
+    if u.scheme not in ('http', 'https') or not u.hostname:
+        raise ValueError('unknown url type: %r' % url)
+    tls = u.scheme == 'https'
+    timings = timings or Timings()
+    port = u.port or (443 if tls else 80)
+    key = (u.scheme, u.hostname, port, None, headers.get('Authorization'))
+
+    target = u.path or '/'
+    if u.query:
+        target += '?' + u.query
+    lines = [
+        '{} {} HTTP/1.1'.format(method, target),
+        'Host: %s' % u.netloc.rpartition('@')[2],
+        'Accept-Encoding: identity'
+    ]
+    if not pool:
+        lines.append('Connection: close')
+    for name, value in headers.items():
+        if name.lower() not in ('host', 'connection', 'content-length', 'accept-encoding'):
+            lines.append('{}: {}'.format(name, value))
+    if data is not None:
+        if not any(name.lower() == 'content-type' for name in headers):
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+        lines.append('Content-Length: %d' % len(data))
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    if data is not None:
+        request += data
+
+    conn = pool.get(key) if pool else None
+    while True:
+        reused = conn is not None
+        if not reused:
+            conn = _Stream(*await _open_connection(u.hostname, port, tls, timings))
+            if tls:
+                _CERTIFICATES.put(u.hostname, port,
+                                  conn.writer.get_extra_info('peercert'))
+        try:
+            start = time.perf_counter()
+            conn.writer.write(request)
+            await conn.writer.drain()
+            version, status, response_headers = await _read_response_head(conn.reader)
+            timings.ttfb += (time.perf_counter() - start) * 1000
+        except (OSError, asyncio.IncompleteReadError):
+            conn.close()
+            if reused:  # server closed the idle connection, try a new one
+                conn = None
+                continue
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        break
+
+    if status in _REDIRECTS and 'location' in response_headers or status == 401:
+        body = None  # discard
+    try:
+        start = time.perf_counter()
+        complete = await _read_response_body(conn.reader, method, status, response_headers, body)
+        timings.transfer += (time.perf_counter() - start) * 1000
+    except BaseException:
+        conn.close()
+        raise
+
+    if pool and complete and _keep_alive(version, status, response_headers, method):
+        pool.put(key, conn)
+    else:
+        conn.close()
+    return status, response_headers
+
+
+def _keep_alive(version, status, headers, method):
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        if 'keep-alive' not in connection:
+            return False
+    elif 'close' in connection:
+        return False
+    # a body without a length is delimited by the server closing the connection
+    if method == 'HEAD' or 100 <= status <= 199 or status in (204, 304):
+        return True
+    return 'chunked' in headers.get('transfer-encoding', '').lower() or 'content-length' in headers
+
+
+async def _read_response_head(reader):
+
+    while True:
+        lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        try:
+            version, status = lines[0].split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise ConnectionError('malformed status line %r' % lines[0])
+        if status != 100:
+            break
+
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            continue
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            value = '{}, {}'.format(headers[name], value)
+        headers[name] = value
+    return version, status, headers
+
+
+async def _read_response_body(reader, method, status, headers, body=None):
+    """Feed the response body to `body`, returns False if reading stopped early."""
+
+    if method == 'HEAD' or 100 <= status <= 199 or status in (204, 304):
+        return True
+
+    chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+    length = None
+    if not chunked and 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise ConnectionError('malformed content length')
+
+    drain = None
+    if body is not None and not body.wants_body:
+        if not chunked and (length is None or length > DRAIN_BYTES):
+            return False
+        body = None  # drain so the connection can be reused
+        drain = DRAIN_BYTES
+
+    if chunked:
         while True:
+            try:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+            except ValueError:
+                raise ConnectionError('malformed chunk size')
+            if drain is not None:
+                drain -= size
+                if drain < 0:
+                    return False
+            if not size:
+                while (await reader.readline()).strip():  # skip trailers
+                    pass
+                return True
+            while size:
+                data = await reader.readexactly(min(size, BODY_CHUNK))
+                size -= len(data)
+                if body is not None and body.feed(data):
+                    return False
+            await reader.readexactly(2)
+
+    if length is not None:
+        while length:
+            data = await reader.read(min(length, BODY_CHUNK))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', length)
+            length -= len(data)
+            if body is not None and body.feed(data):
+                return not length
+        return True
+
+    while True:  # body is delimited by the server closing the connection
+        data = await reader.read(BODY_CHUNK)
+        if not data:
+            return True
+        if body is not None and body.feed(data):
+            return False
+
+
+class ShardMap:
+    """Assign checks to one of several urlmon instances by their resource.
+
+    Uses rendezvous (highest random weight) hashing so adding or removing a
+    shard only moves the checks that belong to it.
+    """
+
+    def __init__(self, nodes, node):
+
+        if node not in nodes:
+            raise ValueError('shard %r is not one of %s' %
+                             (node, ', '.join(nodes)))
+        self.nodes = list(nodes)
+        self.node = node
+
+    @classmethod
+    def from_settings(cls, shards, shard):
+        """Return a ShardMap for SHARDS and SHARD, or None if not sharded."""
+
+        if not shards:
+            return None
+        if shard is None:
+            raise ValueError('SHARD must be set when SHARDS is')
+        if isinstance(shards, int):
+            return cls(['shard-%d' % i for i in range(shards)], 'shard-%d' % int(shard))
+        return cls([str(n) for n in shards], str(shard))
 
-            count -= 1
-            start = time.time()
+    @staticmethod
+    def weight(node, resource):
 
-            if username and password:
-                auth_handler = HTTPBasicAuthHandler()
-                auth_handler.add_password(realm=realm,
-                                          uri=uri,
-                                          user=username,
-                                          passwd=password)
-                if proxy:
-                    opener = build_opener(auth_handler, ProxyHandler(proxy))
-                else:
-                    opener = build_opener(auth_handler)
+        key = '{}\0{}'.format(node, resource).encode('utf-8')
+        digest = hashlib.sha1(key).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def owner(self, resource):
+
+        return max(self.nodes, key=lambda node: self.weight(node, resource))
+
+    def owns(self, check):
+
+        return self.owner(check.resource) == self.node
+
+
+class CheckScheduler:
+    """Timer heap that releases every check once per `interval` seconds.
+
+    First runs are spread at random across each check's interval and later
+    runs are jittered by up to JITTER of the interval so that checks do not
+    all fire at the start of the loop.
+    """
+
+    def __init__(self, checks, jitter=JITTER):
+
+        self.jitter = jitter
+        self._heap = []
+        self._seq = itertools.count()
+        self._checks = {}
+
+        self.update(checks)
+
+    def __len__(self):
+
+        return len(self._checks)
+
+    @property
+    def checks(self):
+
+        return [check for _, check in self._checks.values()]
+
+    @staticmethod
+    def interval(check):
+
+        return check.interval
+
+    @staticmethod
+    def key(check):
+
+        return json.dumps(check.definition, sort_keys=True, default=repr)
+
+    def update(self, checks):
+        """Replace the scheduled checks with `checks` and return (added, removed).
+
+        Checks whose definition is unchanged keep their existing Check object
+        and place in the timer heap. Removed checks are dropped lazily when
+        they next fall due.
+        """
+
+        current = collections.defaultdict(list)
+        for key, check in self._checks.values():
+            current[key].append(check)
+
+        added = list()
+        kept = dict()
+        now = time.time()
+        for check in checks:
+            key = self.key(check)
+            if current[key]:
+                check = current[key].pop()
             else:
-                if proxy:
-                    opener = build_opener(ProxyHandler(proxy))
-                else:
-                    opener = build_opener()
-            install_opener(opener)
+                self.add(check, now + random.uniform(0, self.interval(check)))
+                added.append(check)
+            kept[id(check)] = (key, check)
+
+        removed = [check for _, check in self._checks.values()
+                   if id(check) not in kept]
+        self._checks = kept
+        return added, removed
+
+    def add(self, check, due):
+
+        heapq.heappush(self._heap, (due, next(self._seq), check))
+
+    def next_due(self):
+
+        return self._heap[0][0] if self._heap else math.inf
+
+    def due(self, now):
+        """Yield (deadline, check) for all checks due by now and reschedule them."""
+
+        while self._heap and self._heap[0][0] <= now:
+            due, _, check = heapq.heappop(self._heap)
+            if id(check) not in self._checks:
+                continue
+            interval = self.interval(check)
+            deadline = due + interval
+            jitter = random.uniform(-self.jitter, self.jitter)
+            next_due = deadline + jitter * interval
+            if next_due <= now:  # fell behind, don't burst to catch up
+                next_due = now + interval
+            self.add(check, next_due)
+            yield deadline, check
+
+
+class _Coalescing:
+    """Priority queue mixin that drops a check if a previous run is still waiting.
+
+    Items are (deadline, seq, check) tuples so the check with the earliest
+    deadline is handed out first. Under overload every check is delayed by a
+    similar amount rather than queueing up multiple stale runs.
+    """
+
+    def _init(self, maxsize):
+
+        super()._init(maxsize)
+        self.waiting = set()
+        self.coalesced = 0
+
+    def _put(self, item):
+
+        check = item[2]
+        if check is not None:
+            if id(check) in self.waiting:
+                self.coalesced += 1
+                return
+            self.waiting.add(id(check))
+        super()._put(item)
+
+    def _get(self):
+
+        item = super()._get()
+        if item[2] is not None:
+            self.waiting.discard(id(item[2]))
+        return item
+
+
+class DeadlineQueue(_Coalescing, queue.PriorityQueue):
+    pass
+
+
+class AsyncDeadlineQueue(_Coalescing, asyncio.PriorityQueue):
+    pass
+
+
+_SEQUENCE = itertools.count()  # tie-breaker for queue items with the same deadline
+
+
+class AIMDLimit:
+    """Concurrency limit with additive increase and multiplicative decrease.
+
+    Every AIMD_WINDOW results the limit is halved if more than
+    AIMD_TIMEOUT_RATE of them timed out, otherwise it grows by one.
+    """
+
+    __slots__ = ('limit', 'minimum', 'maximum', 'results', 'timeouts')
+
+    def __init__(self, maximum, minimum=1):
+
+        self.limit = self.maximum = maximum
+        self.minimum = minimum
+        self.results = 0
+        self.timeouts = 0
+
+    def record(self, timed_out):
+
+        self.results += 1
+        self.timeouts += timed_out
+        if self.results < AIMD_WINDOW:
+            return
+        if self.timeouts > self.results * AIMD_TIMEOUT_RATE:
+            self.limit = max(self.limit // 2, self.minimum)
+        else:
+            self.limit = min(self.limit + 1, self.maximum)
+        self.results = self.timeouts = 0
+
+
+class _Origin:
+
+    __slots__ = ('limit', 'active', 'deferred')
+
+    def __init__(self, maximum):
+
+        self.limit = AIMDLimit(maximum)
+        self.active = 0
+        self.deferred = {}  # queue items by check, oldest first
+
+
+class ConcurrencyLimiter:
+    """Limits on checks in flight, in total and per origin (scheme, host, port).
+
+    Both limits back off when checks time out, so a struggling origin is
+    throttled while checks to healthy origins keep flowing. Timeouts from an
+    origin that is already throttled do not count against the total limit,
+    which never drops below one origin's worth of checks. A worker first
+    reserves a slot under the total limit, then start() either takes a slot
+    for the check's origin or defers the queue item until one of the
+    origin's checks finishes. Like the queue, only one deferred run of a
+    check is kept.
+    """
+
+    def __init__(self, limit, origin_limit=ORIGIN_CONCURRENCY):
+
+        self.origin_limit = min(origin_limit or limit, limit)
+        self.total = AIMDLimit(limit, max(limit // 10, self.origin_limit))
+        self.active = 0
+        self.deferred = 0
+        self.closed = False
+        self._origins = {}
+        self.cond = threading.Condition()
+
+    def reserve(self, block=True):
+        """Take a slot under the total limit, returns False if none and not `block`."""
+
+        with self.cond:
+            while self.active >= self.total.limit:
+                if not block:
+                    return False
+                self.cond.wait()
+            self.active += 1
+            return True
+
+    def cancel(self):
+
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def start(self, origin, item):
+
+        with self.cond:
+            state = self._origins.get(origin)
+            if state is None:
+                state = self._origins[origin] = _Origin(self.origin_limit)
+            if state.active < state.limit.limit:
+                state.active += 1
+                return True
+            if not self.closed and id(item[2]) not in state.deferred:
+                state.deferred[id(item[2])] = item
+                self.deferred += 1
+            self.active -= 1
+            self.cond.notify()
+            return False
+
+    def finish(self, origin, timed_out):
+        """Release the slots of a finished check, returns a deferred item to queue again or None."""
+
+        with self.cond:
+            self.active -= 1
+            state = self._origins[origin]
+            state.active -= 1
+            self.total.record(
+                timed_out and state.limit.limit == state.limit.maximum)
+            state.limit.record(timed_out)
+            self.cond.notify()
+            if state.deferred:
+                self.deferred -= 1
+                return state.deferred.pop(next(iter(state.deferred)))
+        return None
+
+    def close(self):
+        """Drop deferred checks so that shutdown does not wait for throttled origins."""
+
+        with self.cond:
+            self.closed = True
+            for state in self._origins.values():
+                state.deferred.clear()
+            self.deferred = 0
+
+
+class RetryTimer(threading.Thread):
+    """Puts failed checks back on the worker queue after a delay.
+
+    Items are (deadline, seq, check, previous) where `previous` holds the
+    results of the earlier attempts, so no worker is held while waiting.
+    """
+
+    def __init__(self, queue):
+
+        threading.Thread.__init__(self, name='RetryTimer', daemon=True)
+        self.queue = queue
+        self._heap = []
+        self._cond = threading.Condition()
+
+    def __len__(self):
+
+        return len(self._heap)
+
+    def put_later(self, delay, check, previous):
+
+        due = time.time() + delay
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(_SEQUENCE), check, previous))
+            self._cond.notify()
+
+    def run(self):
+
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - time.time())
+                    else:
+                        self._cond.wait()
+                item = heapq.heappop(self._heap)
+            self.queue.put(item)
+
+
+class _LocalPool:
+    """stats() and update_checks() for worker pools that run checks in this process."""
+
+    def stats(self):
 
-            if 'User-agent' not in headers:
-                headers['User-agent'] = 'alert-urlmon/%s' % (__version__)
+        return {
+            'queued': self.qsize(),
+            'coalesced': self.coalesced,
+            'retries': self.retries,
+            'limit': self.limiter.total.limit,
+            'max_limit': self.limiter.total.maximum,
+            'deferred': self.limiter.deferred,
+            'sent': self.alerts.sent if self.alerts else 0,
+            'suppressed': self.alerts.suppressed if self.alerts else 0,
+            'dns_hits': _RESOLVER.hits,
+            'dns_misses': _RESOLVER.misses
+        }
 
+    def update_checks(self, checks, removed):
+
+        for check in removed:
+            _HISTORY.forget(check)
+            if self.alerts:
+                self.alerts.forget(check)
+
+
+class ThreadWorkerPool(_LocalPool):
+    """Run checks on a fixed pool of WorkerThreads.
+
+    Accepts (deadline, seq, check) items and exposes the same interface as
+    AsyncWorkerPool so UrlmonDaemon can feed either engine.
+    """
+
+    def __init__(self, api, threads=SERVER_THREADS, alerts=None):
+
+        self.api = api
+        self.alerts = alerts
+        self.threads = threads
+        self.queue = DeadlineQueue()
+        self.timer = RetryTimer(self.queue)
+        self.limiter = ConcurrencyLimiter(threads)
+        self.workers = []
+
+    def start(self):
+
+        self.timer.start()
+
+        LOG.debug('Starting %s worker threads...', self.threads)
+        for i in range(self.threads):
+            w = WorkerThread(self.queue, self.api, self.alerts,
+                             self.timer, self.limiter)
             try:
-                if post:
-                    req = Request(url, json.dumps(post), headers=headers)
-                else:
-                    req = Request(url, headers=headers)
-                response = urlopen(req, None, MAX_TIMEOUT)
-            except ValueError as e:
-                LOG.error('Request failed: %s' % e)
-            except URLError as e:
-                if hasattr(e, 'reason'):
-                    reason = str(e.reason)
-                    status = None
-                elif hasattr(e, 'code'):
-                    reason = None
-                    status = e.code  # pylint: disable=no-member
+                w.start()
             except Exception as e:
-                LOG.warning('Unexpected error: %s' % e)
-            else:
-                status = response.getcode()
-                body = response.read()
+                LOG.error('Worker thread #%s did not start: %s', i, e)
+                continue
+            LOG.info('Started worker thread: %s', w.getName())
+            self.workers.append(w)
 
-            rtt = int((time.time() - start) * 1000)  # round-trip time
+    def put(self, item):
 
-            if status:  # return result if any HTTP/S response is received
-                break
+        self.queue.put(item)
+
+    def qsize(self):
+
+        return self.queue.qsize()
+
+    @property
+    def coalesced(self):
+
+        return self.queue.coalesced
+
+    @property
+    def retries(self):
+
+        return len(self.timer)
+
+    def shutdown(self):
+
+        self.limiter.close()
+        for i in range(self.threads):
+            self.queue.put((math.inf, i, None))
+        for w in self.workers:
+            w.join()
+        _HISTORY.close()
 
-            if not count:
+
+class AsyncWorkerPool(_LocalPool):
+    """Run checks as coroutines on a private event loop.
+
+    Accepts the same (deadline, seq, check) items as ThreadWorkerPool.
+    """
+
+    def __init__(self, api, concurrency=MAX_CONCURRENCY, alerts=None):
+
+        self.api = api
+        self.alerts = alerts
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        self.sender = ThreadPoolExecutor(max_workers=SENDER_THREADS)
+        self.connections = ConnectionPool()
+        self.retries = 0  # failed checks waiting to be retried
+        self.limiter = ConcurrencyLimiter(concurrency)
+        self._capacity = None  # notified when the limiter frees a slot
+
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='AsyncWorkerPool')
+
+    def start(self):
+
+        self._thread.start()
+        self._ready.wait()
+
+    def put(self, item):
+
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def qsize(self):
+
+        return self.queue.qsize()
+
+    def _retry(self, item):
+
+        self.retries -= 1
+        self.queue.put_nowait(item)
+
+    @property
+    def coalesced(self):
+
+        return self.queue.coalesced
+
+    def shutdown(self):
+
+        self.limiter.close()
+        for i in range(self.concurrency):
+            self.put((math.inf, i, None))
+        self._thread.join()
+        self.sender.shutdown()
+        _HISTORY.close()
+
+    def _run(self):
+
+        asyncio.set_event_loop(self.loop)
+        self.queue = AsyncDeadlineQueue()
+        self._capacity = asyncio.Condition()
+        workers = [self.loop.create_task(self._worker())
+                   for _ in range(self.concurrency)]
+        self._ready.set()
+        try:
+            self.loop.run_until_complete(asyncio.gather(*workers))
+        finally:
+            self.connections.clear()
+            self.loop.close()
+
+    async def _released(self):
+
+        async with self._capacity:
+            self._capacity.notify()
+
+    async def _worker(self):
+
+        while True:
+            async with self._capacity:
+                await self._capacity.wait_for(lambda: self.limiter.reserve(block=False))
+            item = await self.queue.get()
+            deadline, _, check, *previous = item
+            if check is None:
+                self.limiter.cancel()
+                await self._released()
                 break
-            time.sleep(10)
 
-        return status, reason, body, rtt
+            if not self.limiter.start(check.origin, item):
+                LOG.debug('Deferring %s, too many checks in flight to %s',
+                          check.resource, check.origin[1])
+                await self._released()
+                continue
+
+            if time.time() > deadline:
+                LOG.warning('URL request for %s to %s is running %d seconds late.', check.resource, check.url,
+                            int(time.time() - deadline))
+
+            result = None
+            try:
+                result = await self.process(check, *previous)
+            except Exception as e:
+                LOG.error('Check for %s failed: %s',
+                          check.resource, e, exc_info=1)
+            finally:
+                deferred = self.limiter.finish(
+                    check.origin, result is not None and result.timed_out)
+                if deferred:
+                    self.queue.put_nowait(deferred)
+            await self._released()
+
+    async def process(self, check, previous=()):
+
+        resource = check.resource
+        LOG.info('Polling %s...', resource)
+        result = await async_urlmon(check, self.connections)
+        result.previous = list(previous)
+        if result.should_retry(check):
+            LOG.info('%s attempt %d of %d failed, retrying in %ds.',
+                     resource, result.attempts, check.count, RETRY_DELAY)
+            item = (time.time() + RETRY_DELAY, next(_SEQUENCE),
+                    check, result.previous + [result])
+            self.retries += 1
+            self.loop.call_later(RETRY_DELAY, self._retry, item)
+            return result
+        history = _HISTORY.record(check, result)
+        event, severity, value, text = check_status(check, result, history)
+
+        days_left = None
+        if check.check_ssl:
+            try:
+                days_left = await async_ssl_days_left(check)
+            except Exception as e:
+                LOG.warning(
+                    'Failed to get certificate for %s: %s', resource, e)
+
+        await self.loop.run_in_executor(
+            self.sender, send_check_alerts, self.api, check, event, severity, value, text, days_left, self.alerts, result,
+            history)
+        LOG.info('%s check complete.', resource)
+        return result
+
+
+def worker_pool(engine, api, alerts=None):
+    """Return the worker pool for ENGINE, not yet started."""
+
+    if engine == 'asyncio':
+        # Run checks as coroutines on a single event loop
+        LOG.debug(
+            'Starting asyncio engine for up to %s concurrent checks...', MAX_CONCURRENCY)
+        return AsyncWorkerPool(api, MAX_CONCURRENCY, alerts)
+    return ThreadWorkerPool(api, SERVER_THREADS, alerts)
+
+
+class ProcessWorkerPool:
+    """Run checks in child processes, each with its own ENGINE worker pool.
+
+    The parent keeps the scheduler and sends each child ('run', deadline,
+    seq, id) for the checks assigned to it. Children compile their checks
+    from the definitions sent whenever the checks change, and every check
+    always runs in the same child so its alert state stays in one place.
+    Children report their stats() every STATS_EVERY seconds.
+    """
+
+    def __init__(self, processes=PROCESSES, engine=ENGINE):
+
+        self.engine = engine
+        self.processes = [None] * processes
+        self.inboxes = [multiprocessing.Queue() for _ in range(processes)]
+        self.outbox = multiprocessing.Queue()
+        self._ids = {}          # check id by id(Check)
+        self._definitions = {}  # check definition by check id
+        self._next_id = itertools.count()
+        self._stats = {}
+
+    def start(self):
+
+        for index in range(len(self.processes)):
+            self._spawn(index)
+
+    def _spawn(self, index):
+
+        process = multiprocessing.Process(
+            target=_worker_process, args=(
+                index, self.engine, self.inboxes[index], self.outbox),
+            name='urlmon-worker-%d' % index, daemon=True)
+        process.start()
+        self.processes[index] = process
+        LOG.info('Started worker process: %s (pid %s)',
+                 process.name, process.pid)
+
+    def _send_checks(self, index):
+
+        n = len(self.processes)
+        checks = {cid: d for cid, d in self._definitions.items()
+                  if cid % n == index}
+        self.inboxes[index].put(('checks', checks))
+
+    def update_checks(self, checks, removed):
+
+        ids = {}
+        for check in checks:
+            cid = self._ids.get(id(check))
+            ids[id(check)] = next(self._next_id) if cid is None else cid
+        self._ids = ids
+        self._definitions = {
+            ids[id(check)]: check.definition for check in checks}
+        for index in range(len(self.processes)):
+            self._send_checks(index)
+
+    def put(self, item):
+
+        cid = self._ids.get(id(item[2]))
+        if cid is not None:
+            self.inboxes[cid % len(self.processes)].put(
+                ('run', item[0], item[1], cid))
+
+    def stats(self):
+
+        while True:
+            try:
+                index, stats = self.outbox.get_nowait()
+            except queue.Empty:
+                break
+            self._stats[index] = stats
+
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                LOG.error('Worker process %s exited with code %s, restarting...',
+                          process.name, process.exitcode)
+                self._stats.pop(index, None)
+                # the old one may be left locked
+                self.inboxes[index] = multiprocessing.Queue()
+                self._spawn(index)
+                self._send_checks(index)
+
+        total = collections.Counter()
+        for stats in self._stats.values():
+            total.update(stats)
+        return total
+
+    def shutdown(self):
+
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def _worker_process(index, engine, inbox, outbox):
+    """Run the checks sent by a ProcessWorkerPool in a child process."""
+
+    # the parent shuts the children down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    api = Client(endpoint=settings.ENDPOINT, key=settings.API_KEY)
+    alerts = AlertFilter(ALERT_REFRESH) if ALERT_REFRESH else None
+    pool = worker_pool(engine, api, alerts)
+    pool.start()
+
+    checks = {}
+    next_stats = time.time()
+    while True:
+        try:
+            message = inbox.get(timeout=STATS_EVERY)
+        except queue.Empty:
+            message = ('idle',)
+        if message is None:
+            break
+
+        if message[0] == 'run':
+            _, deadline, seq, cid = message
+            check = checks.get(cid)
+            if check is not None:
+                pool.put((deadline, seq, check))
+        elif message[0] == 'checks':
+            current = {cid: checks.get(cid) or Check(definition)
+                       for cid, definition in message[1].items()}
+            removed = [check for cid, check in checks.items()
+                       if cid not in current]
+            pool.update_checks(list(current.values()), removed)
+            checks = current
+
+        if time.time() >= next_stats:
+            outbox.put((index, pool.stats()))
+            next_stats = time.time() + STATS_EVERY
+
+    pool.shutdown()
 
 
 class UrlmonDaemon:
@@ -385,42 +2773,106 @@ class UrlmonDaemon:
     def __init__(self):
 
         self.shuttingdown = False
+        self.reload = False
+
+    def load_checks(self):
+
+        checks = compile_checks(self.source.load())
+        if self.shards:
+            total = len(checks)
+            checks = [check for check in checks if self.shards.owns(check)]
+            LOG.info('Shard %s of %s running %d of %d checks',
+                     self.shards.node, len(self.shards.nodes), len(checks), total)
+        return checks
+
+    def reload_checks(self, scheduler):
+
+        LOG.info('Reloading checks from %s...', self.source.path)
+        try:
+            checks = self.load_checks()
+        except Exception as e:
+            LOG.error(
+                'Failed to reload checks, keeping %d current checks: %s', len(scheduler), e)
+            return
+
+        added, removed = scheduler.update(checks)
+        self.queue.update_checks(scheduler.checks, removed)
+        LOG.info('Reloaded checks: %d added, %d removed, %d running',
+                 len(added), len(removed), len(scheduler))
+
+    def sighup(self, signum, frame):
+
+        self.reload = True
 
     def run(self):
 
         self.running = True
 
-        self.queue = queue.Queue()
         self.api = Client(endpoint=settings.ENDPOINT, key=settings.API_KEY)
 
-        # Start worker threads
-        LOG.debug('Starting %s worker threads...', SERVER_THREADS)
-        for i in range(SERVER_THREADS):
-            w = WorkerThread(self.queue, self.api)
-            try:
-                w.start()
-            except Exception as e:
-                LOG.error('Worker thread #%s did not start: %s', i, e)
-                continue
-            LOG.info('Started worker thread: %s', w.getName())
+        # fail on bad shard settings or checks before any workers are running
+        self.source = CheckSource(CHECKS_FILE)
+        self.shards = ShardMap.from_settings(SHARDS, SHARD)
+        origin = '{}/{}'.format('urlmon', platform.uname()[1])
+        if self.shards:
+            origin = '{}/{}'.format(origin, self.shards.node)
+        scheduler = CheckScheduler(self.load_checks())
+
+        if PROCESSES > 1:
+            LOG.debug('Starting %s worker processes...', PROCESSES)
+            self.queue = ProcessWorkerPool(PROCESSES, ENGINE)
+        else:
+            self.alerts = AlertFilter(ALERT_REFRESH) if ALERT_REFRESH else None
+            self.queue = worker_pool(ENGINE, self.api, self.alerts)
+        self.queue.start()
+        self.queue.update_checks(scheduler.checks, [])
+        next_heartbeat = time.time()
+        next_reload = time.time() + RELOAD_EVERY if RELOAD_EVERY else math.inf
+
+        try:
+            signal.signal(signal.SIGHUP, self.sighup)
+        except (AttributeError, ValueError):  # not on Windows or outside the main thread
+            LOG.debug('Reload on SIGHUP is not available')
 
         while not self.shuttingdown:
             try:
-                for check in settings.checks:
-                    self.queue.put((check, time.time()))
+                now = time.time()
+                if now >= next_reload:
+                    next_reload = now + RELOAD_EVERY
+                    self.reload = self.reload or self.source.changed()
+                if self.reload:
+                    self.reload = False
+                    self.reload_checks(scheduler)
+
+                for deadline, check in scheduler.due(now):
+                    self.queue.put((deadline, next(_SEQUENCE), check))
+
+                if now < next_heartbeat:
+                    # wake for the next due check, batching those a few ms apart
+                    time.sleep(
+                        max(min(scheduler.next_due(), next_heartbeat, next_reload) - time.time(), 0.05))
+                    continue
+                next_heartbeat = now + LOOP_EVERY
 
                 LOG.debug('Send heartbeat...')
                 try:
-                    origin = '{}/{}'.format('urlmon', platform.uname()[1])
                     self.api.heartbeat(
                         origin, tags=[__version__], timeout=3600)
                 except Exception as e:
                     LOG.warning('Failed to send heartbeat: %s', e)
 
-                time.sleep(LOOP_EVERY)
-                LOG.info('URL check queue length is %d', self.queue.qsize())
-
-                if self.queue.qsize() > 100:
+                stats = self.queue.stats()
+                LOG.info('URL check queue length is %d (%d runs skipped while still queued, %d waiting to retry)',
+                         stats['queued'], stats['coalesced'], stats['retries'])
+                LOG.info('Concurrency limit is %d of %d (%d checks deferred by origin limits)',
+                         stats['limit'], stats['max_limit'], stats['deferred'])
+                if ALERT_REFRESH:
+                    LOG.info('Check alerts sent %d, suppressed %d',
+                             stats['sent'], stats['suppressed'])
+                LOG.info('DNS cache hits %d, misses %d',
+                         stats['dns_hits'], stats['dns_misses'])
+
+                if stats['queued'] > 100:
                     severity = 'warning'
                 else:
                     severity = 'ok'
@@ -428,10 +2880,16 @@ class UrlmonDaemon:
                     self.api.send_alert(
                         resource=origin,
                         event='big queue for http checks',
-                        value=self.queue.qsize(),
+                        value=stats['queued'],
                         severity=severity,
-                        text='URL check queue length is %d' % self.queue.qsize(),
+                        text='URL check queue length is %d' % stats['queued'],
                         event_type='serviceAlert',
+                        attributes={
+                            'retriesWaiting': stats['retries'],
+                            'concurrencyLimit': stats['limit'],
+                            'alertsSent': stats['sent'] if ALERT_REFRESH else None,
+                            'alertsSuppressed': stats['suppressed'] if ALERT_REFRESH else None
+                        }
                     )
                 except Exception as e:
                     LOG.warning('Failed to send alert: %s', e)
@@ -442,9 +2900,7 @@ class UrlmonDaemon:
         LOG.info('Shutdown request received...')
         self.running = False
 
-        for i in range(SERVER_THREADS):
-            self.queue.put(None)
-        w.join()
+        self.queue.shutdown()
 
 
 def main():